@@ -0,0 +1,318 @@
+# Compiled-circuit cache
+#
+# Parsing a circuit and preprocessing it only depend on its source, the
+# group order and the setup, yet every process used to redo it. A compiled
+# circuit holds everything that is derived from those: the gate columns
+# (wire ids and selectors), the public input layout, the copy permutation,
+# the preprocessed polynomials and the commitments of the verification key.
+# It is written to a binary artifact named by a hash of its inputs in a
+# cache directory, so that later processes, e.g. prover workers, map the
+# artifact instead of recompiling. Once the directory
+# outgrows its size limit, the least recently used artifacts are evicted.
+#
+# An artifact is a 4-byte magic, a 1-byte version and a 4-byte big-endian
+# header length, followed by a JSON header and the arrays it points to, at
+# offsets aligned to 8 bytes:
+# - "wire_ids": the L, R, O and D variable ids, as little-endian int64
+# - "selectors": the L, R, M, O, C, D, L5, R5, O5 and K selectors, as
+#   32-byte big-endian words of the values modulo the field
+# - "permutation": the copy permutation, as little-endian int64
+# - "preprocessed": the evaluations of QM, QL, QR, QO, QC, S1, S2 and S3,
+#   followed by those of QD, QL5, QR5, QO5 and S4 for programs with custom
+#   gates and of QK and TK for programs with lookups, as 32-byte big-endian
+#   words
+# - "commitments": the commitments of the same polynomials, in the same
+#   order, as compressed points
+import hashlib
+import json
+import numpy as np
+import os
+import tempfile
+from compiler.assembly import Selectors, WireIds
+from compiler.program import Program, CommonPreprocessedInput
+from curve import Scalar
+from dataclasses import dataclass
+from instrumentation import span
+from poly import Polynomial, Basis
+from proving_key import CUSTOM, LOOKUP, ProvingKey
+from scheduler import Scheduler
+from serialization import WORD_SIZE, compress_point, decompress_point
+from setup import Setup
+from typing import Callable, Iterable, Optional
+from verifier import VerificationKey
+
+MAGIC = b"BPLC"
+VERSION = 1
+SUFFIX = ".circuit"
+ALIGNMENT = 8
+
+
+@dataclass
+class CompiledCircuit:
+    """A program with its preprocessed input and verification key"""
+
+    program: Program
+    preprocessed: CommonPreprocessedInput
+    verification_key: VerificationKey
+
+    # The commitments of the verification key are reused, so only the
+    # polynomials of the proving key are computed
+    def proving_key(
+        self, setup: Setup, scheduler: Optional[Scheduler] = None
+    ) -> ProvingKey:
+        return ProvingKey.from_preprocessed_input(
+            setup, self.preprocessed, scheduler, self.verification_key
+        )
+
+
+# Key of the setup: its first power of x determines x, and its length the
+# degrees it can commit to
+def _setup_fingerprint(setup: Setup) -> bytes:
+    return compress_point(setup.powers_of_x[1]) + len(setup.powers_of_x).to_bytes(
+        8, "big"
+    )
+
+
+def _to_words(values: Iterable[int]) -> bytes:
+    modulus = Scalar.field_modulus
+    return b"".join((x % modulus).to_bytes(WORD_SIZE, "big") for x in values)
+
+
+# Selectors are stored modulo the field, and read back as the nearest
+# signed values, so that small negative coefficients are small again
+def _from_words(data: bytes) -> np.ndarray:
+    modulus = Scalar.field_modulus
+    values = []
+    for i in range(0, len(data), WORD_SIZE):
+        x = int.from_bytes(data[i : i + WORD_SIZE], "big")
+        values.append(x - modulus if x > modulus // 2 else x)
+    return np.array(values, dtype=object)
+
+
+# Names of the preprocessed polynomials of the program, mapped to the names
+# of their commitments in the verification key
+def _polynomial_names(program: Program) -> dict[str, str]:
+    names = {x: x.capitalize() for x in ["QM", "QL", "QR", "QO", "QC"]}
+    names.update({x: x for x in ["S1", "S2", "S3"]})
+    if program.has_custom_gates():
+        names.update(CUSTOM)
+    if program.has_lookups():
+        names.update(LOOKUP)
+    return names
+
+
+def encode_circuit(circuit: CompiledCircuit) -> bytes:
+    program = circuit.program
+    names = _polynomial_names(program)
+    polynomials = [getattr(circuit.preprocessed, x) for x in names]
+    commitments = [getattr(circuit.verification_key, x) for x in names.values()]
+    arrays = {
+        "wire_ids": np.stack(program.wire_ids.as_list()).astype("<i8").tobytes(),
+        "selectors": _to_words(
+            int(x) for column in program.selectors.as_list() for x in column
+        ),
+        "permutation": program.copy_permutation().astype("<i8").tobytes(),
+        "preprocessed": b"".join(
+            x.n.to_bytes(WORD_SIZE, "big") for p in polynomials for x in p.values
+        ),
+        "commitments": b"".join(compress_point(x) for x in commitments),
+    }
+    offsets = {}
+    offset = 0
+    for name, data in arrays.items():
+        offsets[name] = [offset, len(data)]
+        offset += -len(data) % ALIGNMENT + len(data)
+    header = json.dumps(
+        {
+            "group_order": program.group_order,
+            "num_constraints": program.num_constraints,
+            "variables": program.variables,
+            "public_ids": program.public_ids(),
+            "arrays": offsets,
+        }
+    ).encode()
+    out = bytearray(MAGIC)
+    out.append(VERSION)
+    out += len(header).to_bytes(4, "big")
+    out += header
+    out += bytes(-len(out) % ALIGNMENT)
+    for data in arrays.values():
+        out += data + bytes(-len(data) % ALIGNMENT)
+    return bytes(out)
+
+
+# Decodes an artifact from a buffer, typically a memory-mapped file. The
+# wire ids are used in place; the field elements are read into Python ints,
+# so nothing is recomputed
+def decode_circuit(data: np.ndarray, setup: Setup) -> CompiledCircuit:
+    if bytes(data[: len(MAGIC)]) != MAGIC:
+        raise Exception("Not a compiled circuit")
+    if data[len(MAGIC)] != VERSION:
+        raise Exception("Unsupported circuit version: {}".format(data[len(MAGIC)]))
+    start = len(MAGIC) + 5
+    length = int.from_bytes(bytes(data[len(MAGIC) + 1 : start]), "big")
+    header = json.loads(bytes(data[start : start + length]))
+    base = start + length
+    base += -base % ALIGNMENT
+
+    def array(name: str) -> np.ndarray:
+        offset, size = header["arrays"][name]
+        return data[base + offset : base + offset + size]
+
+    group_order = header["group_order"]
+    rows = header["num_constraints"]
+    wire_ids = array("wire_ids").view("<i8").reshape(4, rows)
+    selectors = _from_words(array("selectors").tobytes()).reshape(10, rows)
+    program = Program.from_columns(
+        group_order,
+        header["variables"],
+        WireIds(*wire_ids),
+        Selectors(*selectors),
+        header["public_ids"],
+        array("permutation").view("<i8"),
+    )
+    names = _polynomial_names(program)
+    words = array("preprocessed").tobytes()
+    size = group_order * WORD_SIZE
+    polynomials = [
+        Polynomial(
+            [
+                Scalar(int.from_bytes(words[j : j + WORD_SIZE], "big"))
+                for j in range(i, i + size, WORD_SIZE)
+            ],
+            Basis.LAGRANGE,
+        )
+        for i in range(0, len(words), size)
+    ]
+    preprocessed = CommonPreprocessedInput(group_order, *polynomials[:8])
+    optional = list(names.items())[8:]
+    for (name, _), p in zip(optional, polynomials[8:]):
+        setattr(preprocessed, name, p)
+    points = array("commitments").tobytes()
+    commitments = [
+        decompress_point(points[i : i + WORD_SIZE])
+        for i in range(0, len(points), WORD_SIZE)
+    ]
+    verification_key = VerificationKey(
+        group_order,
+        *commitments[:8],
+        setup.X2,
+        Scalar.root_of_unity(group_order),
+        preprocessed.quotient_chunks(),
+    )
+    for (_, name), x in zip(optional, commitments[8:]):
+        setattr(verification_key, name, x)
+    return CompiledCircuit(program, preprocessed, verification_key)
+
+
+class CircuitCache:
+    """Directory of compiled circuits, keyed by a hash of the source, the
+    group order and the setup. Artifacts are written atomically, so
+    processes can share a directory, and the least recently used ones are
+    evicted once the directory holds more than `max_bytes`"""
+
+    def __init__(self, dir: str, max_bytes: int = 1 << 30):
+        os.makedirs(dir, exist_ok=True)
+        self.dir = dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    # Without a group order, circuits are compiled for the smallest one that
+    # fits them
+    def load_str(
+        self, source: str, group_order: Optional[int], setup: Setup
+    ) -> CompiledCircuit:
+        key = self._key([source.encode()], group_order, setup)
+        return self._load(key, lambda: Program.from_str(source, group_order), setup)
+
+    # The file is hashed and, on a miss, parsed in a streaming fashion
+    def load_file(
+        self, path: str, group_order: Optional[int], setup: Setup
+    ) -> CompiledCircuit:
+        def chunks() -> Iterable[bytes]:
+            with open(path, "rb") as f:
+                while chunk := f.read(1 << 20):
+                    yield chunk
+
+        key = self._key(chunks(), group_order, setup)
+        return self._load(key, lambda: Program.from_file(path, group_order), setup)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.dir, key + SUFFIX)
+
+    def _key(
+        self, source: Iterable[bytes], group_order: Optional[int], setup: Setup
+    ) -> str:
+        h = hashlib.sha256()
+        h.update(MAGIC + bytes([VERSION]))
+        h.update((group_order or 0).to_bytes(8, "big"))
+        h.update(_setup_fingerprint(setup))
+        for chunk in source:
+            h.update(chunk)
+        return h.hexdigest()
+
+    def _load(
+        self, key: str, compile: Callable[[], Program], setup: Setup
+    ) -> CompiledCircuit:
+        path = self.path(key)
+        # The artifact may be evicted by another process at any time, so it
+        # is opened rather than checked for. Once open, it stays readable
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            f = None
+        if f is not None:
+            with f, span("load_circuit", "setup", key=key):
+                data = np.memmap(f, dtype=np.uint8, mode="r")
+                circuit = decode_circuit(data, setup)
+                # Mark the artifact as recently used
+                os.utime(f.fileno())
+            self.hits += 1
+            return circuit
+
+        self.misses += 1
+        with span("compile_circuit", "setup", key=key):
+            program = compile()
+            preprocessed = program.common_preprocessed_input()
+            circuit = CompiledCircuit(
+                program, preprocessed, setup.verification_key(preprocessed)
+            )
+        # Temporary files are not counted against `max_bytes`, so one that
+        # is not renamed into place is removed
+        fd, tmp = tempfile.mkstemp(dir=self.dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(encode_circuit(circuit))
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self.evict(keep=path)
+        return circuit
+
+    # Removes the least recently used artifacts until the directory fits in
+    # `max_bytes`, except for `keep`. Other processes may evict the same
+    # artifacts concurrently: one that is already gone no longer takes up
+    # space, whoever removed it
+    def evict(self, keep: Optional[str] = None):
+        entries = []
+        for name in os.listdir(self.dir):
+            if name.endswith(SUFFIX):
+                try:
+                    stat = os.stat(os.path.join(self.dir, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            path = os.path.join(self.dir, name)
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
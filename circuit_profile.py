@@ -0,0 +1,238 @@
+# Circuit profiling: compiles a constraint file and estimates what proving
+# it costs, without running a proof, to plan capacity before submitting
+# circuits to provers.
+#
+# The report holds the gate count, the group order and the rows lost to
+# padding, the fan-out of the variables (the lengths of the cycles of the
+# copy permutation that the S_σ polynomials are built from), the share of
+# rows each selector is set on, and the sizes of the FFTs and MSMs of each
+# prover round, as well as the SRS size needed to prove.
+#
+# Usage:
+#   python circuit_profile.py circuit.txt [--group-order 1024] [--json]
+import argparse
+import json
+import numpy as np
+from compiler.program import Program, extended_order
+from dataclasses import asdict, dataclass
+from typing import Optional
+
+# Selector names, in selector column order (L, R, M, O, C, D, L5, R5, O5, K)
+SELECTORS = ["QL", "QR", "QM", "QO", "QC", "QD", "QL5", "QR5", "QO5", "QK"]
+
+
+@dataclass
+class RoundCost:
+    """The polynomial transforms and commitments of one prover round. Sizes
+    map to how many transforms of that size the round does"""
+
+    round: str
+    # Inverse FFTs from evaluations on the roots of unity to coefficients
+    ifft: dict[int, int]
+    # FFTs over the coset of the extended domain, and back
+    coset_fft: dict[int, int]
+    # MSMs, one per commitment, by number of points
+    msm: dict[int, int]
+
+
+@dataclass
+class CircuitProfile:
+    """Shape of a compiled circuit, and the estimated cost of proving it"""
+
+    gates: int
+    group_order: int
+    # Rows of the group order that hold no gate, and their share of it
+    padding_rows: int
+    padding_ratio: float
+    public_inputs: int
+    custom_gates: bool
+    lookups: bool
+    # Variables, and the number of cycles of the copy permutation of each
+    # length: a variable used in k cells is a cycle of length k
+    variables: int
+    fan_out: dict[int, int]
+    # Largest fan-out, and the variable that has it
+    max_fan_out: int
+    max_fan_out_variable: Optional[str]
+    # Share of the rows of the group order each selector is nonzero on
+    selector_density: dict[str, float]
+    # Cost of building the proving key, then of each round of a proof
+    preprocessing: RoundCost
+    rounds: list[RoundCost]
+    # Powers of x the setup needs
+    srs_size: int
+
+    def __str__(self) -> str:
+        lines = [
+            "gates:          {}".format(self.gates),
+            "group order:    {} ({} padding rows, {:.1%})".format(
+                self.group_order, self.padding_rows, self.padding_ratio
+            ),
+            "public inputs:  {}".format(self.public_inputs),
+            "features:       {}".format(
+                ", ".join(
+                    name
+                    for name, x in (
+                        ("custom gates", self.custom_gates),
+                        ("lookups", self.lookups),
+                    )
+                    if x
+                )
+                or "none"
+            ),
+            "variables:      {} (max fan-out {}: {})".format(
+                self.variables, self.max_fan_out, self.max_fan_out_variable
+            ),
+            "fan-out:        {}".format(
+                ", ".join("{}x{}".format(k, v) for k, v in self.fan_out.items())
+            ),
+            "selectors:      {}".format(
+                ", ".join(
+                    "{} {:.1%}".format(k, v) for k, v in self.selector_density.items()
+                )
+            ),
+            "srs size:       {} powers".format(self.srs_size),
+            "cost:",
+        ]
+        for cost in [self.preprocessing] + self.rounds:
+            lines.append(
+                "  {:<14}{}".format(
+                    cost.round,
+                    "; ".join(
+                        "{} {}".format(
+                            name,
+                            ", ".join("{}x{}".format(k, v) for k, v in sizes.items()),
+                        )
+                        for name, sizes in (
+                            ("ifft", cost.ifft),
+                            ("coset fft", cost.coset_fft),
+                            ("msm", cost.msm),
+                        )
+                        if sizes
+                    )
+                    or "evaluations only",
+                )
+            )
+        return "\n".join(lines)
+
+    def to_json(self) -> dict:
+        return asdict(self)
+
+
+def _sizes(*pairs: tuple[int, int]) -> dict[int, int]:
+    sizes: dict[int, int] = {}
+    for size, count in pairs:
+        if count:
+            sizes[size] = sizes.get(size, 0) + count
+    return sizes
+
+
+# Transforms and commitments of the proving key and of each prover round,
+# following `ProvingKey.from_preprocessed_input` and `Prover`. With n the
+# group order, polynomials are committed to as n coefficients, and the
+# quotient is computed over a coset of the extended domain (see
+# `extended_order`)
+def estimate_costs(program: Program) -> tuple[RoundCost, list[RoundCost]]:
+    n = program.group_order
+    wires = len(program.columns())
+    custom = int(program.has_custom_gates())
+    lookups = int(program.has_lookups())
+    quotient_chunks = program.quotient_chunks()
+    extended = extended_order(n, quotient_chunks)
+
+    # Selectors and S_σ polynomials, and q_K(X) and t(X), committed to for
+    # the verification key, and L_0(X) over the coset
+    preprocessed = 5 + wires + 4 * custom + 2 * lookups
+    preprocessing = RoundCost(
+        "preprocessing",
+        _sizes((n, preprocessed + 1)),
+        _sizes((extended, preprocessed + 1)),
+        _sizes((n, preprocessed)),
+    )
+    rounds = [
+        # Wires, and the sorted halves h1(X), h2(X) of lookups
+        RoundCost(
+            "round_1",
+            _sizes((n, wires + 2 * lookups)),
+            {},
+            _sizes((n, wires + 2 * lookups)),
+        ),
+        # Grand products z(X) and z2(X)
+        RoundCost("round_2", _sizes((n, 1 + lookups)), {}, _sizes((n, 1 + lookups))),
+        # PI(X), every witness polynomial over the coset and the quotient
+        # back, committed in chunks
+        RoundCost(
+            "round_3",
+            _sizes((n, 1)),
+            _sizes((extended, wires + 2 + 3 * lookups), (extended, 1)),
+            _sizes((n, quotient_chunks)),
+        ),
+        RoundCost("round_4", {}, {}, {}),
+        # The opening proofs at ζ and ζω, quotients of degree below n - 1
+        RoundCost("round_5", {}, {}, _sizes((n - 1, 2))),
+    ]
+    return preprocessing, rounds
+
+
+def profile(program: Program) -> CircuitProfile:
+    n = program.group_order
+    columns = len(program.columns())
+    # The cycle of a variable has one cell per use, and the unused rows are
+    # uses of the empty wire, which is left out
+    uses = np.bincount(
+        np.concatenate(program.wire_ids.as_list()[:columns]),
+        minlength=len(program.variables),
+    )[1:]
+    lengths, counts = np.unique(uses[uses > 0], return_counts=True)
+    busiest = int(np.argmax(uses)) + 1 if len(uses) else 0
+
+    names = SELECTORS[:5]
+    if program.has_custom_gates():
+        names += SELECTORS[5:9]
+    if program.has_lookups():
+        names += SELECTORS[9:]
+    density = {
+        name: np.count_nonzero(program.selectors.as_list()[SELECTORS.index(name)]) / n
+        for name in names
+    }
+
+    preprocessing, rounds = estimate_costs(program)
+    return CircuitProfile(
+        program.num_constraints,
+        n,
+        program.padding_rows(),
+        program.padding_ratio(),
+        len(program.public_ids()),
+        program.has_custom_gates(),
+        program.has_lookups(),
+        len(program.variables) - 1,
+        {int(k): int(v) for k, v in zip(lengths, counts)},
+        int(uses.max(initial=0)),
+        program.variables[busiest] if busiest else None,
+        density,
+        preprocessing,
+        rounds,
+        n,
+    )
+
+
+def main(argv: Optional[list[str]] = None):
+    parser = argparse.ArgumentParser(
+        description="Report the shape of a circuit and the cost of proving it"
+    )
+    parser.add_argument("path", help="constraint file")
+    parser.add_argument(
+        "--group-order",
+        type=int,
+        default=None,
+        help="group order to compile for, the smallest that fits by default",
+    )
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args(argv)
+
+    report = profile(Program.from_file(args.path, args.group_order))
+    print(json.dumps(report.to_json(), indent=2) if args.json else report)
+
+
+if __name__ == "__main__":
+    main()
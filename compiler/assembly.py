@@ -1,19 +1,75 @@
+import numpy as np
+import re
 from utils import *
 from .utils import *
-from typing import Optional
+from typing import Optional, Union
 from dataclasses import dataclass
+from functools import lru_cache
 
 
 @dataclass
 class GateWires:
-    """Variable names for Left, Right, and Output wires."""
+    """Variable names for Left, Right, and Output wires, and for the Fourth
+    wire of custom gates, which holds their output. The Output wire is then
+    a third input."""
 
     L: Optional[str]
     R: Optional[str]
     O: Optional[str]
+    D: Optional[str] = None
 
     def as_list(self) -> list[Optional[str]]:
-        return [self.L, self.R, self.O]
+        return [self.L, self.R, self.O, self.D]
+
+
+@dataclass
+class WireIds:
+    """Interned variable ids of the Left, Right, Output and Fourth wires of
+    every gate, one int array per column. Id 0 is the empty wire (None)."""
+
+    L: np.ndarray
+    R: np.ndarray
+    O: np.ndarray
+    D: np.ndarray
+
+    def as_list(self) -> list[np.ndarray]:
+        return [self.L, self.R, self.O, self.D]
+
+
+@dataclass
+class Selectors:
+    """Selector coefficients of every gate, one object array of ints per
+    selector, as in `Gate` but not reduced modulo the field, so that the
+    usual small coefficients share Python's cached small ints."""
+
+    L: np.ndarray
+    R: np.ndarray
+    M: np.ndarray
+    O: np.ndarray
+    C: np.ndarray
+    # Selectors of custom gates: the Fourth wire, and the fifth powers of the
+    # Left, Right and Output wires
+    D: np.ndarray
+    L5: np.ndarray
+    R5: np.ndarray
+    O5: np.ndarray
+    # Lookups: the size of the range table the Left wire is looked up in, 0
+    # for other gates
+    K: np.ndarray
+
+    def as_list(self) -> list[np.ndarray]:
+        return [
+            self.L,
+            self.R,
+            self.M,
+            self.O,
+            self.C,
+            self.D,
+            self.L5,
+            self.R5,
+            self.O5,
+            self.K,
+        ]
 
 
 @dataclass
@@ -25,6 +81,11 @@ class Gate:
     M: Scalar
     O: Scalar
     C: Scalar
+    D: Scalar
+    L5: Scalar
+    R5: Scalar
+    O5: Scalar
+    K: Scalar
 
 
 @dataclass
@@ -46,65 +107,195 @@ class AssemblyEqn:
         return Scalar(-self.coeffs.get("", 0))
 
     def O(self) -> Scalar:
+        if self.is_custom():
+            return Scalar(-self.coeffs.get(self.wires.O, 0))
         return Scalar(self.coeffs.get("$output_coeff", 1))
 
     def M(self) -> Scalar:
-        if None not in self.wires.as_list():
+        if None not in (self.wires.L, self.wires.R):
             return Scalar(
                 -self.coeffs.get(get_product_key(self.wires.L, self.wires.R), 0)
             )
         return Scalar(0)
 
+    # Custom gates have their output on the Fourth wire
+    def is_custom(self) -> bool:
+        return self.wires.D is not None
+
+    # Size of the range table the Left wire is looked up in, 0 if the gate
+    # is not a lookup
+    def lookup(self) -> int:
+        return self.coeffs.get("$lookup", 0)
+
     def gate(self) -> Gate:
-        return Gate(self.L(), self.R(), self.M(), self.O(), self.C())
+        return Gate(*(Scalar(x) for x in self.selectors()))
 
+    # The gate's selectors as plain ints (L, R, M, O, C, D, L5, R5, O5, K),
+    # see `Selectors`
+    def selectors(self) -> tuple[int, ...]:
+        coeffs, wires = self.coeffs, self.wires
+        product = get_product_key(wires.L, wires.R)
+        output_coeff = coeffs.get("$output_coeff", 1)
+        custom = self.is_custom()
+        return (
+            -coeffs.get(wires.L, 0),
+            -coeffs.get(wires.R, 0) if wires.R != wires.L else 0,
+            -coeffs.get(product, 0) if None not in (wires.L, wires.R) else 0,
+            -coeffs.get(wires.O, 0) if custom else output_coeff,
+            -coeffs.get("", 0),
+            output_coeff if custom else 0,
+            *(
+                -coeffs.get(get_power_key(x, 5), 0) if custom and x else 0
+                for x in (wires.L, wires.R, wires.O)
+            ),
+            self.lookup(),
+        )
 
-# Converts a arithmetic expression containing numbers, variables and {+, -, *}
-# into a mapping of term to coefficient
-#
-# For example:
-# ['a', '+', 'b', '*', 'c', '*', '5'] becomes {'a': 1, 'b*c': 5}
-#
-# Note that this is a recursive algo, so the input can be a mix of tokens and
-# mapping expressions
-#
-def evaluate(exprs: list[str], first_is_negative=False) -> dict[Optional[str], int]:
-    # Splits by + and - first, then *, to follow order of operations
-    # The first_is_negative flag helps us correctly interpret expressions
-    # like 6000 - 700 - 80 + 9 (that's 5229)
-    if "+" in exprs:
-        L = evaluate(exprs[: exprs.index("+")], first_is_negative)
-        R = evaluate(exprs[exprs.index("+") + 1 :], False)
-        return {x: L.get(x, 0) + R.get(x, 0) for x in set(L.keys()).union(R.keys())}
-    elif "-" in exprs:
-        L = evaluate(exprs[: exprs.index("-")], first_is_negative)
-        R = evaluate(exprs[exprs.index("-") + 1 :], True)
-        return {x: L.get(x, 0) + R.get(x, 0) for x in set(L.keys()).union(R.keys())}
-    elif "*" in exprs:
-        L = evaluate(exprs[: exprs.index("*")], first_is_negative)
-        R = evaluate(exprs[exprs.index("*") + 1 :], first_is_negative)
-        o = {}
-        for k1 in L.keys():
-            for k2 in R.keys():
-                o[get_product_key(k1, k2)] = L[k1] * R[k2]
-        return o
-    elif len(exprs) > 1:
-        raise Exception("No ops, expected sub-expr to be a unit: {}".format(exprs[1]))
-    elif exprs[0][0] == "-":
-        return evaluate([exprs[0][1:]], not first_is_negative)
-    elif exprs[0].isnumeric():
-        return {"": int(exprs[0]) * (-1 if first_is_negative else 1)}
-    elif is_valid_variable_name(exprs[0]):
-        return {exprs[0]: -1 if first_is_negative else 1}
-    else:
-        raise Exception("ok wtf is {}".format(exprs[0]))
+
+# Splits a line of the constraint language into tokens: ("num", int),
+# ("var", name) and ("op", op) for the operators +, -, *, ^, < and the
+# keywords <== and ===. Spaces between tokens are optional
+def tokenize(eq: str) -> list[tuple[str, Union[int, str]]]:
+    tokens: list[tuple[str, Union[int, str]]] = []
+    for num, var, op, other in _TOKEN.findall(eq):
+        if num:
+            tokens.append(("num", int(num)))
+        elif var:
+            tokens.append(("var", var))
+        elif op:
+            tokens.append(("op", op))
+        else:
+            raise Exception("Unexpected character: {}".format(other))
+    return tokens
+
+
+_TOKEN = re.compile(r"(\d+)|([^\W\d_][^\W_]*)|(<==|===|[-+*^<])|(\S)")
+
+# Binding strength of the binary operators
+_PRECEDENCE = {"+": 1, "-": 1, "*": 2, "^": 3}
+
+
+class _Parser:
+    """Precedence-climbing parser of an expression into a mapping of term to
+    coefficient. A term is the sorted tuple of the variables multiplied in
+    it, so the constant term is ()"""
+
+    def __init__(self, tokens: list[tuple[str, Union[int, str]]], pos: int):
+        self.tokens = tokens
+        self.pos = pos
+
+    def peek(self) -> Optional[tuple[str, Union[int, str]]]:
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def parse(self) -> dict[tuple, int]:
+        coeffs = self.expression(1)
+        if self.pos < len(self.tokens):
+            raise Exception(
+                "Unexpected token: {}".format(_describe(self.tokens[self.pos]))
+            )
+        return coeffs
+
+    def expression(self, min_precedence: int) -> dict[tuple, int]:
+        left = self.unary()
+        while True:
+            token = self.peek()
+            if token is None:
+                return left
+            if token[0] != "op" or token[1] not in _PRECEDENCE:
+                raise Exception("Unexpected token: {}".format(_describe(token)))
+            if _PRECEDENCE[token[1]] < min_precedence:
+                return left
+            self.pos += 1
+            right = self.expression(_PRECEDENCE[token[1]] + 1)
+            if token[1] == "*":
+                left = _multiply(left, right)
+            elif token[1] == "^":
+                exponent = right.get((), 0)
+                if list(right) != [()] or exponent < 1:
+                    raise Exception("Exponents must be positive numbers")
+                power = left
+                for _ in range(exponent - 1):
+                    power = _multiply(power, left)
+                left = power
+            else:
+                sign = 1 if token[1] == "+" else -1
+                for term, coeff in right.items():
+                    left[term] = left.get(term, 0) + sign * coeff
+
+    def unary(self) -> dict[tuple, int]:
+        token = self.peek()
+        self.pos += 1
+        if token is None:
+            raise Exception("Unexpected end of expression")
+        kind, value = token
+        if kind == "num":
+            return {(): value}
+        elif kind == "slot":
+            return {(value,): 1}
+        elif value == "-":
+            # -x^5 is -(x^5)
+            negated = self.expression(_PRECEDENCE["^"])
+            return {term: -coeff for term, coeff in negated.items()}
+        else:
+            raise Exception("Unexpected token: {}".format(_describe(token)))
+
+
+# Variables are replaced by their slots before parsing, see `_parse_template`
+def _describe(token: tuple[str, Union[int, str]]) -> str:
+    return "variable" if token[0] == "slot" else str(token[1])
+
+
+def _multiply(left: dict[tuple, int], right: dict[tuple, int]) -> dict[tuple, int]:
+    o: dict[tuple, int] = {}
+    for k1, c1 in left.items():
+        for k2, c2 in right.items():
+            term = tuple(sorted(k1 + k2))
+            o[term] = o.get(term, 0) + c1 * c2
+    return o
+
+
+@dataclass
+class _Template:
+    """A parsed line whose variables are numbered by first use"""
+
+    # Slots of the output variable and of the variables of the expression
+    out: int
+    variables: list[int]
+    coeffs: dict[tuple, int]
+    negate_out: bool
+
+
+# Lines of generated programs repeat the same shape with other variables,
+# e.g. `Lsq0 <== Ladj0 * Ladj0`, so lines are parsed once per template: the
+# tokens with every variable replaced by its slot
+@lru_cache(maxsize=4096)
+def _parse_template(template: tuple) -> _Template:
+    tokens = list(template)
+    negate_out = len(tokens) > 0 and tokens[0] == ("op", "-")
+    if negate_out:
+        tokens = tokens[1:]
+    if len(tokens) < 2 or tokens[1] not in (("op", "<=="), ("op", "===")):
+        raise Exception("Unsupported op: {}".format(tokens[1:2]))
+    # Check out variable name validity
+    if tokens[0][0] != "slot":
+        raise Exception("Invalid out variable name: {}".format(tokens[0][1]))
+    out = tokens[0][1]
+    variables = []
+    for kind, value in tokens[2:]:
+        if kind == "slot" and value not in variables:
+            variables.append(value)
+    coeffs = _Parser(tokens, 2).parse()
+    return _Template(out, variables, coeffs, negate_out)
 
 
 # Converts an equation to a mapping of term to coefficient, and verifies that
 # the operations in the equation are valid.
 #
 # Also outputs a triple containing the L and R input variables and the output
-# variable
+# variable. Constraints with three input variables or fifth powers compile to
+# custom gates, whose inputs are on the L, R and O wires and whose output is
+# on the fourth wire D. Range checks `a < size` compile to lookups of the L
+# wire in the table 0, 1, ..., size - 1, with no gate
 #
 # Think of the list of (variable triples, coeffs) pairs as this language's
 # version of "assembly"
@@ -113,54 +304,77 @@ def evaluate(exprs: list[str], first_is_negative=False) -> dict[Optional[str], i
 # a === 9                      ([None, None, 'a'], {'': 9})
 # b <== a * c                  (['a', 'c', 'b'], {'a*c': 1})
 # d <== a * c - 45 * a + 987   (['a', 'c', 'd'], {'a*c': 1, 'a': -45, '': 987})
+# d <== a^5 + 2 * b - c        (['a', 'b', 'c', 'd'], {'a*a*a*a*a': 1, 'b': 2,
+#                                                      'c': -1})
+# a < 256                      (['a', None, None], {'$output_coeff': 0,
+#                                                   '$lookup': 256})
 #
 # Example invalid equations:
 # 7 === 7                      # Can't assign to non-variable
 # a <== b * * c                # Two times signs in a row
 # e <== a + b * c * d          # Multiplicative degree > 2
+# e <== a^3                    # Powers other than the fifth
+# a < b                        # Range checks against a variable
 #
 def eq_to_assembly(eq: str) -> AssemblyEqn:
-    tokens = eq.rstrip("\n").split(" ")
-    if tokens[1] in ("<==", "==="):
-        # First token is the output variable
-        out = tokens[0]
-        # Convert the expression to coefficient map form
-        coeffs = evaluate(tokens[2:])
-        # Handle the "-x === a * b" case
-        if out[0] == "-":
-            out = out[1:]
-            coeffs["$output_coeff"] = -1
-        # Check out variable name validity
-        if not is_valid_variable_name(out):
-            raise Exception("Invalid out variable name: {}".format(out))
-        # Gather list of variables used in the expression
-        variables = []
-        for t in tokens[2:]:
-            var = t.lstrip("-")
-            if is_valid_variable_name(var) and var not in variables:
-                variables.append(var)
-        # Construct the list of allowed coefficients
-        allowed_coeffs = variables + ["", "$output_coeff"]
-        if len(variables) == 0:
-            pass
-        elif len(variables) == 1:
-            variables.append(variables[0])
-            allowed_coeffs.append(get_product_key(*variables))
-        elif len(variables) == 2:
-            allowed_coeffs.append(get_product_key(*variables))
-        else:
-            raise Exception("Max 2 variables, found {}".format(variables))
-        # Check that only allowed coefficients are in the coefficient map
-        for key in coeffs.keys():
-            if key not in allowed_coeffs:
-                raise Exception("Disallowed multiplication: {}".format(key))
-        # Return output
-        wires = variables + [None] * (2 - len(variables)) + [out]
-        return AssemblyEqn(GateWires(wires[0], wires[1], wires[2]), coeffs)
-    elif tokens[1] == "public":
+    tokens = tokenize(eq)
+    if len(tokens) == 2 and tokens[0][0] == "var" and tokens[1] == ("var", "public"):
+        name = tokens[0][1]
+        return AssemblyEqn(
+            GateWires(name, None, None),
+            {name: -1, "$output_coeff": 0, "$public": True},
+        )
+    # Range checks 0 <= a < size are lookups of a in the table 0..size-1
+    if len(tokens) > 1 and tokens[0][0] == "var" and tokens[1] == ("op", "<"):
+        if len(tokens) != 3 or tokens[2][0] != "num" or tokens[2][1] < 1:
+            raise Exception("Range checks must be of the form: var < size")
         return AssemblyEqn(
-            GateWires(tokens[0], None, None),
-            {tokens[0]: -1, "$output_coeff": 0, "$public": True},
+            GateWires(tokens[0][1], None, None),
+            {"$output_coeff": 0, "$lookup": tokens[2][1]},
         )
+    if len(tokens) > 1 and tokens[0][0] == tokens[1][0] == "var":
+        raise Exception("Unsupported op: {}".format(tokens[1][1]))
+    # Number the variables by first use
+    names: list[str] = []
+    slots: dict[str, int] = {}
+    template = []
+    for kind, value in tokens:
+        if kind == "var":
+            if value not in slots:
+                slots[value] = len(names)
+                names.append(value)
+            template.append(("slot", slots[value]))
+        else:
+            template.append((kind, value))
+    parsed = _parse_template(tuple(template))
+    out = names[parsed.out]
+    variables = [names[x] for x in parsed.variables]
+    # Construct the list of allowed coefficients
+    allowed_coeffs = variables + ["", "$output_coeff"]
+    custom = len(variables) == 3 or any(len(x) == 5 for x in parsed.coeffs)
+    if len(variables) > 3:
+        raise Exception("Max 3 variables, found {}".format(variables))
+    elif custom:
+        allowed_coeffs += [get_power_key(x, 5) for x in variables]
+        if len(variables) > 1:
+            allowed_coeffs.append(get_product_key(*variables[:2]))
+    elif len(variables) == 1:
+        variables.append(variables[0])
+        allowed_coeffs.append(get_product_key(*variables))
+    elif len(variables) == 2:
+        allowed_coeffs.append(get_product_key(*variables))
+    coeffs: dict[Optional[str], int] = {}
+    for term, coeff in parsed.coeffs.items():
+        key = "*".join(sorted(names[x] for x in term))
+        # Check that only allowed coefficients are in the coefficient map
+        if key not in allowed_coeffs:
+            raise Exception("Disallowed multiplication: {}".format(key))
+        coeffs[key] = coeff
+    # Handle the "-x === a * b" case
+    if parsed.negate_out:
+        coeffs["$output_coeff"] = -1
+    if custom:
+        wires = variables + [None] * (3 - len(variables)) + [out]
     else:
-        raise Exception("Unsupported op: {}".format(tokens[1]))
+        wires = variables + [None] * (2 - len(variables)) + [out, None]
+    return AssemblyEqn(GateWires(*wires), coeffs)
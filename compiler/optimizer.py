@@ -0,0 +1,285 @@
+# Gate-count optimizer
+#
+# The language compiles every line to its own gate. This pass removes gates
+# whose work can be done by other gates, while accepting exactly the same
+# assignments of the remaining variables:
+# - constant folding: a variable defined as a constant is substituted into
+#   every gate that uses it
+# - merging: a variable defined by a gate is substituted into the gates
+#   that use it, if every one of them still fits in a single gate
+#   q_L a + q_R b + q_M ab + q_O c + q_C = 0. E.g. `x <== a + 5` and
+#   `y <== x * x` become `y <== a * a + 10 * a + 25`
+# - common subexpression elimination: a variable defined by the same
+#   expression as an earlier one is replaced by it
+# - dead variable removal: the gate defining a variable that no other gate
+#   uses is dropped
+#
+# A gate defines the variable of its output wire if that variable does not
+# appear in any earlier gate, nor in a product of its own gate, as in
+# witness generation. Public variables are never removed, nor are the
+# variables of the public declaration rows, and variables that no gate
+# defines (the inputs of the program) are never substituted. Custom gates
+# and range checks are kept as they are, so the variables they use are never
+# substituted either.
+from utils import *
+from .assembly import Selectors, WireIds
+from .program import Program, minimal_group_order
+from dataclasses import dataclass
+from typing import Optional
+import numpy as np
+
+# A gate as its terms: () for the constant, (x,) for a variable and (x, y)
+# for a product, mapped to coefficients modulo the field. Variables are ids
+Terms = dict[tuple[int, ...], int]
+
+
+@dataclass
+class OptimizationReport:
+    """Gates saved by each optimization"""
+
+    gates_before: int
+    gates_after: int
+    folded: int = 0
+    merged: int = 0
+    common: int = 0
+    dead: int = 0
+
+    def __str__(self) -> str:
+        return (
+            "{} gates -> {} gates (saved {}: {} constants folded, {} merged, "
+            "{} common subexpressions, {} dead)"
+        ).format(
+            self.gates_before,
+            self.gates_after,
+            self.gates_before - self.gates_after,
+            self.folded,
+            self.merged,
+            self.common,
+            self.dead,
+        )
+
+
+def _terms(L: int, R: int, O: int, D: int, QL, QR, QM, QO, QC, *others) -> Terms:
+    modulus = Scalar.field_modulus
+    terms: Terms = {}
+    if D != 0 or others[-1] != 0:
+        # Custom gates and range checks only record which variables they use
+        return {(x,): 1 for x in (L, R, O, D) if x != 0}
+
+    def add(key: tuple[int, ...], coeff: int):
+        if 0 in key or coeff % modulus == 0:
+            return
+        value = (terms.get(key, 0) + coeff) % modulus
+        if value:
+            terms[key] = value
+        else:
+            del terms[key]
+
+    add((), QC)
+    add((L,), QL)
+    add((R,), QR)
+    add((O,), QO)
+    add(tuple(sorted((L, R))), QM)
+    return terms
+
+
+def _signed(x: int) -> int:
+    modulus = Scalar.field_modulus
+    return x - modulus if x > modulus // 2 else x
+
+
+# Lays the terms out on the wires of one gate, with `out` on the output wire
+# if possible. Returns None if they do not fit in a gate
+def _lower(terms: Terms, out: int) -> Optional[tuple[int, ...]]:
+    modulus = Scalar.field_modulus
+    products = [k for k in terms if len(k) == 2]
+    linear = [k[0] for k in terms if len(k) == 1]
+    if len(products) > 1 or any(len(k) > 2 for k in terms):
+        return None
+    if products:
+        L, R = products[0]
+        others = [x for x in linear if x not in (L, R)]
+        if len(others) > 1:
+            return None
+        O = others[0] if others else 0
+    else:
+        if out in linear:
+            linear.remove(out)
+            linear.append(out)
+        if len(linear) > 3:
+            return None
+        L, R, O = ([0] * (3 - len(linear)) + linear)[-3:]
+        if L == 0:
+            L, R = R, 0
+    QL = terms.get((L,), 0) if L else 0
+    QR = terms.get((R,), 0) if R and R != L else 0
+    QM = terms.get(products[0], 0) if products else 0
+    QO = terms.get((O,), 0) if O else 0
+    QC = terms.get((), 0)
+    # Witness generation runs gates whose output coefficient is ±1
+    if QO not in (0, 1, modulus - 1):
+        scale = pow(QO, -1, modulus)
+        QL, QR, QM, QO, QC = (x * scale % modulus for x in (QL, QR, QM, QO, QC))
+    selectors = (_signed(x) for x in (QL, QR, QM, QO, QC))
+    return (L, R, O, 0, *selectors, 0, 0, 0, 0, 0)
+
+
+# Substitutes `expr` for `var` in `terms`. Returns None if the result has a
+# degree above 2
+def _substitute(terms: Terms, var: int, expr: Terms) -> Optional[Terms]:
+    modulus = Scalar.field_modulus
+    out: Terms = {}
+
+    def add(key: tuple[int, ...], coeff: int):
+        key = tuple(sorted(key))
+        out[key] = (out.get(key, 0) + coeff) % modulus
+
+    for key, coeff in terms.items():
+        factors = [x for x in key if x != var]
+        power = len(key) - len(factors)
+        if power == 0:
+            add(key, coeff)
+        elif power == 1:
+            for k, c in expr.items():
+                add(tuple(factors) + k, coeff * c)
+        else:
+            for k1, c1 in expr.items():
+                for k2, c2 in expr.items():
+                    add(k1 + k2, coeff * c1 * c2)
+    out = {k: v for k, v in out.items() if v}
+    if any(len(k) > 2 for k in out):
+        return None
+    return out
+
+
+def optimize(
+    program: Program, group_order: Optional[int] = None
+) -> tuple[Program, OptimizationReport]:
+    modulus = Scalar.field_modulus
+    public = set(program.public_ids())
+    fixed = len(public)
+    columns = [x.tolist() for x in program.wire_ids.as_list()]
+    selectors = [[int(x) for x in column] for column in program.selectors.as_list()]
+    rows: list[Optional[tuple[int, ...]]] = [
+        tuple(x) for x in zip(*columns, *selectors)
+    ]
+    terms = [_terms(*row) for row in rows]
+    # Custom gates and range checks, which are kept as they are
+    opaque = {i for i, row in enumerate(rows) if row[3] != 0 or row[-1] != 0}
+    uses: dict[int, set[int]] = {}
+    for i in range(fixed, len(rows)):
+        for key in terms[i]:
+            for x in key:
+                uses.setdefault(x, set()).add(i)
+    report = OptimizationReport(len(rows), len(rows))
+
+    # The expression defined by gate i for its output, if it defines it
+    def definition(i: int) -> Optional[Terms]:
+        x = rows[i][2]
+        coeff = terms[i].get((x,))
+        if i in opaque:
+            return None
+        if x == 0 or x in public or coeff is None or min(uses[x]) != i:
+            return None
+        if any(x in k for k in terms[i] if len(k) == 2):
+            return None
+        inverse = pow(-coeff, -1, modulus)
+        return {k: c * inverse % modulus for k, c in terms[i].items() if k != (x,)}
+
+    # Whether gate i still defines its output by `key`, as gates change when
+    # variables are inlined into them
+    def defines(i: int, key: frozenset) -> bool:
+        if rows[i] is None:
+            return False
+        expr = definition(i)
+        return expr is not None and frozenset(expr.items()) == key
+
+    def remove(i: int):
+        for key in terms[i]:
+            for x in key:
+                uses[x].discard(i)
+        rows[i] = None
+        report.gates_after -= 1
+
+    # Replaces `var` by `expr` everywhere but in gate i, and drops gate i,
+    # if every gate still fits
+    def inline(i: int, var: int, expr: Terms) -> bool:
+        updates = {}
+        if uses[var] & opaque:
+            return False
+        for j in uses[var] - {i}:
+            new = _substitute(terms[j], var, expr)
+            row = None if new is None else _lower(new, rows[j][2])
+            if row is None:
+                return False
+            updates[j] = (new, row)
+        for j, (new, row) in updates.items():
+            for key in terms[j]:
+                for x in key:
+                    uses[x].discard(j)
+            terms[j] = new
+            rows[j] = row
+            for key in new:
+                for x in key:
+                    uses.setdefault(x, set()).add(j)
+        remove(i)
+        return True
+
+    changed = True
+    while changed:
+        changed = False
+        # Gates that define a variable by each expression
+        seen: dict[frozenset, int] = {}
+        for i in range(fixed, len(rows)):
+            if rows[i] is None:
+                continue
+            if not terms[i]:
+                # A gate left with no terms holds trivially
+                remove(i)
+                changed = True
+                continue
+            expr = definition(i)
+            if expr is None:
+                continue
+            var = rows[i][2]
+            key = frozenset(expr.items())
+            if uses[var] == {i}:
+                remove(i)
+                report.dead += 1
+                changed = True
+            elif key in seen and defines(seen[key], key):
+                if inline(i, var, {(rows[seen[key]][2],): 1}):
+                    report.common += 1
+                    changed = True
+            else:
+                seen[key] = i
+
+        for i in range(fixed, len(rows)):
+            expr = None if rows[i] is None else definition(i)
+            if expr is None:
+                continue
+            if inline(i, rows[i][2], expr):
+                if all(len(k) == 0 for k in expr):
+                    report.folded += 1
+                else:
+                    report.merged += 1
+                changed = True
+
+    # Keep the variables that are still used, in order
+    kept = [row for row in rows if row is not None]
+    used = sorted({0} | {x for row in kept for x in row[:4]} | public)
+    ids = {old: new for new, old in enumerate(used)}
+    wires = np.array([[ids[x] for x in row[:4]] for row in kept], dtype=np.int64)
+    wires = wires.reshape(-1, 4).T
+    values = [np.array(x, dtype=object) for x in zip(*[row[4:] for row in kept])]
+    # By default, the smallest group order the optimized program fits in
+    if group_order is None:
+        group_order = minimal_group_order(len(kept), len(program.lookup_table()))
+    optimized = Program.from_columns(
+        group_order,
+        [program.variables[x] for x in used],
+        WireIds(*wires),
+        Selectors(*values),
+        [ids[x] for x in program.public_ids()],
+    )
+    return optimized, report
@@ -1,11 +1,50 @@
 # A simple zk language, reverse-engineered to match https://zkrepl.dev/ output
 
+import numpy as np
 from utils import *
 from .assembly import *
 from .utils import *
-from typing import Optional, Set
+from .tape import WitnessTape
+from array import array
+from typing import Iterable, Optional, Union
 from poly import Polynomial, Basis
 
+# A witness as a flat array of field elements (ints), indexed by variable id
+Witness = np.ndarray
+
+# Smallest group order a program is proved over: the prover does not handle
+# a single row
+MIN_GROUP_ORDER = 2
+
+
+# Smallest power of two group order with room for `rows` gates (public
+# inputs included, as they are declared in the first rows) and a lookup
+# table of `table_size` values
+def minimal_group_order(rows: int, table_size: int = 0) -> int:
+    group_order = MIN_GROUP_ORDER
+    while group_order < max(rows, table_size):
+        group_order *= 2
+    return group_order
+
+
+# Number of chunks of degree < n the quotient polynomial t(X) is split
+# into. The constraint polynomial has degree below 4n (z(X) times three
+# wire terms in the permutation argument), so t(X) has degree below 3n.
+# With custom gates, q_L5(X) a(X)^5 has degree below 6n, so t(X) has
+# degree below 5n. The lookup grand product has degree below 4n too
+def num_quotient_chunks(custom_gates: bool) -> int:
+    return 5 if custom_gates else 3
+
+
+# Size of the extended domain the quotient is computed over. The constraint
+# polynomial has degree below (quotient_chunks + 1) * n, so the domain is the
+# smallest power of two multiple of n with more points than that
+def extended_order(group_order: int, quotient_chunks: int) -> int:
+    extension = 1
+    while extension <= quotient_chunks:
+        extension *= 2
+    return group_order * extension
+
 
 @dataclass
 class CommonPreprocessedInput:
@@ -29,22 +68,219 @@ class CommonPreprocessedInput:
     # S_σ3(X) third permutation polynomial S_σ3(X)
     S3: Polynomial
 
+    # Custom gates, None for programs without them:
+    # q_D(X) fourth wire selector polynomial
+    QD: Optional[Polynomial] = None
+    # q_L5(X), q_R5(X), q_O5(X) selector polynomials of the fifth powers of
+    # the left, right and output wires
+    QL5: Optional[Polynomial] = None
+    QR5: Optional[Polynomial] = None
+    QO5: Optional[Polynomial] = None
+    # S_σ4(X) fourth permutation polynomial S_σ4(X)
+    S4: Optional[Polynomial] = None
+
+    # Lookups, None for programs without them:
+    # q_K(X) lookup selector polynomial, 1 on the rows whose left wire is
+    # looked up
+    QK: Optional[Polynomial] = None
+    # t(X) table polynomial: the range table, sorted, padded to the group
+    # order with its last value
+    TK: Optional[Polynomial] = None
+
+    def has_custom_gates(self) -> bool:
+        return self.QD is not None
+
+    def has_lookups(self) -> bool:
+        return self.QK is not None
+
+    # Number of chunks the quotient polynomial is split into
+    def quotient_chunks(self) -> int:
+        return num_quotient_chunks(self.has_custom_gates())
+
 
 class Program:
-    constraints: list[AssemblyEqn]
     group_order: int
+    # Number of constraints, in the first rows of the circuit
+    num_constraints: int
+    # Variable names are interned to dense ids: `variables` maps ids to
+    # names, with the empty wire (None) at id 0, and `variable_ids` maps
+    # names back. Only the API boundary deals in names
+    variables: list[Optional[str]]
+    variable_ids: dict[Optional[str], int]
+    # Gates are stored as columns: the variable ids of the wires and the
+    # selectors of every constraint. The fourth wire and the selectors of
+    # custom gates and lookups are zero for the other gates
+    wire_ids: WireIds
+    selectors: Selectors
+    # Variable ids of the public variables, declared in the first rows
+    _public_ids: list[int]
+    _constraints: Optional[list[AssemblyEqn]]
+    _permutation: Optional[np.ndarray]
+    _witness_tape: Optional[WitnessTape]
 
-    def __init__(self, constraints: list[str], group_order: int):
-        if len(constraints) > group_order:
+    # Constraints are parsed one line at a time as they are consumed, and
+    # only their gates are kept, so `constraints` may be any iterable of
+    # lines, e.g. an open file. Blank lines are skipped. Without a
+    # `group_order`, the smallest one that fits the program is used (see
+    # `minimal_group_order`)
+    def __init__(self, constraints: Iterable[str], group_order: Optional[int] = None):
+        self.variables = [None]
+        self.variable_ids = {None: 0}
+        self._public_ids = []
+        ids = [array("q") for _ in range(4)]
+        selectors: list[list[int]] = [[] for _ in range(10)]
+        table_size = 0
+        rows = 0
+        for line in constraints:
+            line = line.strip()
+            if not line:
+                continue
+            if rows == group_order:
+                raise Exception("Group order too small")
+            constraint = eq_to_assembly(line)
+            for column, var in enumerate(constraint.wires.as_list()):
+                if var not in self.variable_ids:
+                    self.variable_ids[var] = len(self.variables)
+                    self.variables.append(var)
+                ids[column].append(self.variable_ids[var])
+            if constraint.coeffs.get("$public", False) is True:
+                if len(self._public_ids) < rows:
+                    raise Exception("Public var declarations must be at the top")
+                self._public_ids.append(ids[0][-1])
+            if constraint.lookup():
+                if table_size not in (0, constraint.lookup()):
+                    raise Exception("Range checks must all use the same size")
+                if group_order is not None and constraint.lookup() > group_order:
+                    raise Exception("Range table larger than the group order")
+                table_size = constraint.lookup()
+            for column, x in zip(selectors, constraint.selectors()):
+                column.append(x)
+            rows += 1
+        self.num_constraints = rows
+        self.group_order = group_order or minimal_group_order(rows, table_size)
+        self.wire_ids = WireIds(*(np.frombuffer(x, dtype=np.int64) for x in ids))
+        self.selectors = Selectors(*(np.array(x, dtype=object) for x in selectors))
+        self._constraints = None
+        self._permutation = None
+        self._witness_tape = None
+
+    @classmethod
+    def from_str(cls, constraints: str, group_order: Optional[int] = None):
+        return cls(constraints.split("\n"), group_order)
+
+    @classmethod
+    def from_lines(cls, lines: Iterable[str], group_order: Optional[int] = None):
+        return cls(lines, group_order)
+
+    # Loads a program from a file, streaming it line by line, so the source
+    # is never held in memory
+    @classmethod
+    def from_file(cls, path: str, group_order: Optional[int] = None):
+        with open(path) as f:
+            return cls(f, group_order)
+
+    # Rebuilds a program from its columns, e.g. as loaded from a compiled
+    # circuit (see circuit_cache.py), without parsing anything. The copy
+    # permutation is taken as given if there is one
+    @classmethod
+    def from_columns(
+        cls,
+        group_order: int,
+        variables: list[Optional[str]],
+        wire_ids: WireIds,
+        selectors: Selectors,
+        public_ids: list[int],
+        permutation: Optional[np.ndarray] = None,
+    ):
+        program = cls([], group_order)
+        program.num_constraints = len(wire_ids.L)
+        program.variables = variables
+        program.variable_ids = {x: id for id, x in enumerate(variables)}
+        program.wire_ids = wire_ids
+        program.selectors = selectors
+        program._public_ids = public_ids
+        program._permutation = permutation
+        return program
+
+    # The same program over another group order, by default the smallest one
+    # that fits it, without parsing it again. The gate columns and the
+    # witness tape are shared, while the copy permutation, which depends on
+    # the group order, is rebuilt when needed
+    def with_group_order(self, group_order: Optional[int] = None) -> "Program":
+        table_size = len(self.lookup_table())
+        if group_order is None:
+            group_order = minimal_group_order(self.num_constraints, table_size)
+        if group_order < self.num_constraints:
             raise Exception("Group order too small")
-        assembly = [eq_to_assembly(constraint) for constraint in constraints]
-        self.constraints = assembly
-        self.group_order = group_order
+        if table_size > group_order:
+            raise Exception("Range table larger than the group order")
+        program = Program.from_columns(
+            group_order,
+            self.variables,
+            self.wire_ids,
+            self.selectors,
+            self.public_ids(),
+        )
+        program._witness_tape = self._witness_tape
+        return program
+
+    # Rows of the group order that hold no gate
+    def padding_rows(self) -> int:
+        return self.group_order - self.num_constraints
+
+    # Share of the rows of the group order that hold no gate. Every FFT and
+    # MSM of the prover is sized by the group order, so this is the share of
+    # the proving work spent on padding
+    def padding_ratio(self) -> float:
+        return self.padding_rows() / self.group_order
+
+    # The assembly equation of a row, rebuilt from its gate
+    def constraint(self, row: int) -> AssemblyEqn:
+        L, R, O, D = (self.variables[x[row]] for x in self.wire_ids.as_list())
+        if row < len(self._public_ids):
+            return AssemblyEqn(
+                GateWires(L, None, None), {L: -1, "$output_coeff": 0, "$public": True}
+            )
+        QL, QR, QM, QO, QC, QD, QL5, QR5, QO5, QK = (
+            int(x[row]) for x in self.selectors.as_list()
+        )
+        if QK != 0:
+            return AssemblyEqn(
+                GateWires(L, None, None), {"$output_coeff": 0, "$lookup": QK}
+            )
+        terms = [
+            ("", -QC),
+            (L, -QL),
+            (R, -QR if R != L else 0),
+            (get_product_key(L, R), -QM),
+        ]
+        if D is not None:
+            terms += [
+                (O, -QO),
+                (get_power_key(L, 5), -QL5),
+                (get_power_key(R, 5), -QR5),
+                (get_power_key(O, 5), -QO5),
+            ]
+            QO = QD
+        coeffs = {k: v for k, v in terms if v != 0}
+        if QO != 1:
+            coeffs["$output_coeff"] = QO
+        return AssemblyEqn(GateWires(L, R, O, D), coeffs)
+
+    # The assembly equations of every row. They are only built when first
+    # asked for, as the program itself only keeps the gates
+    @property
+    def constraints(self) -> list[AssemblyEqn]:
+        if self._constraints is None:
+            self._constraints = [
+                self.constraint(row) for row in range(self.num_constraints)
+            ]
+        return self._constraints
 
     def common_preprocessed_input(self) -> CommonPreprocessedInput:
-        L, R, M, O, C = self.make_gate_polynomials()
+        L, R, M, O, C, D, L5, R5, O5, K = self.make_gate_polynomials()
         S = self.make_s_polynomials()
-        return CommonPreprocessedInput(
+        pk = CommonPreprocessedInput(
             self.group_order,
             M,
             L,
@@ -55,11 +291,40 @@ class Program:
             S[Column.RIGHT],
             S[Column.OUTPUT],
         )
+        if self.has_custom_gates():
+            pk.QD, pk.QL5, pk.QR5, pk.QO5 = D, L5, R5, O5
+            pk.S4 = S[Column.FOURTH]
+        if self.has_lookups():
+            table = self.lookup_table()
+            padding = [table[-1]] * (self.group_order - len(table))
+            pk.QK = K
+            pk.TK = Polynomial([Scalar(x) for x in table + padding], Basis.LAGRANGE)
+        return pk
 
-    @classmethod
-    def from_str(cls, constraints: str, group_order: int):
-        lines = [line.strip() for line in constraints.split("\n")]
-        return cls(lines, group_order)
+    # Whether any gate is a custom gate, i.e. uses the fourth wire
+    def has_custom_gates(self) -> bool:
+        return bool(self.wire_ids.D.any())
+
+    # Whether any row is a lookup, i.e. a range check
+    def has_lookups(self) -> bool:
+        return bool(self.selectors.K.any())
+
+    # Number of chunks the quotient polynomial of a proof is split into, as
+    # in `CommonPreprocessedInput.quotient_chunks`
+    def quotient_chunks(self) -> int:
+        return num_quotient_chunks(self.has_custom_gates())
+
+    # The range table of the program's lookups: 0, 1, ..., size - 1. Every
+    # range check of a program has the same size
+    def lookup_table(self) -> list[int]:
+        return list(range(int(self.selectors.K.max(initial=0))))
+
+    # The wire columns of the circuit. Programs without custom gates leave
+    # out the fourth wire, so they are proved as before
+    def columns(self) -> list[Column]:
+        if self.has_custom_gates():
+            return Column.variants() + [Column.FOURTH]
+        return Column.variants()
 
     def coeffs(self) -> list[dict[Optional[str], int]]:
         return [constraint.coeffs for constraint in self.constraints]
@@ -67,93 +332,123 @@ class Program:
     def wires(self) -> list[GateWires]:
         return [constraint.wires for constraint in self.constraints]
 
+    # Builds the copy constraints as a permutation of the 3n cells (4n with
+    # custom gates), with
+    # cell (column, row) at index (column.value - 1) * group_order + row.
+    # The uses of each variable form a cycle in (row, column) order, and
+    # `sigma[cell]` is the cell before `cell` in its cycle.
+    #
+    # For example, if some variable is used in positions
+    # (LEFT, 4), (LEFT, 7) and (OUTPUT, 2), then
+    #
+    # sigma[(LEFT, 7)] = (LEFT, 4)
+    # sigma[(OUTPUT, 2)] = (LEFT, 7)
+    # sigma[(LEFT, 4)] = (OUTPUT, 2)
+    #
+    # The cycles are built in a single pass over the cells in that order,
+    # remembering the first and latest use of every variable id. The
+    # permutation is built once
+    def copy_permutation(self) -> np.ndarray:
+        if self._permutation is not None:
+            return self._permutation
+        n = self.group_order
+        columns = len(self.columns())
+        # Unused rows are uses of the empty wire
+        ids = np.zeros((columns, n), dtype=np.int64)
+        for column, wire in enumerate(self.wire_ids.as_list()[:columns]):
+            ids[column, : len(wire)] = wire
+        first = [-1] * len(self.variables)
+        latest = [-1] * len(self.variables)
+        sigma = [0] * (columns * n)
+        for row, row_ids in enumerate(zip(*ids.tolist())):
+            for column, id in enumerate(row_ids):
+                cell = column * n + row
+                if latest[id] < 0:
+                    first[id] = cell
+                else:
+                    sigma[cell] = latest[id]
+                latest[id] = cell
+        # Close the cycles
+        for id, cell in enumerate(first):
+            if cell >= 0:
+                sigma[cell] = latest[id]
+        self._permutation = np.array(sigma, dtype=np.int64)
+        return self._permutation
+
+    # S_σ1, S_σ2 and S_σ3 (and S_σ4) hold, at each cell, the label of the
+    # cell before it in its cycle, where cell (column, row) is labelled
+    # ω^row * column
     def make_s_polynomials(self) -> dict[Column, Polynomial]:
-        # For each variable, extract the list of (column, row) positions
-        # where that variable is used
-        variable_uses: dict[Optional[str], Set[Cell]] = {None: set()}
-        for row, constraint in enumerate(self.constraints):
-            for column, value in zip(Column.variants(), constraint.wires.as_list()):
-                if value not in variable_uses:
-                    variable_uses[value] = set()
-                variable_uses[value].add(Cell(column, row))
-
-        # Mark unused cells
-        for row in range(len(self.constraints), self.group_order):
-            for column in Column.variants():
-                variable_uses[None].add(Cell(column, row))
-
-        # For each list of positions, rotate by one.
-        #
-        # For example, if some variable is used in positions
-        # (LEFT, 4), (LEFT, 7) and (OUTPUT, 2), then we store:
-        #
-        # at S[LEFT][7] the field element representing (LEFT, 4)
-        # at S[OUTPUT][2] the field element representing (LEFT, 7)
-        # at S[LEFT][4] the field element representing (OUTPUT, 2)
-
-        S_values = {
-            Column.LEFT: [Scalar(0)] * self.group_order,
-            Column.RIGHT: [Scalar(0)] * self.group_order,
-            Column.OUTPUT: [Scalar(0)] * self.group_order,
+        n = self.group_order
+        modulus = Scalar.field_modulus
+        roots = [x.n for x in Scalar.roots_of_unity(n)]
+        columns = self.columns()
+        labels = [root * column.value % modulus for column in columns for root in roots]
+        sigma = self.copy_permutation().tolist()
+        return {
+            column: Polynomial(
+                [Scalar(labels[x]) for x in sigma[i * n : (i + 1) * n]],
+                Basis.LAGRANGE,
+            )
+            for i, column in enumerate(columns)
         }
 
-        for _, uses in variable_uses.items():
-            sorted_uses = sorted(uses)
-            for i, cell in enumerate(sorted_uses):
-                next_i = (i + 1) % len(sorted_uses)
-                next_column = sorted_uses[next_i].column
-                next_row = sorted_uses[next_i].row
-                S_values[next_column][next_row] = cell.label(self.group_order)
-
-        S = {}
-        S[Column.LEFT] = Polynomial(S_values[Column.LEFT], Basis.LAGRANGE)
-        S[Column.RIGHT] = Polynomial(S_values[Column.RIGHT], Basis.LAGRANGE)
-        S[Column.OUTPUT] = Polynomial(S_values[Column.OUTPUT], Basis.LAGRANGE)
-
-        return S
-
     # Get the list of public variable assignments, in order
     def get_public_assignments(self) -> list[Optional[str]]:
-        coeffs = self.coeffs()
-        o = []
-        no_more_allowed = False
-        for coeff in coeffs:
-            if coeff.get("$public", False) is True:
-                if no_more_allowed:
-                    raise Exception("Public var declarations must be at the top")
-                var_name = [x for x in list(coeff.keys()) if "$" not in str(x)][0]
-                if coeff != {"$public": True, "$output_coeff": 0, var_name: -1}:
-                    raise Exception("Malformatted coeffs: {}", format(coeffs))
-                o.append(var_name)
-            else:
-                no_more_allowed = True
-        return o
-
-    # Generate the gate polynomials: L, R, M, O, C,
-    # each a list of length `group_order`
-    def make_gate_polynomials(
-        self,
-    ) -> tuple[Polynomial, Polynomial, Polynomial, Polynomial, Polynomial]:
-        L = [Scalar(0) for _ in range(self.group_order)]
-        R = [Scalar(0) for _ in range(self.group_order)]
-        M = [Scalar(0) for _ in range(self.group_order)]
-        O = [Scalar(0) for _ in range(self.group_order)]
-        C = [Scalar(0) for _ in range(self.group_order)]
-        for i, constraint in enumerate(self.constraints):
-            gate = constraint.gate()
-            L[i] = gate.L
-            R[i] = gate.R
-            M[i] = gate.M
-            O[i] = gate.O
-            C[i] = gate.C
-        return (
-            Polynomial(L, Basis.LAGRANGE),
-            Polynomial(R, Basis.LAGRANGE),
-            Polynomial(M, Basis.LAGRANGE),
-            Polynomial(O, Basis.LAGRANGE),
-            Polynomial(C, Basis.LAGRANGE),
+        return [self.variables[x] for x in self._public_ids]
+
+    # Generate the gate polynomials: L, R, M, O, C, the custom gate
+    # selectors D, L5, R5, O5 and the lookup selector K, which is 1 on
+    # lookup rows, each a list of length `group_order`
+    def make_gate_polynomials(self) -> tuple[Polynomial, ...]:
+        padding = [Scalar(0)] * (self.group_order - self.num_constraints)
+        *gates, lookups = self.selectors.as_list()
+        return tuple(
+            Polynomial([Scalar(int(x)) for x in column] + padding, Basis.LAGRANGE)
+            for column in gates + [lookups != 0]
         )
 
+    # Variable ids of the public variables, in order
+    def public_ids(self) -> list[int]:
+        return list(self._public_ids)
+
+    # Converts a full assignment of named variables to a witness array.
+    # Arrays are passed through
+    def witness_values(
+        self, witness: Union[dict[Optional[str], int], Witness]
+    ) -> Witness:
+        if not isinstance(witness, dict):
+            assert len(witness) == len(self.variables)
+            return witness
+        values = np.zeros(len(self.variables), dtype=object)
+        for id, var in enumerate(self.variables[1:], 1):
+            if var not in witness:
+                raise Exception("Missing assignment for variable: {}".format(var))
+            values[id] = witness[var] % Scalar.field_modulus
+        return values
+
+    # Converts a witness array back to named variables. Other assignments
+    # given in `extra` are kept
+    def witness_dict(
+        self, values: Witness, extra: dict[Optional[str], int] = {}
+    ) -> dict[Optional[str], int]:
+        out = {k: v % Scalar.field_modulus for k, v in extra.items()}
+        out.update(zip(self.variables, values))
+        return out
+
+    # Compiles the program's witness generation into a tape, once
+    def witness_tape(self) -> WitnessTape:
+        if self._witness_tape is None:
+            self._witness_tape = WitnessTape.compile(
+                self.selectors, self.wire_ids, self.variables
+            )
+        return self._witness_tape
+
+    # Runs the program to fill in every variable of the witness array from
+    # the given assignments, see `fill_variable_assignments`
+    def fill_witness(self, starting_assignments: dict[Optional[str], int]) -> Witness:
+        return self.witness_tape().run(starting_assignments)
+
     # Attempts to "run" the program to fill in any intermediate variable
     # assignments, starting from the given assignments. Eg. if
     # `starting_assignments` contains {'a': 3, 'b': 5}, and the first line
@@ -161,32 +456,13 @@ class Program:
     def fill_variable_assignments(
         self, starting_assignments: dict[Optional[str], int]
     ) -> dict[Optional[str], int]:
-        out = {k: Scalar(v) for k, v in starting_assignments.items()}
-        out[None] = Scalar(0)
-        for constraint in self.constraints:
-            wires = constraint.wires
-            coeffs = constraint.coeffs
-            in_L = wires.L
-            in_R = wires.R
-            output = wires.O
-            out_coeff = coeffs.get("$output_coeff", 1)
-            product_key = get_product_key(in_L, in_R)
-            if output is not None and out_coeff in (-1, 1):
-                new_value = (
-                    Scalar(
-                        coeffs.get("", 0)
-                        + out[in_L] * coeffs.get(in_L, 0)
-                        + out[in_R] * coeffs.get(in_R, 0) * (1 if in_R != in_L else 0)
-                        + out[in_L] * out[in_R] * coeffs.get(product_key, 0)
-                    )
-                    * out_coeff
-                )  # should be / but equivalent for (1, -1)
-                if output in out:
-                    if out[output] != new_value:
-                        raise Exception(
-                            "Failed assertion: {} = {}".format(out[output], new_value)
-                        )
-                else:
-                    out[output] = new_value
-                    # print('filled in:', output, out[output])
-        return {k: v.n for k, v in out.items()}
+        values = self.fill_witness(starting_assignments)
+        return self.witness_dict(values, starting_assignments)
+
+    # Fills in the assignments of many witnesses at once, see
+    # `fill_variable_assignments`
+    def fill_variable_assignments_batch(
+        self, starting_assignments: list[dict[Optional[str], int]]
+    ) -> list[dict[Optional[str], int]]:
+        values = self.witness_tape().run_batch(starting_assignments)
+        return [self.witness_dict(*x) for x in zip(values, starting_assignments)]
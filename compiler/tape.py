@@ -0,0 +1,301 @@
+# Compiled witness generation
+#
+# Filling in a witness means running every constraint of the form
+# `out <== expression` in order. Instead of re-reading the gates of the
+# program on every run, the program is compiled once from its selector and
+# wire columns into a tape of instructions over the interned variable ids of
+# the program, which are the slots of the witness array:
+#
+#     vals[out] = (c + vals[l] * cl + vals[r] * cr + vals[l] * vals[r] * cm) * oc
+#
+# Custom gates assign their fourth wire, and also add their output wire as a
+# third input and the fifth powers of their inputs:
+#
+#     + vals[t] * ct + vals[l]^5 * cl5 + vals[r]^5 * cr5 + vals[t]^5 * ct5
+#
+# Range checks are not instructions: the values they look up are checked
+# once the witness is filled in.
+#
+# The instructions are also grouped into layers, where no instruction
+# depends on another one of the same layer. Batched runs evaluate a whole
+# layer for many assignments at once with numpy. Most gates only use a
+# couple of the terms, so each layer is split further by which
+# coefficients are nonzero, and only those terms are computed.
+
+import numpy as np
+from utils import *
+from .assembly import *
+from .utils import *
+from dataclasses import dataclass
+from typing import Optional
+
+
+@dataclass
+class Instruction:
+    out: int
+    left: int
+    right: int
+    const: int
+    left_coeff: int
+    right_coeff: int
+    product_coeff: int
+    out_coeff: int
+    # Checks the value of an already assigned output instead of assigning it
+    check: bool
+    # Third input and fifth powers of custom gates
+    third: int = 0
+    third_coeff: int = 0
+    left5_coeff: int = 0
+    right5_coeff: int = 0
+    third5_coeff: int = 0
+
+
+# Which terms of an instruction are nonzero: const, left, right, product,
+# third, left^5, right^5, third^5
+def _shape(x: Instruction) -> tuple[bool, ...]:
+    return tuple(
+        getattr(x, name) != 0
+        for name in (
+            "const",
+            "left_coeff",
+            "right_coeff",
+            "product_coeff",
+            "third_coeff",
+            "left5_coeff",
+            "right5_coeff",
+            "third5_coeff",
+        )
+    )
+
+
+@dataclass
+class TapeLayer:
+    """Instructions of the same shape in a layer as columns, shaped to
+    broadcast over a batch"""
+
+    # Which terms are computed, see `_shape`
+    shape: tuple[bool, ...]
+    out: np.ndarray
+    left: np.ndarray
+    right: np.ndarray
+    const: np.ndarray
+    left_coeff: np.ndarray
+    right_coeff: np.ndarray
+    product_coeff: np.ndarray
+    out_coeff: np.ndarray
+    check: np.ndarray
+    third: np.ndarray
+    third_coeff: np.ndarray
+    left5_coeff: np.ndarray
+    right5_coeff: np.ndarray
+    third5_coeff: np.ndarray
+
+    @classmethod
+    def from_instructions(cls, instructions: list[Instruction]):
+        def column(name: str, dtype) -> np.ndarray:
+            return np.array([getattr(x, name) for x in instructions], dtype=dtype)
+
+        def coeff(name: str) -> np.ndarray:
+            return column(name, object).reshape(-1, 1)
+
+        return cls(
+            _shape(instructions[0]),
+            column("out", np.int64),
+            column("left", np.int64),
+            column("right", np.int64),
+            coeff("const"),
+            coeff("left_coeff"),
+            coeff("right_coeff"),
+            coeff("product_coeff"),
+            coeff("out_coeff"),
+            column("check", bool),
+            column("third", np.int64),
+            coeff("third_coeff"),
+            coeff("left5_coeff"),
+            coeff("right5_coeff"),
+            coeff("third5_coeff"),
+        )
+
+
+@dataclass
+class WitnessTape:
+    # Name of each variable id, which is also its slot. Slot 0 is the empty
+    # wire (None), which is always 0
+    variables: list[Optional[str]]
+    # Variable ids that are read before any constraint assigns them, or
+    # that no constraint assigns, which every run must be given
+    inputs: list[int]
+    # Instructions in program order, for single runs
+    instructions: list[Instruction]
+    # The same instructions in dependency layers split by shape, for batched
+    # runs
+    layers: list[TapeLayer]
+    # Range checks, as (variable id, size) pairs
+    lookups: list[tuple[int, int]]
+
+    @classmethod
+    def compile(
+        cls,
+        selectors: Selectors,
+        wire_ids: WireIds,
+        variables: list[Optional[str]],
+    ):
+        modulus = Scalar.field_modulus
+        inputs = []
+        instructions = []
+        # Layer of the instruction assigning each slot, -1 for inputs, None
+        # for slots that are not known yet
+        depth: list[Optional[int]] = [-1] + [None] * (len(variables) - 1)
+        layers: list[list[Instruction]] = []
+        lookups = []
+
+        columns = [x.tolist() for x in wire_ids.as_list() + selectors.as_list()]
+        for L, R, O, D, QL, QR, QM, QO, QC, QD, QL5, QR5, QO5, QK in zip(*columns):
+            if QK != 0:
+                lookups.append((L, QK))
+                continue
+            # Custom gates define their fourth wire, and read their output
+            # wire as a third input
+            T, QT = 0, 0
+            if D != 0:
+                O, T, QO, QT = D, O, QD, QO
+            # Only gates that define their output, up to sign, are run
+            if O == 0 or QO not in (-1, 1):
+                continue
+            for id in (L, R, T):
+                if depth[id] is None:
+                    depth[id] = -1
+                    inputs.append(id)
+            check = depth[O] is not None
+            instruction = Instruction(
+                O,
+                L,
+                R,
+                -QC % modulus,
+                -QL % modulus,
+                -QR % modulus,
+                -QM % modulus,
+                QO % modulus,
+                check,
+                T,
+                -QT % modulus,
+                -QL5 % modulus,
+                -QR5 % modulus,
+                -QO5 % modulus,
+            )
+            sources = [L, R, T, O] if check else [L, R, T]
+            layer = max(depth[x] for x in sources) + 1
+            if not check:
+                depth[O] = layer
+            if layer == len(layers):
+                layers.append([])
+            layers[layer].append(instruction)
+            instructions.append(instruction)
+
+        inputs += [id for id, x in enumerate(depth) if x is None]
+
+        shaped = []
+        for layer in layers:
+            shapes: dict[tuple, list[Instruction]] = {}
+            for x in layer:
+                shapes.setdefault(_shape(x), []).append(x)
+            shaped += [TapeLayer.from_instructions(x) for x in shapes.values()]
+
+        return cls(variables, inputs, instructions, shaped, lookups)
+
+    def _load(self, assignments: dict[Optional[str], int]) -> list[int]:
+        vals = [0] * len(self.variables)
+        for id in self.inputs:
+            var = self.variables[id]
+            if var not in assignments:
+                raise Exception("Missing assignment for input: {}".format(var))
+            vals[id] = assignments[var] % Scalar.field_modulus
+        return vals
+
+    # Assignments given for variables that the tape assigns are checked
+    # against the computed values, and range checks against their sizes
+    def _check(self, assignments: dict[Optional[str], int], vals: list[int]):
+        for id, var in enumerate(self.variables[1:], 1):
+            if var in assignments:
+                value = assignments[var] % Scalar.field_modulus
+                if value != vals[id]:
+                    raise Exception("Failed assertion: {} = {}".format(value, vals[id]))
+        for id, size in self.lookups:
+            if vals[id] >= size:
+                raise Exception(
+                    "Failed range check: {} < {}".format(self.variables[id], size)
+                )
+
+    # Fills in the witness array of the given assignments
+    def run(self, assignments: dict[Optional[str], int]) -> np.ndarray:
+        modulus = Scalar.field_modulus
+        vals = self._load(assignments)
+        for x in self.instructions:
+            l, r = vals[x.left], vals[x.right]
+            value = (
+                x.const + l * x.left_coeff + r * x.right_coeff + l * r * x.product_coeff
+            )
+            if x.third != 0 or x.left5_coeff != 0 or x.right5_coeff != 0:
+                t = vals[x.third]
+                value += (
+                    t * x.third_coeff
+                    + pow(l, 5, modulus) * x.left5_coeff
+                    + pow(r, 5, modulus) * x.right5_coeff
+                    + pow(t, 5, modulus) * x.third5_coeff
+                )
+            value = value * x.out_coeff % modulus
+            if x.check:
+                if vals[x.out] != value:
+                    raise Exception(
+                        "Failed assertion: {} = {}".format(vals[x.out], value)
+                    )
+            else:
+                vals[x.out] = value
+        self._check(assignments, vals)
+        return np.array(vals, dtype=object)
+
+    # Runs the tape for many assignments at once: every slot holds a row of
+    # values, one per assignment, and each layer is evaluated in one go
+    def run_batch(
+        self, assignments: list[dict[Optional[str], int]]
+    ) -> list[np.ndarray]:
+        modulus = Scalar.field_modulus
+        if len(assignments) == 0:
+            return []
+        vals = np.array([self._load(x) for x in assignments], dtype=object).T
+        for layer in self.layers:
+            has_const, has_left, has_right, has_product, *custom = layer.shape
+            has_third, has_left5, has_right5, has_third5 = custom
+            l, r = vals[layer.left], vals[layer.right]
+            values = layer.const if has_const else 0
+            if has_left:
+                values = values + l * layer.left_coeff
+            if has_right:
+                values = values + r * layer.right_coeff
+            if has_product:
+                values = values + l * r * layer.product_coeff
+            if has_third:
+                values = values + vals[layer.third] * layer.third_coeff
+            if has_left5:
+                values = values + l**5 % modulus * layer.left5_coeff
+            if has_right5:
+                values = values + r**5 % modulus * layer.right5_coeff
+            if has_third5:
+                values = values + vals[layer.third] ** 5 % modulus * layer.third5_coeff
+            # Constant gates give a single column for the whole batch
+            values = np.broadcast_to(
+                values * layer.out_coeff % modulus, (len(layer.out), len(assignments))
+            )
+            checks = vals[layer.out[layer.check]]
+            failed = np.argwhere(checks != values[layer.check])
+            if len(failed) > 0:
+                i, j = failed[0]
+                raise Exception(
+                    "Failed assertion: {} = {}".format(
+                        checks[i, j], values[layer.check][i, j]
+                    )
+                )
+            vals[layer.out[~layer.check]] = values[~layer.check]
+        for j, x in enumerate(assignments):
+            self._check(x, vals[:, j])
+        return list(vals.T)
@@ -7,6 +7,8 @@ class Column(Enum):
     LEFT = 1
     RIGHT = 2
     OUTPUT = 3
+    # Fourth wire of custom gates, which holds their output
+    FOURTH = 4
 
     def __lt__(self, other):
         if self.__class__ is other.__class__:
@@ -41,20 +43,26 @@ class Cell:
         return "(" + str(self.row) + ", " + str(self.column.value) + ")"
 
     # Outputs the label (an inner-field element) representing a given
-    # (column, row) pair. Expects section = 1 for left, 2 right, 3 output
+    # (column, row) pair. Expects section = 1 for left, 2 right, 3 output,
+    # 4 fourth
     def label(self, group_order: int) -> Scalar:
         assert self.row < group_order
-        return Scalar.roots_of_unity(group_order)[self.row] * self.column.value
+        return Scalar.root_of_unity(group_order) ** self.row * self.column.value
 
 
 # Gets the key to use in the coeffs dictionary for the term for key1*key2,
 # where key1 and key2 can be constant(''), a variable, or product keys
-# Note that degrees higher than 2 are disallowed in the compiler, but we
-# still allow them in the parser in case we find a way to compile them later
+# Note that degrees higher than 2 are disallowed in the compiler, except for
+# the fifth powers of custom gates, but the parser allows any degree
 def get_product_key(key1, key2):
     members = sorted((key1 or "").split("*") + (key2 or "").split("*"))
     return "*".join([x for x in members if x])
 
 
+# Gets the key of the term for key to the given power
+def get_power_key(key: str, exponent: int) -> str:
+    return get_product_key(key, "*".join([key] * (exponent - 1)))
+
+
 def is_valid_variable_name(name: str) -> bool:
     return len(name) > 0 and name.isalnum() and name[0] not in "0123456789"
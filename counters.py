@@ -0,0 +1,199 @@
+# Operation counters
+#
+# Counts the primitive operations done while counting is enabled: `Scalar`
+# multiplications, inversions and exponentiations, elliptic curve
+# additions, doublings and multiplications, pairings, and the sizes of MSMs
+# and FFTs. Counting is opt-in: the primitives are only wrapped while an
+# `OpCounter` is active, so the default path is left untouched.
+#
+#     with OpCounter() as counter:
+#         vk.verify_proof(group_order, proof, public)
+#     print(counter.counts, counter.spans["pairing"])
+#
+# Counts are also aggregated per instrumentation span (see
+# instrumentation.py), e.g. per prover round. Only the calling process is
+# counted, not the workers of a `PoolScheduler`.
+import py_ecc.bn128 as b
+import py_ecc.bn128.bn128_curve as bn128_curve
+import py_ecc.bn128.bn128_pairing as bn128_pairing
+from curve import Scalar, Field
+from dataclasses import dataclass, field, fields
+from instrumentation import Observer, Event, add_observer, remove_observer
+from typing import Optional
+
+
+@dataclass
+class OpCounts:
+    """Numbers of primitive operations"""
+
+    # Scalar field operations. The multiplications an exponentiation or
+    # an inversion is made of are counted as multiplications too
+    field_mul: int = 0
+    field_inv: int = 0
+    field_exp: int = 0
+    # G1 and G2 operations; a multiplication counts the additions and
+    # doublings it is made of
+    ec_add: int = 0
+    ec_double: int = 0
+    ec_mul: int = 0
+    pairing: int = 0
+    # Sizes of each MSM and FFT, in order
+    msm_sizes: list[int] = field(default_factory=list)
+    fft_sizes: list[int] = field(default_factory=list)
+
+    def copy(self) -> "OpCounts":
+        return OpCounts(
+            *[
+                list(getattr(self, x.name))
+                if x.name.endswith("_sizes")
+                else getattr(self, x.name)
+                for x in fields(self)
+            ]
+        )
+
+    # Operations done since `start`, a copy of these counts taken earlier
+    def since(self, start: "OpCounts") -> "OpCounts":
+        return OpCounts(
+            *[
+                getattr(self, x.name)[len(getattr(start, x.name)) :]
+                if x.name.endswith("_sizes")
+                else getattr(self, x.name) - getattr(start, x.name)
+                for x in fields(self)
+            ]
+        )
+
+    def add(self, other: "OpCounts"):
+        for x in fields(self):
+            setattr(self, x.name, getattr(self, x.name) + getattr(other, x.name))
+
+    def __str__(self) -> str:
+        return (
+            "{} mul, {} inv, {} exp, {} ec add, {} ec double, {} ec mul, "
+            "{} pairings, {} MSMs ({} points), {} FFTs ({} points)"
+        ).format(
+            self.field_mul,
+            self.field_inv,
+            self.field_exp,
+            self.ec_add,
+            self.ec_double,
+            self.ec_mul,
+            self.pairing,
+            len(self.msm_sizes),
+            sum(self.msm_sizes),
+            len(self.fft_sizes),
+            sum(self.fft_sizes),
+        )
+
+
+# Counts of the active counter, None while not counting
+_counts: Optional[OpCounts] = None
+# Depth of nested exponentiations and EC multiplications, which are
+# recursive but count as one operation
+_depth = {"field_exp": 0, "ec_mul": 0}
+
+
+def _mul(self, other):
+    _counts.field_mul += 1
+    return Field.__mul__(self, other)
+
+
+def _div(self, other):
+    _counts.field_inv += 1
+    _counts.field_mul += 1
+    return Field.__div__(self, other)
+
+
+def _rdiv(self, other):
+    _counts.field_inv += 1
+    _counts.field_mul += 1
+    return Field.__rdiv__(self, other)
+
+
+def _recursive(name: str, f):
+    def counted(*args):
+        if _depth[name] == 0:
+            setattr(_counts, name, getattr(_counts, name) + 1)
+        _depth[name] += 1
+        try:
+            return f(*args)
+        finally:
+            _depth[name] -= 1
+
+    return counted
+
+
+def _counted(name: str, f):
+    def counted(*args):
+        setattr(_counts, name, getattr(_counts, name) + 1)
+        return f(*args)
+
+    return counted
+
+
+# The wrapped primitives: (module or class, attribute, original, wrapper).
+# The curve functions call each other through the globals of their module,
+# so they are replaced there as well as in py_ecc.bn128
+_PATCHES = [
+    (Scalar, "__mul__", None, _mul),
+    (Scalar, "__div__", None, _div),
+    (Scalar, "__rdiv__", None, _rdiv),
+    (Scalar, "__pow__", None, _recursive("field_exp", Field.__pow__)),
+    *[
+        (module, name, getattr(module, name), wrapper)
+        for module in (b, bn128_curve)
+        for name, wrapper in (
+            ("add", _counted("ec_add", bn128_curve.add)),
+            ("double", _counted("ec_double", bn128_curve.double)),
+            ("multiply", _recursive("ec_mul", bn128_curve.multiply)),
+        )
+    ],
+    (b, "pairing", b.pairing, _counted("pairing", bn128_pairing.pairing)),
+]
+
+
+class OpCounter(Observer):
+    """Counts operations for the duration of a with block. `counts` holds
+    the totals, and `spans` the operations done within the spans of each
+    name, summed over every span of that name"""
+
+    def __init__(self):
+        self.counts = OpCounts()
+        self.spans: dict[str, OpCounts] = {}
+        self._starts: list[OpCounts] = []
+
+    def __enter__(self) -> "OpCounter":
+        global _counts
+        if _counts is not None:
+            raise Exception("Operations are already being counted")
+        _counts = self.counts
+        for target, name, original, wrapper in _PATCHES:
+            setattr(target, name, wrapper)
+        add_observer(self)
+        return self
+
+    def __exit__(self, *exc):
+        global _counts
+        remove_observer(self)
+        for target, name, original, wrapper in _PATCHES:
+            if original is None:
+                delattr(target, name)
+            else:
+                setattr(target, name, original)
+        _counts = None
+
+    def on_start(self, name: str, category: str):
+        self._starts.append(self.counts.copy())
+
+    def on_event(self, event: Event):
+        if event.duration is None:
+            return
+        if "size" in event.args:
+            if event.category == "msm":
+                self.counts.msm_sizes.append(event.args["size"])
+            elif event.category == "fft":
+                self.counts.fft_sizes.append(event.args["size"])
+        # Spans entered before counting started are not attributed
+        if not self._starts:
+            return
+        ops = self.counts.since(self._starts.pop())
+        self.spans.setdefault(event.name, OpCounts()).add(ops)
@@ -0,0 +1,238 @@
+# Incremental recompilation
+#
+# Editing a few lines of a large circuit used to mean preprocessing it again
+# from scratch: every selector and permutation polynomial, and a full MSM
+# for every commitment of the verification key. But the rows of a circuit
+# are independent, and a commitment is linear in the evaluations of its
+# polynomial: with the Lagrange-basis SRS (see `Setup.lagrange_basis`),
+#
+#   [p'(x)]₁ = [p(x)]₁ + Σ (p'(ω^i) - p(ω^i)) [L_i(x)]₁
+#
+# summed over the rows i where p' differs from p. So an edited program is
+# diffed against the compiled one row by row, only the evaluations of the
+# changed rows are recomputed, and each commitment is updated by an MSM the
+# size of the edit.
+#
+# Rows are compared by position, with variables compared by name, as the
+# two programs intern their variables independently. Edits that change the
+# shape of the circuit (its group order, whether it has custom gates or
+# lookups) are compiled from scratch.
+import numpy as np
+from circuit_cache import CompiledCircuit
+from compiler.program import Program, CommonPreprocessedInput
+from curve import Scalar, ec_lincomb
+from dataclasses import replace
+from instrumentation import span
+from poly import Polynomial, Basis
+from proving_key import CUSTOM, LOOKUP
+from setup import Setup
+from typing import Optional
+from verifier import VerificationKey
+
+# Names of the preprocessed polynomials, in selector column order (L, R, M,
+# O, C, D, L5, R5, O5, K), and of their commitments in the verification key
+SELECTORS = ["QL", "QR", "QM", "QO", "QC", "QD", "QL5", "QR5", "QO5", "QK"]
+PERMUTATION = ["S1", "S2", "S3", "S4"]
+COMMITMENTS = {
+    "QM": "Qm",
+    "QL": "Ql",
+    "QR": "Qr",
+    "QO": "Qo",
+    "QC": "Qc",
+    "S1": "S1",
+    "S2": "S2",
+    "S3": "S3",
+    **CUSTOM,
+    **LOOKUP,
+}
+
+# New evaluations of the preprocessed polynomials: for each polynomial that
+# changed, its changed rows and their new values
+Changes = dict[str, dict[int, Scalar]]
+
+
+# Whether `new` can be preprocessed incrementally from `old`
+def _same_shape(old: Program, new: Program) -> bool:
+    return (
+        old.group_order == new.group_order
+        and old.columns() == new.columns()
+        and old.has_lookups() == new.has_lookups()
+    )
+
+
+# Variable ids of every cell, as a (columns, group order) array, with the
+# unused rows holding the empty wire
+def _cell_ids(program: Program) -> np.ndarray:
+    columns = len(program.columns())
+    ids = np.zeros((columns, program.group_order), dtype=np.int64)
+    for column, wire in enumerate(program.wire_ids.as_list()[:columns]):
+        ids[column, : len(wire)] = wire
+    return ids
+
+
+# Selector columns padded with zeros up to the group order. The lookup
+# column holds the table size, and its polynomial q_K(X) is 0 or 1
+def _selector_columns(program: Program) -> list[np.ndarray]:
+    columns = []
+    for column in program.selectors.as_list():
+        padded = np.zeros(program.group_order, dtype=object)
+        padded[: len(column)] = column
+        columns.append(padded)
+    columns[-1] = (columns[-1] != 0).astype(object)
+    return columns
+
+
+def _selector_changes(old: Program, new: Program) -> Changes:
+    changes = {}
+    names = SELECTORS[:5]
+    if new.has_custom_gates():
+        names += SELECTORS[5:9]
+    if new.has_lookups():
+        names += SELECTORS[9:]
+    old_columns, new_columns = _selector_columns(old), _selector_columns(new)
+    for name in names:
+        i = SELECTORS.index(name)
+        rows = np.flatnonzero(old_columns[i] != new_columns[i])
+        if len(rows):
+            changes[name] = {int(row): Scalar(int(new_columns[i][row])) for row in rows}
+    if new.has_lookups() and old.lookup_table() != new.lookup_table():
+        tables = []
+        for program in (old, new):
+            table = program.lookup_table()
+            tables.append(table + [table[-1]] * (program.group_order - len(table)))
+        changes["TK"] = {
+            row: Scalar(y) for row, (x, y) in enumerate(zip(*tables)) if x != y
+        }
+    return changes
+
+
+# Updates the copy permutation of `old` (see `Program.copy_permutation`) to
+# that of `new` by moving only the cells whose variable changed from their
+# old cycle to their new one, and returns it.
+#
+# The cells are first taken out of their old cycles, then inserted into
+# their new ones in (row, column) order, each right after the closest
+# earlier use of its variable, or after its last use if it is the first.
+# `inverse` maps each cell to the cell after it, to unlink cells in O(1)
+def _update_permutation(old: Program, new: Program) -> np.ndarray:
+    n = new.group_order
+    columns = len(new.columns())
+    old_ids, new_ids = _cell_ids(old), _cell_ids(new)
+    old_names = np.array(old.variables, dtype=object)[old_ids].ravel()
+    new_names = np.array(new.variables, dtype=object)[new_ids].ravel()
+    changed = np.flatnonzero(old_names != new_names).tolist()
+
+    sigma = old.copy_permutation().copy()
+    inverse = np.empty_like(sigma)
+    inverse[sigma] = np.arange(len(sigma))
+    for cell in changed:
+        prev, after = sigma[cell], inverse[cell]
+        sigma[after], inverse[prev] = prev, after
+        sigma[cell] = inverse[cell] = cell
+
+    # Cells are ordered by row, then column: the order of the row-major ids
+    def order(cell: int) -> int:
+        return cell % n * columns + cell // n
+
+    def cell_at(position: int) -> int:
+        return position % columns * n + position // columns
+
+    row_major = new_ids.T.ravel()
+    uses: dict[int, np.ndarray] = {}
+    pending = set(changed)
+    for cell in sorted(changed, key=order):
+        pending.remove(cell)
+        id = int(new_ids.ravel()[cell])
+        if id not in uses:
+            uses[id] = np.flatnonzero(row_major == id)
+        positions = uses[id]
+        i = int(np.searchsorted(positions, order(cell)))
+        if i > 0:
+            prev = cell_at(int(positions[i - 1]))
+        else:
+            # The first use follows the last use already in the cycle
+            later = [cell_at(int(x)) for x in positions[i + 1 :][::-1]]
+            prev = next((x for x in later if x not in pending), cell)
+        if prev != cell:
+            after = inverse[prev]
+            sigma[cell], inverse[prev] = prev, cell
+            sigma[after], inverse[cell] = cell, after
+    return sigma
+
+
+def _permutation_changes(old: Program, new: Program, sigma: np.ndarray) -> Changes:
+    n = new.group_order
+    columns = new.columns()
+    roots = Scalar.roots_of_unity(n)
+    changes = {}
+    for cell in np.flatnonzero(sigma != old.copy_permutation()).tolist():
+        source = int(sigma[cell])
+        column = columns[source // n]
+        name = PERMUTATION[cell // n]
+        changes.setdefault(name, {})[cell % n] = roots[source % n] * column.value
+    return changes
+
+
+# The evaluations of the preprocessed polynomials that differ between the
+# programs, or None if `new` has to be compiled from scratch. The copy
+# permutation of `new` is updated from that of `old` rather than rebuilt
+def diff_programs(old: Program, new: Program) -> Optional[Changes]:
+    if not _same_shape(old, new):
+        return None
+    sigma = _update_permutation(old, new)
+    changes = _selector_changes(old, new)
+    changes.update(_permutation_changes(old, new, sigma))
+    new._permutation = sigma
+    return changes
+
+
+def update_preprocessed_input(
+    pk: CommonPreprocessedInput, changes: Changes
+) -> CommonPreprocessedInput:
+    updated = {}
+    for name, rows in changes.items():
+        values = list(getattr(pk, name).values)
+        for row, x in rows.items():
+            values[row] = x
+        updated[name] = Polynomial(values, Basis.LAGRANGE)
+    return replace(pk, **updated)
+
+
+# Adds Σ (new - old) [L_i(x)]₁ over the changed rows to each commitment
+def update_verification_key(
+    setup: Setup,
+    vk: VerificationKey,
+    pk: CommonPreprocessedInput,
+    changes: Changes,
+) -> VerificationKey:
+    basis = setup.lagrange_basis(vk.group_order) if changes else []
+    updated = {}
+    for name, rows in changes.items():
+        old = getattr(pk, name).values
+        pairs = [(basis[row], x - old[row]) for row, x in rows.items()]
+        with span("msm", "msm", size=len(pairs)):
+            updated[COMMITMENTS[name]] = ec_lincomb(
+                [(getattr(vk, COMMITMENTS[name]), 1)] + pairs
+            )
+    return replace(vk, **updated)
+
+
+# Compiles `program`, an edit of the program of `circuit`, reusing the
+# rows of `circuit` that did not change
+def recompile(
+    setup: Setup, circuit: CompiledCircuit, program: Program
+) -> CompiledCircuit:
+    with span("recompile", "setup", group_order=program.group_order):
+        changes = diff_programs(circuit.program, program)
+        if changes is None:
+            preprocessed = program.common_preprocessed_input()
+            return CompiledCircuit(
+                program, preprocessed, setup.verification_key(preprocessed)
+            )
+        return CompiledCircuit(
+            program,
+            update_preprocessed_input(circuit.preprocessed, changes),
+            update_verification_key(
+                setup, circuit.verification_key, circuit.preprocessed, changes
+            ),
+        )
@@ -0,0 +1,220 @@
+# Instrumentation of the prover, verifier and setup
+#
+# Code reports what it does through `span`, a context manager that times a
+# step, and `log`, which reports a progress message. Both are delivered to
+# the registered observers as `Event`s. With no observer registered, `span`
+# returns a shared no-op context manager and `log` returns immediately, so
+# instrumentation costs nothing measurable when disabled.
+#
+# Categories of spans:
+# - "prove", "verify", "setup": whole operations
+# - "round": prover rounds
+# - "fft", "msm", "division", "transcript", "pairing": sub-steps
+import json
+import os
+import sys
+import threading
+import time
+from dataclasses import dataclass, field, asdict
+from typing import Optional, TextIO
+
+
+@dataclass
+class Event:
+    name: str
+    category: str
+    # Start time, in seconds from an arbitrary origin (time.perf_counter)
+    start: float
+    # Duration in seconds, None for log messages
+    duration: Optional[float] = None
+    # Details of the step, e.g. the size of an FFT
+    args: dict = field(default_factory=dict)
+    pid: int = 0
+    tid: int = 0
+
+
+class Observer:
+    """Receives the events of the instrumented code"""
+
+    # Called when a span is entered; its event follows when it is exited
+    def on_start(self, name: str, category: str):
+        pass
+
+    def on_event(self, event: Event):
+        pass
+
+
+_observers: list[Observer] = []
+
+
+def add_observer(observer: Observer):
+    _observers.append(observer)
+
+
+def remove_observer(observer: Observer):
+    _observers.remove(observer)
+
+
+# Forked worker processes inherit the observers of their parent, but their
+# events would only reach copies of them, so workers drop them
+def clear_observers():
+    _observers.clear()
+
+
+def enabled() -> bool:
+    return len(_observers) > 0
+
+
+def _emit(event: Event):
+    for observer in _observers:
+        observer.on_event(event)
+
+
+class _Span:
+    def __init__(self, name: str, category: str, args: dict):
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        for observer in _observers:
+            observer.on_start(self.name, self.category)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        _emit(
+            Event(
+                self.name,
+                self.category,
+                self.start,
+                end - self.start,
+                self.args,
+                os.getpid(),
+                threading.get_ident(),
+            )
+        )
+
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+# Times the enclosed block:
+#
+#     with span("ifft", "fft", size=n):
+#         ...
+def span(name: str, category: str, **args):
+    if not _observers:
+        return _NO_SPAN
+    return _Span(name, category, args)
+
+
+# Reports a progress message
+def log(message: str, **args):
+    if not _observers:
+        return
+    _emit(
+        Event(
+            message,
+            "log",
+            time.perf_counter(),
+            None,
+            args,
+            os.getpid(),
+            threading.get_ident(),
+        )
+    )
+
+
+class observing:
+    """Registers an observer for the duration of a with block"""
+
+    def __init__(self, observer: Observer):
+        self.observer = observer
+
+    def __enter__(self) -> Observer:
+        add_observer(self.observer)
+        return self.observer
+
+    def __exit__(self, *exc):
+        remove_observer(self.observer)
+
+
+class PrintObserver(Observer):
+    """Prints progress messages, and the durations of spans of the given
+    categories"""
+
+    def __init__(
+        self, categories: tuple[str, ...] = (), out: Optional[TextIO] = None
+    ):
+        self.categories = categories
+        self.out = out
+
+    def on_event(self, event: Event):
+        out = self.out or sys.stdout
+        if event.duration is None:
+            print(event.name, file=out)
+        elif event.category in self.categories:
+            print(
+                "{} ({}): {:.3f}s".format(event.name, event.category, event.duration),
+                file=out,
+            )
+
+
+class Recorder(Observer):
+    """Records every event, for export as JSON or as a Chrome trace"""
+
+    def __init__(self):
+        self.events: list[Event] = []
+
+    def on_event(self, event: Event):
+        self.events.append(event)
+
+    # Total duration of the spans of each name
+    def totals(self) -> dict[str, float]:
+        totals = {}
+        for x in self.events:
+            if x.duration is not None:
+                totals[x.name] = totals.get(x.name, 0) + x.duration
+        return totals
+
+    def to_json(self) -> list[dict]:
+        return [asdict(x) for x in self.events]
+
+    # Trace Event Format, as loaded by chrome://tracing and Perfetto:
+    # spans are complete ("X") events and logs instant ("i") events, with
+    # timestamps in microseconds
+    def to_chrome_trace(self) -> dict:
+        events = []
+        for x in self.events:
+            event = {
+                "name": x.name,
+                "cat": x.category,
+                "ts": x.start * 1e6,
+                "pid": x.pid,
+                "tid": x.tid,
+                "args": x.args,
+            }
+            if x.duration is None:
+                event.update(ph="i", s="t")
+            else:
+                event.update(ph="X", dur=x.duration * 1e6)
+            events.append(event)
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def save_json(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.to_json(), f, default=str)
+
+    def save_chrome_trace(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.to_chrome_trace(), f, default=str)
@@ -0,0 +1,104 @@
+# Memory management for the prover
+#
+# A polynomial of n field elements takes about 150 bytes per element as a
+# list of Scalar objects, but only 32 bytes as raw words. Vectors that are
+# only needed a few rounds later can be spilled to a temporary file and
+# memory-mapped back when they are needed, and the peak memory of every
+# round can be measured to size prover workers.
+import numpy as np
+import resource
+import tempfile
+from curve import Scalar
+from dataclasses import dataclass
+from poly import Polynomial, Basis
+from typing import Optional
+
+WORD_SIZE = 32
+
+
+class SpilledPolynomial:
+    """A polynomial whose values live in a temporary memory-mapped file"""
+
+    def __init__(self, poly: Polynomial, dir: Optional[str] = None):
+        self.basis = poly.basis
+        self.length = len(poly.values)
+        # The file is unlinked as soon as it is created, and its space is
+        # freed once the mapping is dropped
+        self.file = tempfile.TemporaryFile(dir=dir)
+        size = max(self.length, 1) * WORD_SIZE
+        self.words = np.memmap(self.file, dtype=np.uint8, mode="w+", shape=(size,))
+        self.words[: self.length * WORD_SIZE] = np.frombuffer(
+            b"".join(x.n.to_bytes(WORD_SIZE, "big") for x in poly.values),
+            dtype=np.uint8,
+        )
+        self.words.flush()
+
+    def load(self) -> Polynomial:
+        data = self.words.tobytes()
+        return Polynomial(
+            [
+                Scalar(int.from_bytes(data[i : i + WORD_SIZE], "big"))
+                for i in range(0, self.length * WORD_SIZE, WORD_SIZE)
+            ],
+            self.basis,
+        )
+
+    def close(self):
+        del self.words
+        self.file.close()
+
+
+@dataclass
+class RoundMemory:
+    """Memory used by a prover round"""
+
+    name: str
+    # Peak resident set size of the process during the round
+    peak_bytes: int
+    # Resident set size at the end of the round, after releasing what later
+    # rounds do not need
+    retained_bytes: int
+
+    def __str__(self) -> str:
+        return "{}: peak {:.1f} MiB, retained {:.1f} MiB".format(
+            self.name, self.peak_bytes / 2**20, self.retained_bytes / 2**20
+        )
+
+
+# Current and peak resident set size in bytes, from /proc/self/status
+def _rss() -> tuple[int, int]:
+    sizes = {}
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(("VmRSS:", "VmHWM:")):
+                name, size, _ = line.split()
+                sizes[name] = int(size) * 1024
+    return sizes["VmRSS:"], sizes["VmHWM:"]
+
+
+class MemoryTracker:
+    """Measures the peak resident set size of each round. Linux resets the
+    peak when "5" is written to /proc/self/clear_refs, so each round gets
+    its own peak; where it cannot be reset, peaks are since process start"""
+
+    def __init__(self):
+        self.rounds: list[RoundMemory] = []
+        self.reset_peak()
+
+    def reset_peak(self):
+        try:
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+        except OSError:
+            pass
+
+    def end_round(self, name: str):
+        try:
+            current, peak = _rss()
+        except OSError:
+            # Without /proc, only the peak of the whole process is known.
+            # ru_maxrss is in kilobytes on Linux
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+            current = peak
+        self.rounds.append(RoundMemory(name, peak, current))
+        self.reset_peak()
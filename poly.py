@@ -1,4 +1,5 @@
 from curve import Scalar
+from instrumentation import span
 from enum import Enum
 from numpy.polynomial import polynomial as P
 import numpy as np
@@ -199,27 +200,56 @@ class Polynomial:
                 o[i + len(L)] = (x - y_times_root) % modulus
             return o
 
-        roots = [x.n for x in Scalar.roots_of_unity(len(self.values))]
-        o, nvals = Scalar.field_modulus, [x.n for x in self.values]
-        if inv:
-            assert self.basis == Basis.LAGRANGE
-            # Inverse FFT
-            invlen = Scalar(1) / len(self.values)
-            reversed_roots = [roots[0]] + roots[1:][::-1]
-            return Polynomial(
-                [Scalar(x) * invlen for x in _fft(nvals, o, reversed_roots)],
-                Basis.MONOMIAL,
-            )
-        else:
-            assert self.basis == Basis.MONOMIAL
-            # Regular FFT
-            return Polynomial(
-                [Scalar(x) for x in _fft(nvals, o, roots)], Basis.LAGRANGE
-            )
+        with span("ifft" if inv else "fft", "fft", size=len(self.values)):
+            roots = [x.n for x in Scalar.roots_of_unity(len(self.values))]
+            o, nvals = Scalar.field_modulus, [x.n for x in self.values]
+            if inv:
+                assert self.basis == Basis.LAGRANGE
+                # Inverse FFT
+                invlen = Scalar(1) / len(self.values)
+                reversed_roots = [roots[0]] + roots[1:][::-1]
+                return Polynomial(
+                    [Scalar(x) * invlen for x in _fft(nvals, o, reversed_roots)],
+                    Basis.MONOMIAL,
+                )
+            else:
+                assert self.basis == Basis.MONOMIAL
+                # Regular FFT
+                return Polynomial(
+                    [Scalar(x) for x in _fft(nvals, o, roots)], Basis.LAGRANGE
+                )
 
     def ifft(self):
         return self.fft(True)
 
+    # Evaluates a coefficient form polynomial over the coset offset * H,
+    # where H is the subgroup of order `size`. Choosing `size` larger than the
+    # group order leaves room for products of polynomials, and the offset
+    # keeps Z_H(X) = X^n - 1 away from zero
+    def to_coset_extended_lagrange(self, offset: Scalar, size: int):
+        assert self.basis == Basis.MONOMIAL
+        assert len(self.values) <= size
+        # p(offset * X) has coefficients c_i * offset^i
+        shifted = [Scalar(0)] * size
+        offset_pow = Scalar(1)
+        for i, x in enumerate(self.values):
+            shifted[i] = x * offset_pow
+            offset_pow = offset_pow * offset
+        return Polynomial(shifted, Basis.MONOMIAL).fft()
+
+    # Inverse of to_coset_extended_lagrange: converts evaluations over the
+    # coset offset * H back to coefficients
+    def coset_extended_lagrange_to_coeffs(self, offset: Scalar):
+        assert self.basis == Basis.LAGRANGE
+        shifted = self.ifft().values
+        offset_inv = Scalar(1) / offset
+        coeffs = [Scalar(0)] * len(shifted)
+        offset_pow = Scalar(1)
+        for i, x in enumerate(shifted):
+            coeffs[i] = x * offset_pow
+            offset_pow = offset_pow * offset_inv
+        return Polynomial(coeffs, Basis.MONOMIAL)
+
     # add two polynomial for all cases
     # this may be slower than the normal +
     def force_add(self, other):
@@ -1,10 +1,20 @@
-from compiler.program import Program, CommonPreprocessedInput
+import multiprocessing
+import os
+from collections import deque
+from compiler.program import Program, Witness
+from contextlib import nullcontext
+from counters import OpCounter, OpCounts
+from instrumentation import span, log, clear_observers
+from memory import SpilledPolynomial, RoundMemory, MemoryTracker
+from proving_key import ProvingKey
+from scheduler import Scheduler
 from utils import *
 from setup import *
-from typing import Optional
+from typing import Iterable, Iterator, Optional, Union
 from dataclasses import dataclass
 from transcript import Transcript, Message1, Message2, Message3, Message4, Message5
 from poly import Polynomial, Basis
+from witness import wire_values, public_values, validate_witness
 
 
 @dataclass
@@ -20,153 +30,398 @@ class Proof:
         proof["a_1"] = self.msg_1.a_1
         proof["b_1"] = self.msg_1.b_1
         proof["c_1"] = self.msg_1.c_1
+        proof["d_1"] = self.msg_1.d_1
+        proof["h1_1"] = self.msg_1.h1_1
+        proof["h2_1"] = self.msg_1.h2_1
         proof["z_1"] = self.msg_2.z_1
+        proof["z2_1"] = self.msg_2.z2_1
         proof["W_t"] = self.msg_3.W_t
         proof["a_eval"] = self.msg_4.a_eval
         proof["b_eval"] = self.msg_4.b_eval
         proof["c_eval"] = self.msg_4.c_eval
-        proof["ql_eval"] = self.msg_4.ql_eval
-        proof["qr_eval"] = self.msg_4.qr_eval
-        proof["qm_eval"] = self.msg_4.qm_eval
-        proof["qo_eval"] = self.msg_4.qo_eval
-        proof["qc_eval"] = self.msg_4.qc_eval
         proof["s1_eval"] = self.msg_4.s1_eval
         proof["s2_eval"] = self.msg_4.s2_eval
-        proof["s3_eval"] = self.msg_4.s3_eval
-        proof["z_eval"] = self.msg_4.z_eval
         proof["zw_eval"] = self.msg_4.zw_eval
-        proof["t_eval"] = self.msg_4.t_eval
-        proof["W_a"] = self.msg_5.W_a
-        proof["W_a_quot"] = self.msg_5.W_a_quot
-        proof["W_b"] = self.msg_5.W_b
-        proof["W_b_quot"] = self.msg_5.W_b_quot
-        proof["W_c"] = self.msg_5.W_c
-        proof["W_c_quot"] = self.msg_5.W_c_quot
-        proof["W_ql"] = self.msg_5.W_ql
-        proof["W_ql_quot"] = self.msg_5.W_ql_quot
-        proof["W_qr"] = self.msg_5.W_qr
-        proof["W_qr_quot"] = self.msg_5.W_qr_quot
-        proof["W_qm"] = self.msg_5.W_qm
-        proof["W_qm_quot"] = self.msg_5.W_qm_quot
-        proof["W_qo"] = self.msg_5.W_qo
-        proof["W_qo_quot"] = self.msg_5.W_qo_quot
-        proof["W_qc"] = self.msg_5.W_qc
-        proof["W_qc_quot"] = self.msg_5.W_qc_quot
-        proof["W_s1"] = self.msg_5.W_s1
-        proof["W_s1_quot"] = self.msg_5.W_s1_quot
-        proof["W_s2"] = self.msg_5.W_s2
-        proof["W_s2_quot"] = self.msg_5.W_s2_quot
-        proof["W_s3"] = self.msg_5.W_s3
-        proof["W_s3_quot"] = self.msg_5.W_s3_quot
-        proof["W_z"] = self.msg_5.W_z
-        proof["W_z_quot"] = self.msg_5.W_z_quot
-        proof["W_zw"] = self.msg_5.W_zw
-        proof["W_zw_quot"] = self.msg_5.W_zw_quot
-        proof["W_t"] = self.msg_5.W_t
-        proof["W_t_quot"] = self.msg_5.W_t_quot
+        proof["d_eval"] = self.msg_4.d_eval
+        proof["s3_eval"] = self.msg_4.s3_eval
+        proof["qk_eval"] = self.msg_4.qk_eval
+        proof["tk_eval"] = self.msg_4.tk_eval
+        proof["h1_eval"] = self.msg_4.h1_eval
+        proof["h2_eval"] = self.msg_4.h2_eval
+        proof["tkw_eval"] = self.msg_4.tkw_eval
+        proof["h1w_eval"] = self.msg_4.h1w_eval
+        proof["z2w_eval"] = self.msg_4.z2w_eval
+        proof["W_zeta"] = self.msg_5.W_zeta
+        proof["W_zeta_omega"] = self.msg_5.W_zeta_omega
         return proof
 
+    def to_json(self) -> dict:
+        return {
+            "msg_1": dataclass_to_json(self.msg_1),
+            "msg_2": dataclass_to_json(self.msg_2),
+            "msg_3": dataclass_to_json(self.msg_3),
+            "msg_4": dataclass_to_json(self.msg_4),
+            "msg_5": dataclass_to_json(self.msg_5),
+        }
+
+    @classmethod
+    def from_json(cls, data: dict):
+        return cls(
+            dataclass_from_json(Message1, data["msg_1"]),
+            dataclass_from_json(Message2, data["msg_2"]),
+            dataclass_from_json(Message3, data["msg_3"]),
+            dataclass_from_json(Message4, data["msg_4"]),
+            dataclass_from_json(Message5, data["msg_5"]),
+        )
+
+
+ROUNDS = ["round_1", "round_2", "round_3", "round_4", "round_5"]
+# Intermediates that rounds keep on the prover
+INTERMEDIATES = [
+    "PI",
+    "A",
+    "B",
+    "C",
+    "D",
+    "A_coeff",
+    "B_coeff",
+    "C_coeff",
+    "D_coeff",
+    "H1",
+    "H2",
+    "H1_coeff",
+    "H2_coeff",
+    "Z",
+    "Z_coeff",
+    "Z2",
+    "Z2_coeff",
+    "PI_coeff",
+    "T_chunks",
+]
+# Intermediates each round reads from earlier rounds. In low-memory mode,
+# everything else is released after each round. The fourth wire D is None
+# for programs without custom gates, and H1, H2 and Z2 for programs without
+# lookups
+ROUND_INPUTS = {
+    "round_1": ["PI"],
+    "round_2": ["A", "B", "C", "D", "H1", "H2"],
+    "round_3": [
+        "A_coeff",
+        "B_coeff",
+        "C_coeff",
+        "D_coeff",
+        "H1_coeff",
+        "H2_coeff",
+        "Z_coeff",
+        "Z2_coeff",
+        "PI",
+    ],
+    "round_4": [
+        "A_coeff",
+        "B_coeff",
+        "C_coeff",
+        "D_coeff",
+        "H1_coeff",
+        "H2_coeff",
+        "Z_coeff",
+        "Z2_coeff",
+    ],
+    "round_5": [
+        "A_coeff",
+        "B_coeff",
+        "C_coeff",
+        "D_coeff",
+        "H1_coeff",
+        "H2_coeff",
+        "Z_coeff",
+        "Z2_coeff",
+        "PI",
+        "T_chunks",
+    ],
+}
+
+
+# The prover of a worker process of `Prover.prove_many`, set by the pool
+# initializer in each worker
+_worker_prover: Optional["Prover"] = None
+
+
+def _init_prove_worker(prover: "Prover"):
+    global _worker_prover
+    clear_observers()
+    _worker_prover = prover
+
+
+def _prove_many_task(witness: dict[Optional[str], int]) -> Proof:
+    prover = _worker_prover
+    return prover.prove(prover.program.fill_witness(witness))
+
 
 @dataclass
 class Prover:
     group_order: int
     setup: Setup
     program: Program
-    pk: CommonPreprocessedInput
-
-    def __init__(self, setup: Setup, program: Program):
+    pk: ProvingKey
+    scheduler: Scheduler
+    check_witness: bool
+    low_memory: bool
+    spill_dir: Optional[str]
+    report_memory: bool
+    # Memory used by each round of the last proof, with `report_memory`
+    memory_report: list[RoundMemory]
+    count_ops: bool
+    # Operations done by each round of the last proof and by the whole
+    # proof ("prove"), with `count_ops`
+    op_report: dict[str, OpCounts]
+
+    # The proving key can be shared by any number of provers for the same
+    # setup and program; it is built here if none is given. The FFTs and
+    # MSMs of each round run on `scheduler`, in-process by default, or
+    # across worker processes with a `PoolScheduler`. With `check_witness`
+    # the witness is validated against every constraint before proving;
+    # production provers whose witnesses are known to be valid can skip it.
+    #
+    # With `low_memory`, each round releases the intermediates that later
+    # rounds do not read. With a `spill_dir` as well, intermediates that the
+    # next round does not read are spilled to memory-mapped files there until
+    # a later round needs them. With `report_memory`, the peak memory of each
+    # round is measured and kept in `memory_report`. With `count_ops`, the
+    # primitive operations of each round are counted into `op_report`
+    def __init__(
+        self,
+        setup: Setup,
+        program: Program,
+        pk: Optional[ProvingKey] = None,
+        scheduler: Optional[Scheduler] = None,
+        check_witness: bool = True,
+        low_memory: bool = False,
+        spill_dir: Optional[str] = None,
+        report_memory: bool = False,
+        count_ops: bool = False,
+    ):
         self.group_order = program.group_order
         self.setup = setup
         self.program = program
-        self.pk = program.common_preprocessed_input()
-
-    def prove(self, witness: dict[Optional[str], int]) -> Proof:
-        # Initialise Fiat-Shamir transcript
-        transcript = Transcript(b"plonk")
-
-        # Collect fixed and public information
-        # FIXME: Hash pk and PI into transcript
-        public_vars = self.program.get_public_assignments()
-        # Public input polynomial
-        PI = Polynomial(
-            [Scalar(-witness[v]) for v in public_vars]
-            + [Scalar(0) for _ in range(self.group_order - len(public_vars))],
-            Basis.LAGRANGE,
+        self.scheduler = scheduler if scheduler is not None else Scheduler(setup)
+        self.pk = (
+            pk if pk is not None else ProvingKey.build(setup, program, self.scheduler)
         )
-        self.PI = PI
-
-        # Round 1
-        msg_1 = self.round_1(witness)
-        self.beta, self.gamma = transcript.round_1(msg_1)
-
-        # Round 2
-        msg_2 = self.round_2()
-        self.alpha = transcript.round_2(msg_2)
-
-        # Round 3
-        msg_3 = self.round_3()
-        self.zeta = transcript.round_3(msg_3)
-
-        # Round 4
-        msg_4 = self.round_4()
+        self.check_witness = check_witness
+        self.low_memory = low_memory or spill_dir is not None
+        self.spill_dir = spill_dir
+        self.report_memory = report_memory
+        self.memory_report = []
+        self.count_ops = count_ops
+        self.op_report = {}
+
+    # The witness is either a full assignment of named variables, or a
+    # witness array such as the one `Program.fill_witness` returns
+    def prove(self, witness: Union[dict[Optional[str], int], Witness]) -> Proof:
+        with (
+            OpCounter() if self.count_ops else nullcontext()
+        ) as counter, span("prove", "prove", group_order=self.group_order):
+            witness = self.program.witness_values(witness)
+            if self.check_witness:
+                failures = validate_witness(self.program, witness, self.pk)
+                if failures:
+                    raise Exception(
+                        "Witness does not satisfy the constraints:\n"
+                        + "\n".join(str(x) for x in failures)
+                    )
+
+            tracker = MemoryTracker() if self.report_memory else None
+
+            # Initialise Fiat-Shamir transcript
+            transcript = Transcript(
+                b"plonk", self.pk.has_custom_gates(), self.pk.has_lookups()
+            )
 
-        # Round 5
-        msg_5 = self.round_5()
+            # Collect fixed and public information
+            # FIXME: Hash pk and PI into transcript
+            # Public input polynomial
+            self.PI = Polynomial(public_values(self.program, witness), Basis.LAGRANGE)
+
+            # Round 1
+            msg_1 = self.run_round("round_1", tracker, witness)
+            with span("transcript", "transcript"):
+                self.beta, self.gamma = transcript.round_1(msg_1)
+
+            # Round 2
+            msg_2 = self.run_round("round_2", tracker)
+            with span("transcript", "transcript"):
+                self.alpha = transcript.round_2(msg_2)
+
+            # Round 3
+            msg_3 = self.run_round("round_3", tracker)
+            with span("transcript", "transcript"):
+                self.zeta = transcript.round_3(msg_3)
+
+            # Round 4
+            msg_4 = self.run_round("round_4", tracker)
+            with span("transcript", "transcript"):
+                self.v = transcript.round_4(msg_4)
+
+            # Round 5
+            msg_5 = self.run_round("round_5", tracker)
+
+            if tracker is not None:
+                self.memory_report = tracker.rounds
+                for x in tracker.rounds:
+                    log("Memory of {}".format(x))
+            if counter is not None:
+                self.op_report = {x: counter.spans[x] for x in ROUNDS}
+                self.op_report["prove"] = counter.counts
+
+            return Proof(msg_1, msg_2, msg_3, msg_4, msg_5)
+
+    # Runs a round, bringing back the spilled intermediates it reads first,
+    # and releasing or spilling the ones it does not need afterwards
+    def run_round(self, name: str, tracker: Optional[MemoryTracker], *args):
+        for attr in ROUND_INPUTS[name]:
+            value = getattr(self, attr)
+            if isinstance(value, list) and isinstance(value[0], SpilledPolynomial):
+                setattr(self, attr, [self.unspill(x) for x in value])
+            elif isinstance(value, SpilledPolynomial):
+                setattr(self, attr, self.unspill(value))
+
+        with span(name, "round"):
+            message = getattr(self, name)(*args)
+
+        if self.low_memory:
+            later = ROUNDS[ROUNDS.index(name) + 1 :]
+            needed = {x for round in later for x in ROUND_INPUTS[round]}
+            upcoming = ROUND_INPUTS[later[0]] if later else []
+            for attr in INTERMEDIATES:
+                value = getattr(self, attr, None)
+                if value is None:
+                    continue
+                if attr not in needed:
+                    setattr(self, attr, None)
+                elif self.spill_dir is not None and attr not in upcoming:
+                    if isinstance(value, list):
+                        setattr(self, attr, [self.spill(x) for x in value])
+                    else:
+                        setattr(self, attr, self.spill(value))
+        if tracker is not None:
+            tracker.end_round(name)
+        return message
+
+    def spill(self, value: Polynomial):
+        if isinstance(value, SpilledPolynomial):
+            return value
+        return SpilledPolynomial(value, self.spill_dir)
+
+    def unspill(self, value: SpilledPolynomial) -> Polynomial:
+        poly = value.load()
+        value.close()
+        return poly
+
+    # Proves many witnesses of the same program. Each witness may be a
+    # partial assignment, which is completed with `fill_variable_assignments`
+    # before proving. Witnesses are proved in parallel by `processes` workers
+    # that share this prover's proving key, at most `window` at a time, and
+    # the proofs are yielded in input order.
+    #
+    # The workers need the fork start method: the prover is handed to them
+    # through the pool initializer without being pickled (its setup holds G2
+    # points, which do not pickle). Where fork is not available, witnesses
+    # are proved one after the other in this process.
+    #
+    # `memory_report` and `op_report` describe the last proof of this
+    # prover, and proofs made by workers never reach them, so provers with
+    # `report_memory` or `count_ops` only prove in this process
+    def prove_many(
+        self,
+        witnesses: Iterable[dict[Optional[str], int]],
+        processes: Optional[int] = None,
+        window: Optional[int] = None,
+    ) -> Iterator[Proof]:
+        processes = processes or os.cpu_count() or 1
+        if processes == 1 or "fork" not in multiprocessing.get_all_start_methods():
+            for witness in witnesses:
+                yield self.prove(self.program.fill_witness(witness))
+            return
+        if self.report_memory or self.count_ops:
+            raise Exception(
+                "Memory and operation reports need a single process, not {}".format(
+                    processes
+                )
+            )
 
-        return Proof(msg_1, msg_2, msg_3, msg_4, msg_5)
+        # A pool scheduler does not survive the fork, so workers schedule
+        # their FFTs and MSMs in-process
+        prover = Prover(
+            self.setup,
+            self.program,
+            self.pk,
+            check_witness=self.check_witness,
+            low_memory=self.low_memory,
+            spill_dir=self.spill_dir,
+        )
+        window = window or 2 * processes
+        pending = deque()
+        context = multiprocessing.get_context("fork")
+        with context.Pool(processes, _init_prove_worker, (prover,)) as pool:
+            for witness in witnesses:
+                if len(pending) >= window:
+                    yield pending.popleft().get()
+                pending.append(pool.apply_async(_prove_many_task, (witness,)))
+            while pending:
+                yield pending.popleft().get()
 
     def round_1(
         self,
-        witness: dict[Optional[str], int],
+        witness: Witness,
     ) -> Message1:
         # https://github.com/sec-bit/learning-zkp/blob/master/plonk-intro-cn/1-plonk-arithmetization.md
-        program = self.program
-        setup = self.setup
-        group_order = self.group_order
-
-        if None not in witness:
-            witness[None] = 0
-
-        # Compute wire assignments
-        A_values = [Scalar(0) for _ in range(group_order)]
-        B_values = [Scalar(0) for _ in range(group_order)]
-        C_values = [Scalar(0) for _ in range(group_order)]
-
-        for i, gate_wires in enumerate(program.wires()):
-            A_values[i] = Scalar(witness[gate_wires.L])
-            B_values[i] = Scalar(witness[gate_wires.R])
-            C_values[i] = Scalar(witness[gate_wires.O])
-
-        self.A = Polynomial(A_values, Basis.LAGRANGE)
-        self.B = Polynomial(B_values, Basis.LAGRANGE)
-        self.C = Polynomial(C_values, Basis.LAGRANGE)
-
-        a_1 = setup.commit(self.A)
-        b_1 = setup.commit(self.B)
-        c_1 = setup.commit(self.C)
-
-        # Sanity check that witness fulfils gate constraints
-        assert (
-            self.A * self.pk.QL
-            + self.B * self.pk.QR
-            + self.A * self.B * self.pk.QM
-            + self.C * self.pk.QO
-            + self.PI
-            + self.pk.QC
-            == Polynomial([Scalar(0)] * group_order, Basis.LAGRANGE)
+        scheduler = self.scheduler
+
+        # Compute wire assignments. Custom gates add the fourth wire D
+        wires = [
+            Polynomial(x, Basis.LAGRANGE) for x in wire_values(self.program, witness)
+        ]
+
+        # Lookups: the values looked up, f = q_K a (0 on the other rows), are
+        # merged into the table and sorted. The sorted vector s is split into
+        # its even and odd entries h1 and h2, so that the pairs of consecutive
+        # entries of s are (h1_i, h2_i) and (h2_i, h1_i+1), cyclically
+        sorted_halves = []
+        if self.pk.has_lookups():
+            f = [q * a for q, a in zip(self.pk.QK.values, wires[0].values)]
+            s = sorted(x.n for x in f + self.pk.TK.values)
+            sorted_halves = [
+                Polynomial([Scalar(x) for x in s[i::2]], Basis.LAGRANGE)
+                for i in (0, 1)
+            ]
+
+        coeffs = scheduler.ifft(wires + sorted_halves)
+        commitments = scheduler.commit(coeffs)
+
+        # Programs without custom gates have no fourth wire, and programs
+        # without lookups no sorted vector
+        padding = [None] * (4 - len(wires))
+        self.A, self.B, self.C, self.D = wires + padding
+        self.A_coeff, self.B_coeff, self.C_coeff, self.D_coeff = (
+            list(coeffs[: len(wires)]) + padding
         )
+        self.H1, self.H2 = sorted_halves or [None, None]
+        self.H1_coeff, self.H2_coeff = coeffs[len(wires) :] or [None, None]
 
-        return Message1(a_1, b_1, c_1)
+        message = Message1(*commitments[: len(wires)])
+        if sorted_halves:
+            message.h1_1, message.h2_1 = commitments[len(wires) :]
+        return message
 
     def round_2(self) -> Message2:
         # https://github.com/sec-bit/learning-zkp/blob/master/plonk-intro-cn/3-plonk-permutation.md
         group_order = self.group_order
-        setup = self.setup
+        scheduler = self.scheduler
 
         Z_values = [Scalar(1)]
-        roots_of_unity = Scalar.roots_of_unity(group_order)
+        roots_of_unity = self.pk.roots_of_unity
         for i in range(group_order):
-            Z_values.append(
+            Z_value = (
                 Z_values[-1]
                 * self.rlc(self.A.values[i], roots_of_unity[i])
                 * self.rlc(self.B.values[i], 2 * roots_of_unity[i])
@@ -175,145 +430,195 @@ class Prover:
                 / self.rlc(self.B.values[i], self.pk.S2.values[i])
                 / self.rlc(self.C.values[i], self.pk.S3.values[i])
             )
-        # The last value is 1
-        assert Z_values.pop() == 1
-
-        # Sanity-check that Z was computed correctly
-        for i in range(group_order):
-            assert (
-                self.rlc(self.A.values[i], roots_of_unity[i])
-                * self.rlc(self.B.values[i], 2 * roots_of_unity[i])
-                * self.rlc(self.C.values[i], 3 * roots_of_unity[i])
-            ) * Z_values[i] - (
-                self.rlc(self.A.values[i], self.pk.S1.values[i])
-                * self.rlc(self.B.values[i], self.pk.S2.values[i])
-                * self.rlc(self.C.values[i], self.pk.S3.values[i])
-            ) * Z_values[
-                (i + 1) % group_order
-            ] == 0
+            if self.D is not None:
+                Z_value = (
+                    Z_value
+                    * self.rlc(self.D.values[i], 4 * roots_of_unity[i])
+                    / self.rlc(self.D.values[i], self.pk.S4.values[i])
+                )
+            Z_values.append(Z_value)
+        # The last value is 1 when the copy constraints hold
+        Z_values.pop()
 
         Z = Polynomial(Z_values, Basis.LAGRANGE)
-        z_1 = setup.commit(Z)
-        print("Permutation accumulator polynomial successfully generated")
-
-        self.Z = Z
-        return Message2(z_1)
+        accumulators = [Z]
+
+        # The lookup accumulator z2 proves that the pairs of consecutive
+        # entries of the sorted vector are the pairs of consecutive entries
+        # of the table, plus a pair (f_i, f_i) for every looked up value:
+        # z2_i+1 = z2_i (1 + β)(γ + f_i)(γ(1 + β) + t_i + β t_i+1)
+        #   / (γ(1 + β) + h1_i + β h2_i)(γ(1 + β) + h2_i + β h1_i+1)
+        if self.H1 is not None:
+            beta, gamma = self.beta, self.gamma
+            gamma_beta = gamma * (beta + 1)
+            A, QK, TK = self.A.values, self.pk.QK.values, self.pk.TK.values
+            H1, H2 = self.H1.values, self.H2.values
+            Z2_values = [Scalar(1)]
+            for i in range(group_order):
+                j = (i + 1) % group_order
+                Z2_values.append(
+                    Z2_values[-1]
+                    * (beta + 1)
+                    * (gamma + QK[i] * A[i])
+                    * (gamma_beta + TK[i] + beta * TK[j])
+                    / (gamma_beta + H1[i] + beta * H2[i])
+                    / (gamma_beta + H2[i] + beta * H1[j])
+                )
+            # The last value is 1 when every looked up value is in the table
+            Z2_values.pop()
+            accumulators.append(Polynomial(Z2_values, Basis.LAGRANGE))
+
+        coeffs = scheduler.ifft(accumulators)
+        commitments = scheduler.commit(coeffs)
+        log("Permutation accumulator polynomial successfully generated")
+
+        self.Z, self.Z2 = (accumulators + [None])[:2]
+        self.Z_coeff, self.Z2_coeff = (list(coeffs) + [None])[:2]
+        return Message2(*commitments)
 
     def round_3(self) -> Message3:
         # https://github.com/sec-bit/learning-zkp/blob/master/plonk-intro-cn/4-plonk-constraints.md
         group_order = self.group_order
-        setup = self.setup
+        scheduler = self.scheduler
+        pk = self.pk
 
         # Compute the quotient polynomial
 
         alpha = self.alpha
 
-        roots_of_unity = Scalar.roots_of_unity(group_order)
-
-        A_coeff, B_coeff, C_coeff, S1_coeff, S2_coeff, S3_coeff, Z_coeff, QL_coeff, QR_coeff, QM_coeff, QO_coeff, QC_coeff, PI_coeff = (
-            x.ifft()
-            for x in (
-                self.A,
-                self.B,
-                self.C,
-                self.pk.S1,
-                self.pk.S2,
-                self.pk.S3,
-                self.Z,
-                self.pk.QL,
-                self.pk.QR,
-                self.pk.QM,
-                self.pk.QO,
-                self.pk.QC,
-                self.PI,
-            )
+        (PI_coeff,) = scheduler.ifft([self.PI])
+
+        # The constraint polynomial has degree up to 4n (6n with custom
+        # gates), which is too large to multiply out over the n roots of
+        # unity. Instead, evaluate every polynomial over a coset of the
+        # extended domain (the 4n-th roots of unity, or the 8n-th with custom
+        # gates), where products are computed pointwise. The preprocessed
+        # polynomials are already evaluated there in the proving key
+        custom = self.D_coeff is not None
+        lookups = self.Z2_coeff is not None
+        A_big, B_big, C_big, Z_big, PI_big, *extra_big = scheduler.coset_extended(
+            [self.A_coeff, self.B_coeff, self.C_coeff, self.Z_coeff, PI_coeff]
+            + ([self.D_coeff] if custom else [])
+            + ([self.H1_coeff, self.H2_coeff, self.Z2_coeff] if lookups else []),
+            pk.coset_offset,
+            pk.extended_order,
         )
-
-        L0_coeff = (
-            Polynomial([Scalar(1)] + [Scalar(0)] * (group_order - 1), Basis.LAGRANGE)
-        ).ifft()
-
-        # x^8 - 1 coeffs are [-1, 0, 0, 0, 0, 0, 0, 0, 1]
-        # which needs 9 points(n + 1) to determine the polynomial
-        ZH_array = [Scalar(-1)] + [Scalar(0)] * (group_order - 1) + [Scalar(1)]
-        ZH_coeff = Polynomial(ZH_array, Basis.MONOMIAL)
-
-        gate_constraints_coeff = (
-            A_coeff * QL_coeff
-            + B_coeff * QR_coeff
-            + A_coeff * B_coeff * QM_coeff
-            + C_coeff * QO_coeff
-            + PI_coeff
-            + QC_coeff
+        # z(ωX): ω is the (extended order / n)-th power of the extended
+        # domain's root
+        shift = pk.extended_order // group_order
+        ZW_big = Z_big.shift(shift)
+
+        # The extended vectors are the largest of the prover, so each one is
+        # released as soon as the terms that read it are computed
+        gate_constraints_big = (
+            A_big * pk.QL_big
+            + B_big * pk.QR_big
+            + A_big * B_big * pk.QM_big
+            + C_big * pk.QO_big
+            + PI_big
+            + pk.QC_big
         )
+        del PI_big
+        # Custom gates add q_D(X) d(X) + q_L5(X) a(X)^5 + q_R5(X) b(X)^5 +
+        # q_O5(X) c(X)^5
+        if custom:
+            D_big = extra_big.pop(0)
+            gate_constraints_big = gate_constraints_big + D_big * pk.QD_big
+            for wire_big, Q5_big in (
+                (A_big, pk.QL5_big),
+                (B_big, pk.QR5_big),
+                (C_big, pk.QO5_big),
+            ):
+                square_big = wire_big * wire_big
+                gate_constraints_big = (
+                    gate_constraints_big + square_big * square_big * wire_big * Q5_big
+                )
+                del square_big
+
+        # Lookups: z2(X) (1 + β)(γ + q_K(X) a(X))(γ(1 + β) + t(X) + β t(ωX))
+        #   - z2(ωX) (γ(1 + β) + h1(X) + β h2(X))(γ(1 + β) + h2(X) + β h1(ωX))
+        if lookups:
+            H1_big, H2_big, Z2_big = extra_big
+            beta, gamma = self.beta, self.gamma
+            gamma_beta = gamma * (beta + 1)
+            lookup_grand_product_big = Z2_big * (
+                (pk.QK_big * A_big + gamma)
+                * (beta + 1)
+                * (pk.TK_big + pk.TK_big.shift(shift) * beta + gamma_beta)
+            ) - Z2_big.shift(shift) * (
+                (H1_big + H2_big * beta + gamma_beta)
+                * (H2_big + H1_big.shift(shift) * beta + gamma_beta)
+            )
+            lookup_first_row_big = (Z2_big - Scalar(1)) * pk.L0_big
+            del H1_big, H2_big, Z2_big
 
-        normal_roots = Polynomial(
-            roots_of_unity, Basis.LAGRANGE
+        permutation_numerator_big = (
+            self.rlc(A_big, pk.X_big)
+            * self.rlc(B_big, pk.X_big * Scalar(2))
+            * self.rlc(C_big, pk.X_big * Scalar(3))
         )
-
-        roots_coeff = normal_roots.ifft()
-        # z * w
-        ZW = self.Z.shift(1)
-        ZW_coeff = ZW.ifft()
-
-        for i in range(group_order):
-            assert (
-                self.rlc(self.A.values[i], roots_of_unity[i])
-                * self.rlc(self.B.values[i], 2 * roots_of_unity[i])
-                * self.rlc(self.C.values[i], 3 * roots_of_unity[i])
-            ) * self.Z.values[i] - (
-                self.rlc(self.A.values[i], self.pk.S1.values[i])
-                * self.rlc(self.B.values[i], self.pk.S2.values[i])
-                * self.rlc(self.C.values[i], self.pk.S3.values[i])
-            ) * ZW.values[
-                i % group_order
-            ] == 0
-
-        permutation_grand_product_coeff = (
-            (
-                self.rlc(A_coeff, roots_coeff)
-                * self.rlc(B_coeff, roots_coeff * Scalar(2))
-                * self.rlc(C_coeff, roots_coeff * Scalar(3))
+        permutation_denominator_big = (
+            self.rlc(A_big, pk.S1_big)
+            * self.rlc(B_big, pk.S2_big)
+            * self.rlc(C_big, pk.S3_big)
+        )
+        del A_big, B_big, C_big
+        if custom:
+            permutation_numerator_big = permutation_numerator_big * self.rlc(
+                D_big, pk.X_big * Scalar(4)
             )
-            * Z_coeff
-            - (
-                self.rlc(A_coeff, S1_coeff)
-                * self.rlc(B_coeff, S2_coeff)
-                * self.rlc(C_coeff, S3_coeff)
+            permutation_denominator_big = permutation_denominator_big * self.rlc(
+                D_big, pk.S4_big
             )
-            * ZW_coeff
+            del D_big
+        permutation_grand_product_big = (
+            permutation_numerator_big * Z_big - permutation_denominator_big * ZW_big
         )
+        del permutation_numerator_big, permutation_denominator_big, ZW_big
 
-        permutation_first_row_coeff = (Z_coeff - Scalar(1)) * L0_coeff
+        permutation_first_row_big = (Z_big - Scalar(1)) * pk.L0_big
+        del Z_big
 
-        all_constraints = (
-            gate_constraints_coeff
-            + permutation_grand_product_coeff * alpha
-            + permutation_first_row_coeff * alpha**2
+        all_constraints_big = (
+            gate_constraints_big
+            + permutation_grand_product_big * alpha
+            + permutation_first_row_big * alpha**2
         )
+        del gate_constraints_big, permutation_grand_product_big
+        del permutation_first_row_big
+        if lookups:
+            all_constraints_big = (
+                all_constraints_big
+                + lookup_grand_product_big * alpha**3
+                + lookup_first_row_big * alpha**4
+            )
+            del lookup_grand_product_big, lookup_first_row_big
 
         # quotient polynomial
-        T_coeff = all_constraints / ZH_coeff
-
-        print("Generated the quotient polynomial")
-
-        W_t = setup.commit(T_coeff)
-
-        self.A_coeff = A_coeff
-        self.B_coeff = B_coeff
-        self.C_coeff = C_coeff
-        self.S1_coeff = S1_coeff
-        self.S2_coeff = S2_coeff
-        self.S3_coeff = S3_coeff
-        self.Z_coeff = Z_coeff
-        self.ZW_coeff = ZW_coeff
-        self.QL_coeff = QL_coeff
-        self.QR_coeff = QR_coeff
-        self.QM_coeff = QM_coeff
-        self.QO_coeff = QO_coeff
-        self.QC_coeff = QC_coeff
+        quotient_big = all_constraints_big * pk.ZH_inv_big
+        del all_constraints_big
+        (T_coeff,) = scheduler.coset_to_coeffs([quotient_big], pk.coset_offset)
+        del quotient_big
+
+        # The quotient has degree below quotient_chunks * n when the
+        # constraints hold everywhere on the roots of unity. Split it into
+        # chunks of degree < n, so that the SRS only needs n powers:
+        # t(X) = t_lo(X) + X^n t_mid(X) + X^2n t_hi(X) + ...
+        chunks_end = group_order * pk.quotient_chunks
+        assert T_coeff.values[chunks_end:] == [Scalar(0)] * (
+            pk.extended_order - chunks_end
+        )
+        T_chunks = [
+            Polynomial(T_coeff.values[i : i + group_order], Basis.MONOMIAL)
+            for i in range(0, chunks_end, group_order)
+        ]
+
+        log("Generated the quotient polynomial")
+
+        W_t = scheduler.commit(T_chunks)
+
         self.PI_coeff = PI_coeff
-        self.T_coeff = T_coeff
+        self.T_chunks = T_chunks
 
         return Message3(W_t)
 
@@ -322,99 +627,184 @@ class Prover:
         group_order = self.group_order
         zeta = self.zeta
 
+        # The selectors, S3, Z and T enter the linearization polynomial
+        # r(X) linearly, so only the wires, S1, S2 and z(ζω) are evaluated.
+        # With custom gates, S4 takes the place of S3, which is evaluated
         a_eval = self.A_coeff.coeff_eval(zeta)
         b_eval = self.B_coeff.coeff_eval(zeta)
         c_eval = self.C_coeff.coeff_eval(zeta)
-        s1_eval = self.S1_coeff.coeff_eval(zeta)
-        s2_eval = self.S2_coeff.coeff_eval(zeta)
-        s3_eval = self.S3_coeff.coeff_eval(zeta)
+        s1_eval = self.pk.S1_coeff.coeff_eval(zeta)
+        s2_eval = self.pk.S2_coeff.coeff_eval(zeta)
         root_of_unity = Scalar.root_of_unity(group_order)
-        z_eval = self.Z_coeff.coeff_eval(zeta)
         zw_eval = self.Z_coeff.coeff_eval(zeta * root_of_unity)
-        ql_eval = self.QL_coeff.coeff_eval(zeta)
-        qr_eval = self.QR_coeff.coeff_eval(zeta)
-        qm_eval = self.QM_coeff.coeff_eval(zeta)
-        qo_eval = self.QO_coeff.coeff_eval(zeta)
-        qc_eval = self.QC_coeff.coeff_eval(zeta)
-        t_eval = self.T_coeff.coeff_eval(zeta)
+        d_eval = s3_eval = None
+        if self.D_coeff is not None:
+            d_eval = self.D_coeff.coeff_eval(zeta)
+            s3_eval = self.pk.S3_coeff.coeff_eval(zeta)
+        # With lookups, z2(X) enters r(X) linearly, and everything else of
+        # the lookup terms is evaluated
+        lookup_evals = [None] * 7
+        if self.Z2_coeff is not None:
+            zeta_w = zeta * root_of_unity
+            lookup_evals = [
+                self.pk.QK_coeff.coeff_eval(zeta),
+                self.pk.TK_coeff.coeff_eval(zeta),
+                self.H1_coeff.coeff_eval(zeta),
+                self.H2_coeff.coeff_eval(zeta),
+                self.pk.TK_coeff.coeff_eval(zeta_w),
+                self.H1_coeff.coeff_eval(zeta_w),
+                self.Z2_coeff.coeff_eval(zeta_w),
+            ]
 
         self.a_eval = a_eval
         self.b_eval = b_eval
         self.c_eval = c_eval
-        self.ql_eval = ql_eval
-        self.qr_eval = qr_eval
-        self.qm_eval = qm_eval
-        self.qo_eval = qo_eval
-        self.qc_eval = qc_eval
         self.s1_eval = s1_eval
         self.s2_eval = s2_eval
-        self.s3_eval = s3_eval
-        self.z_eval = z_eval
         self.zw_eval = zw_eval
-        self.t_eval = t_eval
+        self.d_eval = d_eval
+        self.s3_eval = s3_eval
+        self.lookup_evals = lookup_evals
 
         return Message4(
             a_eval,
             b_eval,
             c_eval,
-            ql_eval,
-            qr_eval,
-            qm_eval,
-            qo_eval,
-            qc_eval,
             s1_eval,
             s2_eval,
-            s3_eval,
-            z_eval,
             zw_eval,
-            t_eval
+            d_eval,
+            s3_eval,
+            *lookup_evals,
         )
 
     def round_5(self) -> Message5:
-        W_a, W_a_quot = self.generate_commitment(self.A_coeff, self.a_eval)
-        W_b, W_b_quot = self.generate_commitment(self.B_coeff, self.b_eval)
-        W_c, W_c_quot = self.generate_commitment(self.C_coeff, self.c_eval)
-        W_ql, W_ql_quot = self.generate_commitment(self.QL_coeff, self.ql_eval)
-        W_qr, W_qr_quot = self.generate_commitment(self.QR_coeff, self.qr_eval)
-        W_qm, W_qm_quot = self.generate_commitment(self.QM_coeff, self.qm_eval)
-        W_qo, W_qo_quot = self.generate_commitment(self.QO_coeff, self.qo_eval)
-        W_qc, W_qc_quot = self.generate_commitment(self.QC_coeff, self.qc_eval)
-        W_s1, W_s1_quot = self.generate_commitment(self.S1_coeff, self.s1_eval)
-        W_s2, W_s2_quot = self.generate_commitment(self.S2_coeff, self.s2_eval)
-        W_s3, W_s3_quot = self.generate_commitment(self.S3_coeff, self.s3_eval)
-        W_z, W_z_quot = self.generate_commitment(self.Z_coeff, self.z_eval)
-        W_zw, W_zw_quot = self.generate_commitment(self.ZW_coeff, self.zw_eval)
-        W_t, W_t_quot = self.generate_commitment(self.T_coeff, self.t_eval)
-
-        print("Generated final quotient witness polynomials")
-        return Message5(
-            W_a, W_a_quot,
-            W_b, W_b_quot,
-            W_c, W_c_quot,
-            W_ql, W_ql_quot,
-            W_qr, W_qr_quot,
-            W_qm, W_qm_quot,
-            W_qo, W_qo_quot,
-            W_qc, W_qc_quot,
-            W_s1, W_s1_quot,
-            W_s2, W_s2_quot,
-            W_s3, W_s3_quot,
-            W_z, W_z_quot,
-            W_zw, W_zw_quot,
-            W_t, W_t_quot,
+        group_order = self.group_order
+        zeta = self.zeta
+        zeta_w = zeta * Scalar.root_of_unity(group_order)
+        alpha, beta, gamma = self.alpha, self.beta, self.gamma
+        a_eval, b_eval, c_eval = self.a_eval, self.b_eval, self.c_eval
+        s1_eval, s2_eval, zw_eval = self.s1_eval, self.s2_eval, self.zw_eval
+
+        ZH_ev = zeta**group_order - 1
+        L0_ev = ZH_ev / (group_order * (zeta - 1))
+        PI_ev = self.PI.barycentric_eval(zeta)
+
+        # t_lo(X) + ζ^n t_mid(X) + ζ^2n t_hi(X), which agrees with t(X) at ζ
+        T_zeta_coeff = self.T_chunks[0]
+        for i, T_chunk in enumerate(self.T_chunks[1:], 1):
+            T_zeta_coeff = T_zeta_coeff + T_chunk * zeta ** (group_order * i)
+
+        # Linearization polynomial: the constraint polynomial with every
+        # wire and S1, S2, z(ωX) replaced by its evaluation, minus t(ζ)Z_H(ζ)
+        # with the quotient chunks recombined with powers of ζ^n.
+        # It vanishes at ζ, and the verifier can compute its commitment from
+        # the verification key and the proof on its own
+        pk = self.pk
+        gates_coeff = (
+            pk.QM_coeff * (a_eval * b_eval)
+            + pk.QL_coeff * a_eval
+            + pk.QR_coeff * b_eval
+            + pk.QO_coeff * c_eval
+            + pk.QC_coeff
+        )
+        permutation_numerator = (
+            self.rlc(a_eval, zeta)
+            * self.rlc(b_eval, zeta * 2)
+            * self.rlc(c_eval, zeta * 3)
+        )
+        permutation_denominator = self.rlc(a_eval, s1_eval) * self.rlc(b_eval, s2_eval)
+        # The permutation polynomial of the last wire enters r(X) linearly
+        last_eval, S_last_coeff = c_eval, pk.S3_coeff
+        custom = self.D_coeff is not None
+        if custom:
+            d_eval, s3_eval = self.d_eval, self.s3_eval
+            gates_coeff = (
+                gates_coeff
+                + pk.QD_coeff * d_eval
+                + pk.QL5_coeff * a_eval**5
+                + pk.QR5_coeff * b_eval**5
+                + pk.QO5_coeff * c_eval**5
+            )
+            permutation_numerator *= self.rlc(d_eval, zeta * 4)
+            permutation_denominator *= self.rlc(c_eval, s3_eval)
+            last_eval, S_last_coeff = d_eval, pk.S4_coeff
+
+        R_coeff = (
+            gates_coeff
+            + PI_ev
+            + self.Z_coeff * (permutation_numerator * alpha + L0_ev * alpha**2)
+            - (S_last_coeff * beta + last_eval + gamma)
+            * (permutation_denominator * zw_eval * alpha)
+            - L0_ev * alpha**2
+            - T_zeta_coeff * ZH_ev
+        )
+        # Lookups: z2(X) enters r(X) linearly, with the same first row
+        # constraint as z(X)
+        lookups = self.Z2_coeff is not None
+        if lookups:
+            qk_eval, tk_eval, h1_eval, h2_eval, *shifted_evals = self.lookup_evals
+            tkw_eval, h1w_eval, z2w_eval = shifted_evals
+            gamma_beta = gamma * (beta + 1)
+            lookup_numerator = (
+                (beta + 1)
+                * (gamma + qk_eval * a_eval)
+                * (gamma_beta + tk_eval + beta * tkw_eval)
+            )
+            lookup_denominator = (gamma_beta + h1_eval + beta * h2_eval) * (
+                gamma_beta + h2_eval + beta * h1w_eval
+            )
+            R_coeff = (
+                R_coeff
+                + self.Z2_coeff * (lookup_numerator * alpha**3 + L0_ev * alpha**4)
+                - lookup_denominator * z2w_eval * alpha**3
+                - L0_ev * alpha**4
+            )
+        assert R_coeff.coeff_eval(zeta) == 0
+
+        # Aggregate every polynomial opened at ζ with powers of v, so that a
+        # single quotient proves all of their evaluations
+        opened = [
+            (self.A_coeff, a_eval),
+            (self.B_coeff, b_eval),
+            (self.C_coeff, c_eval),
+            (pk.S1_coeff, s1_eval),
+            (pk.S2_coeff, s2_eval),
+        ]
+        # z(X) is opened at ζω directly, which avoids committing to z(ωX)
+        shifted = [(self.Z_coeff, zw_eval)]
+        if custom:
+            opened += [(self.D_coeff, d_eval), (pk.S3_coeff, s3_eval)]
+        if lookups:
+            opened += [
+                (pk.QK_coeff, qk_eval),
+                (pk.TK_coeff, tk_eval),
+                (self.H1_coeff, h1_eval),
+                (self.H2_coeff, h2_eval),
+            ]
+            shifted += [
+                (self.Z2_coeff, z2w_eval),
+                (pk.TK_coeff, tkw_eval),
+                (self.H1_coeff, h1w_eval),
+            ]
+        v = self.v
+        opened_coeff, opened_eval = R_coeff, Scalar(0)
+        for i, (poly, x) in enumerate(opened, 1):
+            opened_coeff = opened_coeff + poly * v**i
+            opened_eval += x * v**i
+        # The polynomials opened at ζω are aggregated with powers of v too
+        shifted_coeff, shifted_eval = shifted[0]
+        for i, (poly, x) in enumerate(shifted[1:], 1):
+            shifted_coeff = shifted_coeff + poly * v**i
+            shifted_eval += x * v**i
+        W_zeta, W_zeta_omega = self.scheduler.open(
+            [opened_coeff, shifted_coeff],
+            [opened_eval, shifted_eval],
+            [zeta, zeta_w],
         )
 
+        log("Generated final quotient witness polynomials")
+        return Message5(W_zeta, W_zeta_omega)
+
     def rlc(self, term_1, term_2):
         return term_1 + term_2 * self.beta + self.gamma
-
-    def generate_commitment(self, coeff: Polynomial, eval: Scalar):
-        setup = self.setup
-        zeta = self.zeta
-        # Polynomial for (X - zeta)
-        ZH_zeta_coeff = Polynomial([-zeta, Scalar(1)], Basis.MONOMIAL)
-        quot_coeff = (coeff - eval) / ZH_zeta_coeff
-        # witness for polynomial itself
-        w = setup.commit(coeff)
-        # witness for quotient polynomial
-        w_quot = setup.commit(quot_coeff)
-        return w, w_quot
@@ -0,0 +1,181 @@
+from compiler.program import Program, CommonPreprocessedInput, extended_order
+from curve import Scalar, primitive_root
+from dataclasses import dataclass
+from poly import Polynomial, Basis
+from scheduler import Scheduler
+from setup import Setup
+from typing import Optional
+from verifier import VerificationKey
+
+# Polynomials of custom gates and of lookups, with the names of their
+# commitments in the verification key
+CUSTOM = {"QD": "Qd", "QL5": "Ql5", "QR5": "Qr5", "QO5": "Qo5", "S4": "S4"}
+LOOKUP = {"QK": "Qk", "TK": "Tk"}
+
+
+@dataclass
+class ProvingKey:
+    """Proving key: everything the prover needs that does not depend on the
+    witness, computed once per (Setup, Program)"""
+
+    group_order: int
+    # Number of chunks of degree < n the quotient polynomial is split into
+    quotient_chunks: int
+    # Order of the extended domain used to compute the quotient polynomial
+    extended_order: int
+    # Offset k of the coset kH the extended domain is evaluated over
+    coset_offset: Scalar
+    # Roots of unity of the group order
+    roots_of_unity: list[Scalar]
+
+    # Selector and permutation polynomials, in Lagrange form
+    QM: Polynomial
+    QL: Polynomial
+    QR: Polynomial
+    QO: Polynomial
+    QC: Polynomial
+    S1: Polynomial
+    S2: Polynomial
+    S3: Polynomial
+
+    # ... in coefficient form
+    QM_coeff: Polynomial
+    QL_coeff: Polynomial
+    QR_coeff: Polynomial
+    QO_coeff: Polynomial
+    QC_coeff: Polynomial
+    S1_coeff: Polynomial
+    S2_coeff: Polynomial
+    S3_coeff: Polynomial
+
+    # ... and evaluated over the extended coset
+    QM_big: Polynomial
+    QL_big: Polynomial
+    QR_big: Polynomial
+    QO_big: Polynomial
+    QC_big: Polynomial
+    S1_big: Polynomial
+    S2_big: Polynomial
+    S3_big: Polynomial
+    # L_0(X), X and 1 / Z_H(X) over the extended coset
+    L0_big: Polynomial
+    X_big: Polynomial
+    ZH_inv_big: Polynomial
+
+    # Commitments to the selector and permutation polynomials
+    verification_key: VerificationKey
+
+    # Custom gate selectors and the fourth permutation polynomial, in the
+    # same three forms. None for programs without custom gates
+    QD: Optional[Polynomial] = None
+    QL5: Optional[Polynomial] = None
+    QR5: Optional[Polynomial] = None
+    QO5: Optional[Polynomial] = None
+    S4: Optional[Polynomial] = None
+    QD_coeff: Optional[Polynomial] = None
+    QL5_coeff: Optional[Polynomial] = None
+    QR5_coeff: Optional[Polynomial] = None
+    QO5_coeff: Optional[Polynomial] = None
+    S4_coeff: Optional[Polynomial] = None
+    QD_big: Optional[Polynomial] = None
+    QL5_big: Optional[Polynomial] = None
+    QR5_big: Optional[Polynomial] = None
+    QO5_big: Optional[Polynomial] = None
+    S4_big: Optional[Polynomial] = None
+    # Lookup selector and table polynomials, in the same three forms. None
+    # for programs without lookups
+    QK: Optional[Polynomial] = None
+    TK: Optional[Polynomial] = None
+    QK_coeff: Optional[Polynomial] = None
+    TK_coeff: Optional[Polynomial] = None
+    QK_big: Optional[Polynomial] = None
+    TK_big: Optional[Polynomial] = None
+
+    def has_custom_gates(self) -> bool:
+        return self.QD is not None
+
+    def has_lookups(self) -> bool:
+        return self.QK is not None
+
+    @classmethod
+    def build(
+        cls, setup: Setup, program: Program, scheduler: Optional[Scheduler] = None
+    ):
+        pk = program.common_preprocessed_input()
+        return cls.from_preprocessed_input(setup, pk, scheduler)
+
+    @classmethod
+    def from_preprocessed_input(
+        cls,
+        setup: Setup,
+        pk: CommonPreprocessedInput,
+        scheduler: Optional[Scheduler] = None,
+        verification_key: Optional[VerificationKey] = None,
+    ):
+        if scheduler is None:
+            scheduler = Scheduler(setup)
+        group_order = pk.group_order
+        quotient_chunks = pk.quotient_chunks()
+        size = extended_order(group_order, quotient_chunks)
+        extension = size // group_order
+        offset = Scalar(primitive_root)
+
+        lagrange = [pk.QM, pk.QL, pk.QR, pk.QO, pk.QC, pk.S1, pk.S2, pk.S3]
+        optional = []
+        if pk.has_custom_gates():
+            optional += list(CUSTOM.items())
+        if pk.has_lookups():
+            optional += list(LOOKUP.items())
+        lagrange += [getattr(pk, name) for name, _ in optional]
+        coeffs = scheduler.ifft(lagrange)
+        bigs = scheduler.coset_extended(coeffs, offset, size)
+
+        L0_big = (
+            Polynomial([Scalar(1)] + [Scalar(0)] * (group_order - 1), Basis.LAGRANGE)
+            .ifft()
+            .to_coset_extended_lagrange(offset, size)
+        )
+        X_big = Polynomial(
+            [x * offset for x in Scalar.roots_of_unity(size)], Basis.LAGRANGE
+        )
+        # Z_H(X) = X^n - 1 only takes `extension` distinct values over the
+        # coset, so there are few inversions to do
+        ZH_inv = [
+            Scalar(1) / ((offset * root) ** group_order - 1)
+            for root in Scalar.roots_of_unity(size)[:extension]
+        ]
+        ZH_inv_big = Polynomial(
+            [ZH_inv[i % extension] for i in range(size)], Basis.LAGRANGE
+        )
+
+        # The commitments may be known already, e.g. from a compiled circuit
+        if verification_key is None:
+            commitments = scheduler.commit(coeffs)
+            verification_key = VerificationKey(
+                group_order,
+                *commitments[:8],
+                setup.X2,
+                Scalar.root_of_unity(group_order),
+                quotient_chunks,
+            )
+            for (_, vk_name), x in zip(optional, commitments[8:]):
+                setattr(verification_key, vk_name, x)
+
+        key = cls(
+            group_order,
+            quotient_chunks,
+            size,
+            offset,
+            Scalar.roots_of_unity(group_order),
+            *lagrange[:8],
+            *coeffs[:8],
+            *bigs[:8],
+            L0_big,
+            X_big,
+            ZH_inv_big,
+            verification_key,
+        )
+        for (name, _), *forms in zip(optional, lagrange[8:], coeffs[8:], bigs[8:]):
+            for suffix, x in zip(("", "_coeff", "_big"), forms):
+                setattr(key, name + suffix, x)
+        return key
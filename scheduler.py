@@ -0,0 +1,188 @@
+# Schedulers for the prover's heavy work
+#
+# Each round of the prover depends on the transcript challenges of the
+# previous one, but within a round the FFTs and MSMs are independent. The
+# prover hands them to a scheduler in batches and waits for the whole batch
+# before hashing the results, so a scheduler is free to run a batch in any
+# order or in parallel.
+import os
+import py_ecc.bn128 as b
+from curve import Scalar, G1Point, ec_lincomb
+from instrumentation import span, clear_observers
+from multiprocessing import Pool
+from poly import Polynomial, Basis
+from setup import Setup
+from typing import Optional
+
+
+# Quotient of the KZG opening of p(X) at `point`: (p(X) - eval) / (X - point)
+def opening_quotient(coeff: Polynomial, eval: Scalar, point: Scalar) -> Polynomial:
+    with span("opening_quotient", "division", size=len(coeff.values)):
+        return (coeff - eval) / Polynomial([-point, Scalar(1)], Basis.MONOMIAL)
+
+
+class Scheduler:
+    """Runs the prover's FFTs and MSMs in-process, one after the other"""
+
+    def __init__(self, setup: Setup):
+        self.setup = setup
+
+    def ifft(self, polys: list[Polynomial]) -> list[Polynomial]:
+        return [x.ifft() for x in polys]
+
+    def coset_extended(
+        self, polys: list[Polynomial], offset: Scalar, size: int
+    ) -> list[Polynomial]:
+        return [x.to_coset_extended_lagrange(offset, size) for x in polys]
+
+    def coset_to_coeffs(
+        self, polys: list[Polynomial], offset: Scalar
+    ) -> list[Polynomial]:
+        return [x.coset_extended_lagrange_to_coeffs(offset) for x in polys]
+
+    def commit(self, polys: list[Polynomial]) -> list[G1Point]:
+        return [self.setup.commit(x) for x in polys]
+
+    # Commitments to the opening quotients of each polynomial at its point
+    def open(
+        self, polys: list[Polynomial], evals: list[Scalar], points: list[Scalar]
+    ) -> list[G1Point]:
+        return self.commit(
+            [opening_quotient(p, e, z) for p, e, z in zip(polys, evals, points)]
+        )
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Polynomials and points cross process boundaries as plain ints, which
+# pickle much smaller than field elements
+def _to_ints(poly: Polynomial) -> list[int]:
+    return [x.n for x in poly.values]
+
+
+def _from_ints(values: list[int], basis: Basis) -> Polynomial:
+    return Polynomial([Scalar(x) for x in values], basis)
+
+
+def _point_to_ints(p: G1Point) -> Optional[tuple[int, int]]:
+    return None if p is None else (p[0].n, p[1].n)
+
+
+def _point_from_ints(p: Optional[tuple[int, int]]) -> G1Point:
+    return None if p is None else (b.FQ(p[0]), b.FQ(p[1]))
+
+
+# The SRS of each worker process, sent once by `_init_worker` instead of
+# with every MSM task
+_powers_of_x: list[G1Point] = []
+
+
+def _init_worker(powers_of_x: list[tuple[int, int]]):
+    global _powers_of_x
+    clear_observers()
+    _powers_of_x = [_point_from_ints(p) for p in powers_of_x]
+
+
+def _msm_task(task: tuple[int, list[int]]) -> Optional[tuple[int, int]]:
+    start, coeffs = task
+    return _point_to_ints(ec_lincomb(zip(_powers_of_x[start:], coeffs)))
+
+
+def _ifft_task(values: list[int]) -> list[int]:
+    return _to_ints(_from_ints(values, Basis.LAGRANGE).ifft())
+
+
+def _coset_extended_task(task: tuple[list[int], int, int]) -> list[int]:
+    values, offset, size = task
+    poly = _from_ints(values, Basis.MONOMIAL)
+    return _to_ints(poly.to_coset_extended_lagrange(Scalar(offset), size))
+
+
+def _coset_to_coeffs_task(task: tuple[list[int], int]) -> list[int]:
+    values, offset = task
+    poly = _from_ints(values, Basis.LAGRANGE)
+    return _to_ints(poly.coset_extended_lagrange_to_coeffs(Scalar(offset)))
+
+
+def _opening_quotient_task(task: tuple[list[int], int, int]) -> list[int]:
+    values, eval, point = task
+    poly = _from_ints(values, Basis.MONOMIAL)
+    return _to_ints(opening_quotient(poly, Scalar(eval), Scalar(point)))
+
+
+class PoolScheduler(Scheduler):
+    """Fans each batch out to a process pool. FFTs run one per task, and
+    every MSM is split into chunks of the SRS that are summed afterwards, so
+    that even a round with a single commitment uses every worker. Each batch
+    is reported as one span, as the workers do not report their own"""
+
+    def __init__(
+        self, setup: Setup, processes: Optional[int] = None, min_chunk: int = 64
+    ):
+        super().__init__(setup)
+        self.processes = processes or os.cpu_count() or 1
+        self.min_chunk = min_chunk
+        self.pool = Pool(
+            self.processes,
+            _init_worker,
+            ([_point_to_ints(p) for p in setup.powers_of_x],),
+        )
+
+    def ifft(self, polys: list[Polynomial]) -> list[Polynomial]:
+        with span("ifft", "fft", count=len(polys), processes=self.processes):
+            results = self.pool.map(_ifft_task, [_to_ints(x) for x in polys])
+            return [_from_ints(x, Basis.MONOMIAL) for x in results]
+
+    def coset_extended(
+        self, polys: list[Polynomial], offset: Scalar, size: int
+    ) -> list[Polynomial]:
+        with span("coset_fft", "fft", count=len(polys), processes=self.processes):
+            tasks = [(_to_ints(x), offset.n, size) for x in polys]
+            results = self.pool.map(_coset_extended_task, tasks)
+            return [_from_ints(x, Basis.LAGRANGE) for x in results]
+
+    def coset_to_coeffs(
+        self, polys: list[Polynomial], offset: Scalar
+    ) -> list[Polynomial]:
+        with span("coset_ifft", "fft", count=len(polys), processes=self.processes):
+            tasks = [(_to_ints(x), offset.n) for x in polys]
+            results = self.pool.map(_coset_to_coeffs_task, tasks)
+            return [_from_ints(x, Basis.MONOMIAL) for x in results]
+
+    def commit(self, polys: list[Polynomial]) -> list[G1Point]:
+        tasks = []
+        owners = []
+        for i, poly in enumerate(polys):
+            assert poly.basis == Basis.MONOMIAL
+            coeffs = _to_ints(poly)
+            if len(coeffs) > len(self.setup.powers_of_x):
+                raise Exception("Not enough powers in setup")
+            step = max(self.min_chunk, -(-len(coeffs) // self.processes))
+            for start in range(0, len(coeffs), step):
+                tasks.append((start, coeffs[start : start + step]))
+                owners.append(i)
+
+        results = [b.Z1] * len(polys)
+        with span("msm", "msm", count=len(polys), processes=self.processes):
+            for i, partial in zip(owners, self.pool.map(_msm_task, tasks)):
+                results[i] = b.add(results[i], _point_from_ints(partial))
+        return results
+
+    def open(
+        self, polys: list[Polynomial], evals: list[Scalar], points: list[Scalar]
+    ) -> list[G1Point]:
+        tasks = [(_to_ints(p), e.n, z.n) for p, e, z in zip(polys, evals, points)]
+        with span("opening_quotient", "division", count=len(polys)):
+            quotients = self.pool.map(_opening_quotient_task, tasks)
+        return self.commit([_from_ints(x, Basis.MONOMIAL) for x in quotients])
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
@@ -0,0 +1,249 @@
+# Compact binary encoding of proofs
+#
+# A proof is written as a fixed layout of 32-byte words, one per message
+# field in declaration order (Message1, ..., Message5), and one per element
+# of list fields such as the quotient chunks of Message3:
+# - G1 points are compressed to their x coordinate. BN254's base field
+#   modulus is below 2^254, so the top two bits of the word are free: bit
+#   255 flags the point at infinity and bit 254 holds the parity of y
+# - scalars are written big-endian
+#
+# The fields of custom gates (the fourth wire) and of lookups are only
+# written for proofs of programs that have them.
+#
+# Every buffer starts with a 4-byte magic, a 1-byte version, a 1-byte count
+# of quotient chunks and a 1-byte set of features (CUSTOM_GATES | LOOKUPS),
+# followed by a 4-byte big-endian proof count for bulk buffers. All the
+# proofs of a bulk buffer share the same chunk count and features, so
+# records keep a fixed size.
+#
+# The version covers the whole layout above. Buffers of any other version
+# are rejected rather than read, so a release that changes the layout
+# bumps VERSION once.
+import py_ecc.bn128 as b
+from curve import Scalar, G1Point
+from dataclasses import fields
+from typing import Iterator, Union
+from prover import Proof
+from transcript import Message1, Message2, Message3, Message4, Message5
+from verifier import (
+    CUSTOM_GATE_COMMITMENTS,
+    CUSTOM_GATE_EVALS,
+    LOOKUP_COMMITMENTS,
+    LOOKUP_EVALS,
+)
+
+MAGIC = b"BPLK"
+VERSION = 1
+WORD_SIZE = 32
+HEADER_SIZE = len(MAGIC) + 3
+COUNT_SIZE = 4
+
+INFINITY_FLAG = 1 << 255
+Y_PARITY_FLAG = 1 << 254
+FLAGS_MASK = INFINITY_FLAG | Y_PARITY_FLAG
+
+CUSTOM_GATES = 1
+LOOKUPS = 2
+# The fields that proofs only carry with custom gates or lookups
+FEATURE_FIELDS = {
+    **dict.fromkeys(CUSTOM_GATE_COMMITMENTS + CUSTOM_GATE_EVALS, CUSTOM_GATES),
+    **dict.fromkeys(LOOKUP_COMMITMENTS + LOOKUP_EVALS, LOOKUPS),
+}
+
+MESSAGES = [Message1, Message2, Message3, Message4, Message5]
+# (message index, field name, field type, is list, feature) for every field
+# of a proof, where feature is 0 for the fields of every proof. The type of
+# list and optional fields is their element type
+LAYOUT = [
+    (
+        i,
+        x.name,
+        getattr(x.type, "__args__", (x.type,))[0],
+        x.name not in FEATURE_FIELDS and hasattr(x.type, "__args__"),
+        FEATURE_FIELDS.get(x.name, 0),
+    )
+    for i, cls in enumerate(MESSAGES)
+    for x in fields(cls)
+]
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+
+def proof_size(quotient_chunks: int, features: int = 0) -> int:
+    return WORD_SIZE * sum(
+        quotient_chunks if is_list else 1
+        for *_, is_list, feature in LAYOUT
+        if feature & features == feature
+    )
+
+
+# The features of the program a proof is for, from the evaluations it carries
+# A proof has a feature if it carries any of its fields
+def _features(proof: Proof) -> int:
+    flat = proof.flatten()
+    features = 0
+    for name, feature in FEATURE_FIELDS.items():
+        if flat[name] is not None:
+            features |= feature
+    return features
+
+
+def compress_point(p: G1Point) -> bytes:
+    if p is None:
+        return INFINITY_FLAG.to_bytes(WORD_SIZE, "big")
+    x, y = p[0].n, p[1].n
+    return ((Y_PARITY_FLAG if y & 1 else 0) | x).to_bytes(WORD_SIZE, "big")
+
+
+def decompress_point(data: Buffer) -> G1Point:
+    word = int.from_bytes(data, "big")
+    if word & INFINITY_FLAG:
+        if word != INFINITY_FLAG:
+            raise Exception("Malformed point at infinity")
+        return b.Z1
+    x = word & ~FLAGS_MASK
+    if x >= b.field_modulus:
+        raise Exception("Point coordinate out of range")
+    # y^2 = x^3 + 3, and p = 3 mod 4 so the square root is a single power
+    y_squared = (pow(x, 3, b.field_modulus) + 3) % b.field_modulus
+    y = pow(y_squared, (b.field_modulus + 1) // 4, b.field_modulus)
+    if y * y % b.field_modulus != y_squared:
+        raise Exception("Point is not on the curve")
+    if (y & 1) != bool(word & Y_PARITY_FLAG):
+        y = b.field_modulus - y
+    return (b.FQ(x), b.FQ(y))
+
+
+def encode_scalar(s: Scalar) -> bytes:
+    return s.n.to_bytes(WORD_SIZE, "big")
+
+
+def decode_scalar(data: Buffer) -> Scalar:
+    n = int.from_bytes(data, "big")
+    if n >= Scalar.field_modulus:
+        raise Exception("Scalar out of range")
+    return Scalar(n)
+
+
+def _encode_value(typ, value) -> bytes:
+    return encode_scalar(value) if typ is Scalar else compress_point(value)
+
+
+def _decode_value(typ, word: memoryview):
+    return decode_scalar(word) if typ is Scalar else decompress_point(word)
+
+
+def _encode_record(proof: Proof, quotient_chunks: int, features: int, out: bytearray):
+    if len(proof.msg_3.W_t) != quotient_chunks:
+        raise Exception("Proofs have different numbers of quotient chunks")
+    if _features(proof) != features:
+        raise Exception("Proofs have different features")
+    messages = [proof.msg_1, proof.msg_2, proof.msg_3, proof.msg_4, proof.msg_5]
+    for i, name, typ, is_list, feature in LAYOUT:
+        if feature & features != feature:
+            continue
+        value = getattr(messages[i], name)
+        # Commitments may be the point at infinity, but scalars are always
+        # there, so a proof missing one cannot be read back
+        if value is None and typ is Scalar:
+            raise Exception("Proof is missing {}".format(name))
+        for x in value if is_list else [value]:
+            out += _encode_value(typ, x)
+
+
+def _decode_record(view: memoryview, quotient_chunks: int, features: int) -> Proof:
+    values = [{} for _ in MESSAGES]
+    offset = 0
+    for i, name, typ, is_list, feature in LAYOUT:
+        if feature & features != feature:
+            continue
+        items = []
+        for _ in range(quotient_chunks if is_list else 1):
+            items.append(_decode_value(typ, view[offset : offset + WORD_SIZE]))
+            offset += WORD_SIZE
+        values[i][name] = items if is_list else items[0]
+    return Proof(*(cls(**v) for cls, v in zip(MESSAGES, values)))
+
+
+def _header(quotient_chunks: int, features: int) -> bytearray:
+    out = bytearray(MAGIC)
+    out.append(VERSION)
+    out.append(quotient_chunks)
+    out.append(features)
+    return out
+
+
+# Returns the quotient chunk count and the features of the buffer
+def _check_header(view: memoryview) -> tuple[int, int]:
+    if len(view) < HEADER_SIZE or bytes(view[: len(MAGIC)]) != MAGIC:
+        raise Exception("Not a serialized proof")
+    if view[len(MAGIC)] != VERSION:
+        raise Exception("Unsupported proof version: {}".format(view[len(MAGIC)]))
+    features = view[len(MAGIC) + 2]
+    if features & ~(CUSTOM_GATES | LOOKUPS):
+        raise Exception("Unsupported proof features: {}".format(features))
+    return view[len(MAGIC) + 1], features
+
+
+def encode_proof(proof: Proof) -> bytes:
+    quotient_chunks, features = len(proof.msg_3.W_t), _features(proof)
+    out = _header(quotient_chunks, features)
+    _encode_record(proof, quotient_chunks, features, out)
+    return bytes(out)
+
+
+def decode_proof(data: Buffer) -> Proof:
+    view = memoryview(data)
+    quotient_chunks, features = _check_header(view)
+    if len(view) != HEADER_SIZE + proof_size(quotient_chunks, features):
+        raise Exception("Wrong proof length: {}".format(len(view)))
+    return _decode_record(view[HEADER_SIZE:], quotient_chunks, features)
+
+
+# Encodes many proofs of the same circuit into one buffer of fixed-size
+# records
+def encode_proofs(proofs: list[Proof]) -> bytes:
+    quotient_chunks = len(proofs[0].msg_3.W_t) if proofs else 0
+    features = _features(proofs[0]) if proofs else 0
+    out = _header(quotient_chunks, features)
+    out += len(proofs).to_bytes(COUNT_SIZE, "big")
+    for proof in proofs:
+        _encode_record(proof, quotient_chunks, features, out)
+    return bytes(out)
+
+
+# Returns the proof count, and the record layout of a bulk buffer: its
+# quotient chunk count and features
+def _bulk_header(view: memoryview) -> tuple[int, tuple[int, int]]:
+    layout = _check_header(view)
+    count = int.from_bytes(view[HEADER_SIZE : HEADER_SIZE + COUNT_SIZE], "big")
+    if len(view) != HEADER_SIZE + COUNT_SIZE + count * proof_size(*layout):
+        raise Exception("Wrong buffer length for {} proofs".format(count))
+    return count, layout
+
+
+def proof_count(data: Buffer) -> int:
+    return _bulk_header(memoryview(data))[0]
+
+
+# Decodes the i-th proof of a bulk buffer without copying the buffer
+def decode_proof_at(data: Buffer, i: int) -> Proof:
+    view = memoryview(data)
+    count, layout = _bulk_header(view)
+    if not 0 <= i < count:
+        raise IndexError("Proof index out of range")
+    size = proof_size(*layout)
+    start = HEADER_SIZE + COUNT_SIZE + i * size
+    return _decode_record(view[start : start + size], *layout)
+
+
+# Lazily decodes every proof of a bulk buffer, slicing a memoryview of it
+def decode_proofs(data: Buffer) -> Iterator[Proof]:
+    view = memoryview(data)
+    count, layout = _bulk_header(view)
+    size = proof_size(*layout)
+    start = HEADER_SIZE + COUNT_SIZE
+    for _ in range(count):
+        yield _decode_record(view[start : start + size], *layout)
+        start += size
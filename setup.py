@@ -3,8 +3,9 @@ import py_ecc.bn128 as b
 from curve import ec_lincomb, G1Point, G2Point
 from compiler.program import CommonPreprocessedInput
 from verifier import VerificationKey
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from poly import Polynomial, Basis
+from instrumentation import span, log
 
 @dataclass
 class Setup(object):
@@ -14,38 +15,44 @@ class Setup(object):
     powers_of_x: list[G1Point]
     # [x]₂ = xH, where H is a generator of G_2
     X2: G2Point
+    # Lagrange-basis SRS ([L_0(x)]₁, ..., [L_{n-1}(x)]₁) of each group order
+    # n, computed when first asked for (see `lagrange_basis`)
+    _lagrange: dict[int, list[G1Point]] = field(
+        default_factory=dict, repr=False, compare=False
+    )
 
     @classmethod
     # tau: a random number whatever you choose
     def generate_srs(cls, powers: int, tau: int):
-        print("Start to generate structured reference string")
+        with span("generate_srs", "setup", powers=powers):
+            log("Start to generate structured reference string")
 
-        # Initialize powers_of_x with 0 values
-        powers_of_x = [0] * powers
-        # powers_of_x[0] =  b.G1 * tau**0 = b.G1
-        # powers_of_x[1] =  b.G1 * tau**1 = powers_of_x[0] * tau
-        # powers_of_x[2] =  b.G1 * tau**2 = powers_of_x[1] * tau
-        # ...
-        # powers_of_x[i] =  b.G1 * tau**i = powers_of_x[i - 1] * tau
-        powers_of_x[0] = b.G1
+            # Initialize powers_of_x with 0 values
+            powers_of_x = [0] * powers
+            # powers_of_x[0] =  b.G1 * tau**0 = b.G1
+            # powers_of_x[1] =  b.G1 * tau**1 = powers_of_x[0] * tau
+            # powers_of_x[2] =  b.G1 * tau**2 = powers_of_x[1] * tau
+            # ...
+            # powers_of_x[i] =  b.G1 * tau**i = powers_of_x[i - 1] * tau
+            powers_of_x[0] = b.G1
 
-        for i in range(1, powers):
-            powers_of_x[i] = b.multiply(powers_of_x[i - 1], tau)
+            for i in range(1, powers):
+                powers_of_x[i] = b.multiply(powers_of_x[i - 1], tau)
 
-        print("Generated G1 side, X^1 point: {}".format(powers_of_x[1]))
+            log("Generated G1 side, X^1 point: {}".format(powers_of_x[1]))
 
-        X2 = b.multiply(b.G2, tau)
-        print("Generated G2 side, X^1 point: {}".format(X2))
+            X2 = b.multiply(b.G2, tau)
+            log("Generated G2 side, X^1 point: {}".format(X2))
 
-        # verify point is on the curve
-        assert b.is_on_curve(powers_of_x[1], b.b)
-        assert b.is_on_curve(X2, b.b2)
-        # check pairing
-        assert b.pairing(b.G2, powers_of_x[1]) == b.pairing(X2, b.G1)
+            # verify point is on the curve
+            assert b.is_on_curve(powers_of_x[1], b.b)
+            assert b.is_on_curve(X2, b.b2)
+            # check pairing
+            assert b.pairing(b.G2, powers_of_x[1]) == b.pairing(X2, b.G1)
 
-        print("Finished to generate structured reference string")
+            log("Finished to generate structured reference string")
 
-        return cls(powers_of_x, X2)
+            return cls(powers_of_x, X2)
 
     # Encodes the KZG commitment that evaluates to the given values in the group
     def commit(self, values: Polynomial) -> G1Point:
@@ -56,11 +63,48 @@ class Setup(object):
             coeffs = values.values
         if len(coeffs) > len(self.powers_of_x):
             raise Exception("Not enough powers in setup")
-        return ec_lincomb([(s, x) for s, x in zip(self.powers_of_x, coeffs)])
+        with span("msm", "msm", size=len(coeffs)):
+            return ec_lincomb([(s, x) for s, x in zip(self.powers_of_x, coeffs)])
+
+    # The commitments of the Lagrange polynomials of the group of order
+    # `group_order`: [L_i(x)]₁, where L_i(ω^j) = 1 if i = j and 0 otherwise.
+    # A polynomial with evaluations v_i commits to Σ v_i [L_i(x)]₁, so a
+    # change to a few evaluations changes its commitment by a small MSM.
+    #
+    # L_i(X) = (1/n) Σ_j ω^{-ij} X^j, so the basis is an inverse FFT of the
+    # powers of x, done in the group, once per group order
+    def lagrange_basis(self, group_order: int) -> list[G1Point]:
+        if group_order in self._lagrange:
+            return self._lagrange[group_order]
+        if group_order > len(self.powers_of_x):
+            raise Exception("Not enough powers in setup")
+
+        def _fft(points, roots_of_unity):
+            if len(points) == 1:
+                return points
+            L = _fft(points[::2], roots_of_unity[::2])
+            R = _fft(points[1::2], roots_of_unity[::2])
+            o = [None] * len(points)
+            for i, (x, y) in enumerate(zip(L, R)):
+                y_times_root = b.multiply(y, roots_of_unity[i])
+                o[i] = b.add(x, y_times_root)
+                o[i + len(L)] = b.add(x, b.neg(y_times_root))
+            return o
+
+        with span("lagrange_basis", "setup", size=group_order):
+            roots = [x.n for x in Scalar.roots_of_unity(group_order)]
+            reversed_roots = [roots[0]] + roots[1:][::-1]
+            invlen = (Scalar(1) / group_order).n
+            basis = [
+                b.multiply(x, invlen)
+                for x in _fft(self.powers_of_x[:group_order], reversed_roots)
+            ]
+        self._lagrange[group_order] = basis
+        return basis
 
     # Generate the verification key for this program with the given setup
     def verification_key(self, pk: CommonPreprocessedInput) -> VerificationKey:
-        return VerificationKey(
+        vk = VerificationKey(
             pk.group_order,
             self.commit(pk.QM),
             self.commit(pk.QL),
@@ -72,4 +116,15 @@ class Setup(object):
             self.commit(pk.S3),
             self.X2,
             Scalar.root_of_unity(pk.group_order),
+            pk.quotient_chunks(),
         )
+        if pk.has_custom_gates():
+            vk.Qd = self.commit(pk.QD)
+            vk.Ql5 = self.commit(pk.QL5)
+            vk.Qr5 = self.commit(pk.QR5)
+            vk.Qo5 = self.commit(pk.QO5)
+            vk.S4 = self.commit(pk.S4)
+        if pk.has_lookups():
+            vk.Qk = self.commit(pk.QK)
+            vk.Tk = self.commit(pk.TK)
+        return vk
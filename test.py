@@ -1,9 +1,11 @@
 from compiler.program import Program
 from setup import Setup
 from prover import Prover
+from proving_key import ProvingKey
 from test.mini_poseidon import rc, mds, poseidon_hash
 from utils import *
 import random
+import time
 
 # Generate a random integer between a specified range by user
 tau = random.randint(2, 100)
@@ -11,36 +13,30 @@ print("Random number tau: ", tau)
 
 def prover_test():
     print("Beginning prover test")
+    # The program picks the smallest power of two group order that fits it
+    program = Program(["e public", "c <== a * b", "e <== c * d"])
+    group_order = program.group_order
     # powers should be 2^n so that we can use roots of unity for FFT
     # and should be bigger than len(coeffs) of polynomial to do KZG commitment
-    # the value here is: powers = 4 * group_order
-    # which is bigger than the order of quotient polynomial
-    group_order = 8
-    powers = group_order * 4
+    # the value here is: powers = group_order
+    # since the quotient polynomial is committed in chunks of degree < n
+    powers = group_order
     setup = Setup.generate_srs(powers, tau)
-
-    program = Program(["e public", "c <== a * b", "e <== c * d"], group_order)
     assignments = {"a": 3, "b": 4, "c": 12, "d": 5, "e": 60}
     prover = Prover(setup, program)
     proof = prover.prove(assignments)
     print("Prover test success")
-    return setup, proof, group_order
+    return prover.pk.verification_key, proof, group_order
 
-def verifier_test(setup, proof, group_order):
+def verifier_test(vk, proof, group_order):
     print("Beginning verifier test")
-    program = Program(["e public", "c <== a * b", "e <== c * d"], group_order)
     public = [60]
-    vk = setup.verification_key(program.common_preprocessed_input())
     assert vk.verify_proof(group_order, proof, public)
     print("Verifier test success")
 
 
 def factorization_test():
     print("Beginning test: prove you know small integers that multiply to 91")
-    group_order = 16
-    powers = group_order * 4
-    setup = Setup.generate_srs(powers, tau)
-
     program = Program.from_str(
         """n public
         pb0 === pb0 * pb0
@@ -57,12 +53,14 @@ def factorization_test():
         qb01 <== qb0 + 2 * qb1
         qb012 <== qb01 + 4 * qb2
         q <== qb012 + 8 * qb3
-        n <== p * q""",
-        16,
+        n <== p * q"""
     )
+    group_order = program.group_order
+    setup = Setup.generate_srs(group_order, tau)
     public = [91]
-    vk = setup.verification_key(program.common_preprocessed_input())
-    print("Generated verification key")
+    pk = ProvingKey.build(setup, program)
+    vk = pk.verification_key
+    print("Generated proving and verification keys")
     assignments = program.fill_variable_assignments(
         {
             "pb3": 1,
@@ -75,12 +73,40 @@ def factorization_test():
             "qb0": 1,
         }
     )
-    prover = Prover(setup, program)
+    prover = Prover(setup, program, pk)
     proof = prover.prove(assignments)
     print("Generated proof")
     assert vk.verify_proof(group_order, proof, public)
     print("Factorization test success!")
 
+def byte_decomposition_test():
+    print("Beginning test: prove that a public value fits in 32 bits")
+    # Each byte is range-checked with one lookup in the table 0..255, where
+    # bit decomposition takes a `b === b * b` gate per bit and a gate per
+    # bit to recombine them. The table takes a group order of 256
+    program = Program.from_str(
+        """x public
+        b0 < 256
+        b1 < 256
+        b2 < 256
+        b3 < 256
+        x01 <== b0 + 256 * b1
+        x012 <== x01 + 65536 * b2
+        x <== x012 + 16777216 * b3"""
+    )
+    group_order = program.group_order
+    setup = Setup.generate_srs(group_order, tau)
+    value = 0xDEADBEEF
+    assignments = program.fill_variable_assignments(
+        {"b{}".format(i): value >> (8 * i) & 255 for i in range(4)}
+    )
+    pk = ProvingKey.build(setup, program)
+    proof = Prover(setup, program, pk).prove(assignments)
+    print("Generated proof with {} rows".format(program.num_constraints))
+    assert pk.verification_key.verify_proof(group_order, proof, [value])
+    print("Byte decomposition test success!")
+
+
 def output_proof_lang() -> str:
     o = []
     o.append("L0 public")
@@ -107,29 +133,77 @@ def output_proof_lang() -> str:
     return "\n".join(o)
 
 
+# Poseidon with custom gates: A{p}{x} is the state before the S-boxes of
+# round x, with its round constants added, so that each output of a round is
+# a single gate over the three previous ones
+def output_custom_proof_lang() -> str:
+    o = []
+    o.append("L0 public")
+    o.append("M0 public")
+    o.append("M64 public")
+    o.append("AL0 <== L0 + {}".format(rc[0][0].n))
+    o.append("AM0 <== M0 + {}".format(rc[0][1].n))
+    o.append("AR0 <== {}".format(rc[0][2].n))
+    for i in range(64):
+        terms = [
+            "A{}{}{}".format(pos, i, "^5" if i < 4 or i >= 60 or pos == "L" else "")
+            for pos in ("L", "M", "R")
+        ]
+        for j, pos in enumerate(("L", "M", "R")):
+            if i == 63 and pos != "M":
+                continue
+            total = " + ".join(
+                "{} * {}".format(mds[j + k].n, term) for k, term in enumerate(terms)
+            )
+            if i == 63:
+                o.append("M64 <== {}".format(total))
+            else:
+                line = "A{}{} <== {} + {}".format(pos, i + 1, total, rc[i + 1][j].n)
+                o.append(line)
+    return "\n".join(o)
+
+
 def poseidon_test():
-    # PLONK-prove the correctness of a Poseidon execution. Note that this is
-    # a very suboptimal way to do it: an optimized implementation would use
-    # a custom PLONK gate to do a round in a single gate
+    # PLONK-prove the correctness of a Poseidon execution. Each output of a
+    # round is one custom gate, which raises its inputs to the fifth power,
+    # instead of the ~16 gates per round of output_proof_lang
     expected_value = poseidon_hash(1, 2)
-    group_order = 1024
-    powers = group_order * 4
-    setup = Setup.generate_srs(powers, tau)
     # Generate code for proof
-    program = Program.from_str(output_proof_lang(), group_order)
+    program = Program.from_str(output_custom_proof_lang())
+    group_order = program.group_order
+    setup = Setup.generate_srs(group_order, tau)
     print("Generated code for Poseidon test")
     assignments = program.fill_variable_assignments({"L0": 1, "M0": 2})
-    vk = setup.verification_key(program.common_preprocessed_input())
-    print("Generated verification key")
-    prover = Prover(setup, program)
+    pk = ProvingKey.build(setup, program)
+    vk = pk.verification_key
+    print("Generated proving and verification keys")
+    prover = Prover(setup, program, pk)
     proof = prover.prove(assignments)
     print("Generated proof")
     assert vk.verify_proof(group_order, proof, [1, 2, expected_value])
     print("Verified proof!")
 
+def parser_benchmark():
+    # Parse the generated Poseidon program, whose lines mostly repeat a few
+    # templates with other variables
+    source = output_proof_lang()
+    runs = 20
+    start = time.time()
+    for _ in range(runs):
+        program = Program.from_str(source)
+    elapsed = (time.time() - start) / runs
+    lines = program.num_constraints
+    print(
+        "Parsed {} constraints in {:.1f} ms ({:.2f} us per line)".format(
+            lines, elapsed * 1e3, elapsed * 1e6 / lines
+        )
+    )
+
 if __name__ == "__main__":
-    setup, proof, group_order = prover_test()
-    verifier_test(setup, proof, group_order)
+    vk, proof, group_order = prover_test()
+    verifier_test(vk, proof, group_order)
     # comment out them if you need to test them
     # factorization_test()
+    # byte_decomposition_test()
     # poseidon_test()
+    # parser_benchmark()
@@ -0,0 +1,106 @@
+import circuit_cache
+import os
+import pytest
+from circuit_cache import CircuitCache
+from compiler.program import Program
+from prover import Prover
+from setup import Setup
+
+SOURCE = "e public\nc <== a * b\ne <== c * d - 3"
+
+
+def test_cache(tmp_path):
+    setup = Setup.generate_srs(8, 7)
+    cache = CircuitCache(str(tmp_path))
+    compiled = cache.load_str(SOURCE, 8, setup)
+    loaded = CircuitCache(str(tmp_path)).load_str(SOURCE, 8, setup)
+    assert cache.misses == 1 and len(os.listdir(tmp_path)) == 1
+    assert loaded.preprocessed == compiled.preprocessed
+    assert loaded.verification_key == compiled.verification_key
+    assert loaded.program.get_public_assignments() == ["e"]
+
+    # A loaded circuit proves without recompiling anything
+    pk = loaded.proving_key(setup)
+    witness = loaded.program.fill_witness({"a": 3, "b": 4, "d": 5})
+    proof = Prover(setup, loaded.program, pk).prove(witness)
+    assert loaded.verification_key.verify_proof(8, proof, [57])
+
+    path = tmp_path / "circuit.txt"
+    path.write_text(SOURCE)
+    assert cache.load_file(str(path), 8, setup).preprocessed == compiled.preprocessed
+    assert cache.misses == 1
+
+
+def test_hit_reads_preprocessed_input(tmp_path, monkeypatch):
+    setup = Setup.generate_srs(16, 7)
+    cache = CircuitCache(str(tmp_path))
+    # Custom gates and lookups add preprocessed polynomials of their own
+    source = SOURCE + "\nf <== a^5 + 2 * b^5 - c\nd < 16"
+    compiled = cache.load_str(source, 16, setup)
+
+    def recompute(self):
+        raise Exception("Preprocessed input recomputed")
+
+    monkeypatch.setattr(Program, "common_preprocessed_input", recompute)
+    loaded = cache.load_str(source, 16, setup)
+    assert cache.hits == 1
+    assert loaded.preprocessed == compiled.preprocessed
+    assert loaded.verification_key == compiled.verification_key
+
+
+def test_evicted_artifact_is_a_miss(tmp_path):
+    setup = Setup.generate_srs(8, 7)
+    cache = CircuitCache(str(tmp_path))
+    cache.load_str(SOURCE, 8, setup)
+    for name in os.listdir(tmp_path):
+        os.remove(tmp_path / name)
+    cache.load_str(SOURCE, 8, setup)
+    assert (cache.hits, cache.misses) == (0, 2)
+
+
+def test_eviction(tmp_path):
+    setup = Setup.generate_srs(8, 7)
+    cache = CircuitCache(str(tmp_path), max_bytes=1)
+    cache.load_str(SOURCE, 8, setup)
+    cache.load_str(SOURCE + "\nf <== e + 1", 8, setup)
+    # Only the latest artifact is kept
+    assert len(os.listdir(tmp_path)) == 1
+    cache.load_str(SOURCE + "\nf <== e + 1", 8, setup)
+    assert cache.hits == 1
+
+
+def test_shared_directory(tmp_path, monkeypatch):
+    setup = Setup.generate_srs(8, 7)
+    first = CircuitCache(str(tmp_path), max_bytes=1)
+    second = CircuitCache(str(tmp_path), max_bytes=1)
+    first.load_str(SOURCE, 8, setup)
+    # The other cache evicts the artifact of the first one
+    second.load_str(SOURCE + "\nf <== e + 1", 8, setup)
+    first.load_str(SOURCE, 8, setup)
+    assert (first.hits, first.misses, second.misses) == (0, 2, 1)
+
+    # Artifacts removed by another process while evicting are skipped,
+    # whether they are gone before they are listed or before they are removed
+    listdir, remove = os.listdir, os.remove
+
+    def concurrent_remove(path):
+        remove(path)
+        remove(path)
+
+    monkeypatch.setattr(
+        circuit_cache.os, "listdir", lambda dir: listdir(dir) + ["gone.circuit"]
+    )
+    monkeypatch.setattr(circuit_cache.os, "remove", concurrent_remove)
+    second.load_str(SOURCE + "\nf <== e + 2", 8, setup)
+    assert len(listdir(tmp_path)) == 1
+
+
+def test_failed_write(tmp_path, monkeypatch):
+    def fail(circuit):
+        raise Exception("Write failed")
+
+    monkeypatch.setattr(circuit_cache, "encode_circuit", fail)
+    with pytest.raises(Exception):
+        CircuitCache(str(tmp_path)).load_str(SOURCE, 8, Setup.generate_srs(8, 7))
+    # The temporary file is removed
+    assert os.listdir(tmp_path) == []
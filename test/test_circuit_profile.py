@@ -0,0 +1,45 @@
+import json
+from circuit_profile import estimate_costs, main, profile
+from compiler.program import Program, extended_order
+
+SOURCE = "e public\nc <== a * b\ne <== c * d - 3\nf <== c + e"
+
+
+def test_profile():
+    report = profile(Program.from_str(SOURCE, 8))
+    assert (report.gates, report.group_order, report.padding_rows) == (4, 8, 4)
+    assert report.padding_ratio == 0.5
+    assert not report.custom_gates and not report.lookups
+    # a, b, d and f are used once, c and e three times
+    assert report.fan_out == {1: 4, 3: 2}
+    assert (report.max_fan_out, report.max_fan_out_variable) == (3, "e")
+    assert report.selector_density["QM"] == 2 / 8
+    assert "QD" not in report.selector_density
+    assert [x.msm for x in report.rounds] == [
+        {8: 3},
+        {8: 1},
+        {8: 3},
+        {},
+        {7: 2},
+    ]
+    assert report.rounds[2].coset_fft == {32: 6}
+    assert report.srs_size == 8
+
+
+def test_main(tmp_path, capsys):
+    path = tmp_path / "circuit.txt"
+    path.write_text(SOURCE)
+    main([str(path), "--group-order", "8", "--json"])
+    assert json.loads(capsys.readouterr().out)["gates"] == 4
+    main([str(path), "--group-order", "8"])
+    assert "padding rows" in capsys.readouterr().out
+
+
+def test_quotient_matches_preprocessed_input():
+    for source in ["c <== a * b", "c public\nd <== a * b + c"]:
+        program = Program.from_str(source)
+        pk = program.common_preprocessed_input()
+        _, rounds = estimate_costs(program)
+        assert rounds[2].msm == {program.group_order: pk.quotient_chunks()}
+        extended = extended_order(program.group_order, pk.quotient_chunks())
+        assert extended in rounds[2].coset_fft
@@ -0,0 +1,40 @@
+import py_ecc.bn128 as b
+import pytest
+from compiler.program import Program
+from counters import OpCounter
+from curve import Scalar
+from prover import Prover
+from setup import Setup
+
+
+def test_primitives():
+    with OpCounter() as counter:
+        Scalar(3) ** 5 / Scalar(7)
+        b.multiply(b.G1, 6)
+    assert counter.counts.field_exp == 1
+    assert counter.counts.field_inv == 1
+    assert counter.counts.ec_mul == 1
+    assert counter.counts.ec_double == 2 and counter.counts.ec_add == 1
+    # The primitives are restored afterwards
+    assert "__mul__" not in Scalar.__dict__
+    assert b.multiply.__module__ == "py_ecc.bn128.bn128_curve"
+    with OpCounter(), pytest.raises(Exception):
+        with OpCounter():
+            pass
+
+
+def test_prover_report():
+    setup = Setup.generate_srs(8, 7)
+    program = Program(["e public", "c <== a * b", "e <== c * d"], 8)
+    prover = Prover(setup, program, count_ops=True)
+    proof = prover.prove(program.fill_witness({"a": 3, "b": 4, "d": 5}))
+    report = prover.op_report
+    assert report["round_1"].msm_sizes == [8, 8, 8]
+    rounds = [report["round_{}".format(i)] for i in range(1, 6)]
+    # The proof also counts the work done between rounds
+    assert sum(x.field_mul for x in rounds) <= report["prove"].field_mul
+    assert sum(len(x.msm_sizes) for x in rounds) == len(report["prove"].msm_sizes)
+    with OpCounter() as counter:
+        assert prover.pk.verification_key.verify_proof(8, proof, [60])
+    assert counter.counts.pairing == 2
+    assert counter.spans["pairing"].pairing == 2
@@ -0,0 +1,51 @@
+from circuit_cache import CompiledCircuit
+from compiler.program import Program
+from curve import Scalar, ec_lincomb
+from incremental import recompile
+from poly import Polynomial, Basis
+from prover import Prover
+from setup import Setup
+
+SOURCE = ["e public", "c <== a * b", "e <== c * d - 3", "f <== e + a"]
+
+
+def compile(setup: Setup, source: list[str]) -> CompiledCircuit:
+    program = Program(source, 8)
+    preprocessed = program.common_preprocessed_input()
+    return CompiledCircuit(
+        program, preprocessed, setup.verification_key(preprocessed)
+    )
+
+
+def test_lagrange_basis():
+    setup = Setup.generate_srs(8, 7)
+    values = [Scalar(x * x + 3) for x in range(8)]
+    assert ec_lincomb(zip(setup.lagrange_basis(8), values)) == setup.commit(
+        Polynomial(values, Basis.LAGRANGE)
+    )
+
+
+def test_recompile():
+    setup = Setup.generate_srs(8, 7)
+    circuit = compile(setup, SOURCE)
+    edits = [
+        # Changed gate, renamed variable, added and removed lines
+        SOURCE[:2] + ["e <== c + d - 3"] + SOURCE[3:],
+        SOURCE[:3] + ["g <== e + a", "f <== g * g"],
+        SOURCE[:3],
+        # New shape: custom gates are compiled from scratch
+        SOURCE + ["g <== a * b + f"],
+    ]
+    for source in edits:
+        edited = recompile(setup, circuit, Program(source, 8))
+        expected = compile(setup, source)
+        permutation = Program(source, 8).copy_permutation()
+        assert (edited.program.copy_permutation() == permutation).all()
+        assert edited.preprocessed == expected.preprocessed
+        assert edited.verification_key == expected.verification_key
+
+    edited = recompile(setup, circuit, Program(edits[0], 8))
+    witness = edited.program.fill_witness({"a": 3, "b": 4, "d": 5})
+    pk = edited.proving_key(setup)
+    proof = Prover(setup, edited.program, pk).prove(witness)
+    assert edited.verification_key.verify_proof(8, proof, [14])
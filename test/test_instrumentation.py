@@ -0,0 +1,31 @@
+from compiler.program import Program
+from instrumentation import Recorder, observing, span, _NO_SPAN
+from prover import Prover
+from setup import Setup
+
+
+def test_disabled():
+    assert span("fft", "fft", size=8) is _NO_SPAN
+
+
+def test_recorder():
+    setup = Setup.generate_srs(8, 7)
+    program = Program(["e public", "c <== a * b", "e <== c * d"], 8)
+    prover = Prover(setup, program)
+    witness = program.fill_witness({"a": 3, "b": 4, "d": 5})
+    with observing(Recorder()) as recorder:
+        proof = prover.prove(witness)
+        assert prover.pk.verification_key.verify_proof(8, proof, [60])
+
+    rounds = [x.name for x in recorder.events if x.category == "round"]
+    assert rounds == ["round_1", "round_2", "round_3", "round_4", "round_5"]
+    categories = {x.category for x in recorder.events}
+    assert {"prove", "verify", "fft", "msm", "pairing", "log"} <= categories
+    # A span is reported when it ends, after the spans nested in it
+    names = [x.name for x in recorder.events]
+    assert names.index("prove") > names.index("round_5")
+
+    trace = recorder.to_chrome_trace()["traceEvents"]
+    assert {x["ph"] for x in trace} == {"X", "i"}
+    assert recorder.totals()["prove"] >= recorder.totals()["round_3"]
+    assert span("fft", "fft") is _NO_SPAN
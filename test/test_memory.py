@@ -0,0 +1,35 @@
+from compiler.program import Program
+from curve import Scalar
+from memory import SpilledPolynomial
+from poly import Polynomial, Basis
+from prover import Prover
+from setup import Setup
+
+
+def test_spill_roundtrip(tmp_path):
+    poly = Polynomial([Scalar(x) for x in (0, 1, -1, 12345)], Basis.MONOMIAL)
+    spilled = SpilledPolynomial(poly, str(tmp_path))
+    assert spilled.load() == poly
+    spilled.close()
+
+
+def test_low_memory_prover(tmp_path):
+    setup = Setup.generate_srs(8, 7)
+    program = Program(["e public", "c <== a * b", "e <== c * d"], 8)
+    witness = program.fill_witness({"a": 3, "b": 4, "d": 5})
+    prover = Prover(setup, program)
+    proof = prover.prove(witness)
+
+    prover = Prover(
+        setup, program, prover.pk, spill_dir=str(tmp_path), report_memory=True
+    )
+    assert prover.prove(witness) == proof
+    assert [x.name for x in prover.memory_report] == [
+        "round_1",
+        "round_2",
+        "round_3",
+        "round_4",
+        "round_5",
+    ]
+    # Nothing is kept once the proof is done
+    assert prover.A_coeff is None and prover.T_chunks is None
@@ -0,0 +1,48 @@
+import pytest
+from compiler.optimizer import optimize
+from compiler.program import Program
+from prover import Prover
+from proving_key import ProvingKey
+from setup import Setup
+
+SOURCE = """e public
+x <== a + 3
+y <== a + 3
+s <== x * y
+k <== 3
+t <== s * b
+u <== t * k
+w <== a * c
+e <== u * c"""
+
+
+def test_optimize():
+    program = Program.from_str(SOURCE, 16)
+    optimized, report = optimize(program, 8)
+    # y is x, k is folded, x is merged into s and t into u, w is unused
+    assert (report.common, report.folded, report.merged, report.dead) == (1, 1, 2, 1)
+    assert optimized.num_constraints == report.gates_after == 4
+    assert optimized.get_public_assignments() == ["e"]
+
+    inputs = {"a": 2, "b": 3, "c": 4}
+    witness = optimized.fill_variable_assignments(inputs)
+    assert witness == {
+        k: v
+        for k, v in program.fill_variable_assignments(inputs).items()
+        if k in witness
+    }
+    with pytest.raises(Exception):
+        optimized.fill_variable_assignments({**inputs, "e": 1})
+
+    setup = Setup.generate_srs(8, 7)
+    pk = ProvingKey.build(setup, optimized)
+    proof = Prover(setup, optimized, pk).prove(optimized.fill_witness(inputs))
+    assert pk.verification_key.verify_proof(8, proof, [witness["e"]])
+
+
+def test_optimize_group_order():
+    program = Program.from_str(SOURCE, 16)
+    optimized, _ = optimize(program)
+    # 4 gates are left of 9, which fit a group order of 4
+    assert (program.group_order, optimized.group_order) == (16, 4)
+    assert optimize(program, 32)[0].group_order == 32
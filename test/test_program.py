@@ -0,0 +1,173 @@
+import pytest
+from compiler.assembly import GateWires, eq_to_assembly
+from compiler.program import Program
+from compiler.utils import Cell, Column
+from prover import Prover
+from proving_key import ProvingKey
+from setup import Setup
+from witness import validate_witness
+
+
+def test_copy_permutation():
+    program = Program(["e public", "c <== a * b", "e <== c * d"], 4)
+    n = program.group_order
+    sigma = program.copy_permutation()
+
+    def cell(column: Column, row: int) -> int:
+        return (column.value - 1) * n + row
+
+    # e is used at (LEFT, 0) and (OUTPUT, 2), c at (OUTPUT, 1) and (LEFT, 2)
+    assert sigma[cell(Column.OUTPUT, 2)] == cell(Column.LEFT, 0)
+    assert sigma[cell(Column.LEFT, 0)] == cell(Column.OUTPUT, 2)
+    assert sigma[cell(Column.LEFT, 2)] == cell(Column.OUTPUT, 1)
+    # a is only used once, so it is a fixed point
+    assert sigma[cell(Column.LEFT, 1)] == cell(Column.LEFT, 1)
+    assert sorted(sigma) == list(range(3 * n))
+
+    S = program.make_s_polynomials()
+    for column in Column.variants():
+        for row in range(n):
+            label = S[column].values[row]
+            before = sigma[cell(column, row)]
+            assert label == Cell(Column.variants()[before // n], before % n).label(n)
+
+
+def test_parser():
+    eqn = eq_to_assembly("d <== a * c - 45 * a + 987")
+    assert eqn.wires == GateWires("a", "c", "d")
+    assert eqn.coeffs == {"a*c": 1, "a": -45, "": 987}
+    # Products bind tighter than differences, and spaces are optional
+    assert eq_to_assembly("x<==a-2*b").coeffs == {"a": 1, "b": -2}
+    assert eq_to_assembly("x <== 3 - 5 * 2").coeffs == {"": -7}
+    assert eq_to_assembly("-r <== q * -q").coeffs == {
+        "q*q": -1,
+        "$output_coeff": -1,
+    }
+    # Lines of the same template are parsed once, with their own variables
+    assert eq_to_assembly("c <== b * a").wires == GateWires("b", "a", "c")
+    assert eq_to_assembly("z <== y * x").coeffs == {"x*y": 1}
+    for eq in ("7 === 7", "a <== b * * c", "e <== a + b * c * d", "a <== b c"):
+        with pytest.raises(Exception):
+            eq_to_assembly(eq)
+
+
+def test_streaming(tmp_path):
+    source = "n public\np <== a + 2 * b\n\n-q <== p * p - 1\nn <== p * q\n"
+    path = tmp_path / "circuit.txt"
+    path.write_text(source)
+    lines = (line for line in source.split("\n"))
+    programs = [
+        Program.from_str(source, 8),
+        Program.from_lines(lines, 8),
+        Program.from_file(str(path), 8),
+    ]
+    for program in programs:
+        assert program.num_constraints == 4
+        assert program.get_public_assignments() == ["n"]
+        assert program.selectors.C.tolist() == [0, 0, 1, 0]
+        # Rows are rebuilt from the gates with the same gate polynomials
+        assert [x.gate() for x in program.constraints] == [
+            eq_to_assembly(x).gate() for x in source.split("\n") if x
+        ]
+    with pytest.raises(Exception):
+        Program.from_lines(iter(["a <== b * c"] * 9), 8)
+    with pytest.raises(Exception):
+        Program(["a <== b * c", "a public"], 8)
+
+
+def test_custom_gates():
+    eqn = eq_to_assembly("d <== a^5 + 2 * b - c^5 + 3")
+    assert eqn.wires == GateWires("a", "b", "c", "d")
+    assert eqn.coeffs == {"a*a*a*a*a": 1, "b": 2, "c*c*c*c*c": -1, "": 3}
+    for eq in ("e <== a^3", "e <== a * b * c + d", "e <== a^5 * b"):
+        with pytest.raises(Exception):
+            eq_to_assembly(eq)
+
+    program = Program.from_str(
+        "e public\nd <== a^5 + 2 * b^5 - c\ne <== a * d + c^5", 8
+    )
+    assert program.has_custom_gates()
+    assert program.columns()[-1] == Column.FOURTH
+    assert program.common_preprocessed_input().quotient_chunks() == 5
+    inputs = {"a": 2, "b": 3, "c": 4}
+    e = program.fill_variable_assignments(inputs)["e"]
+    assert e == 2 * (2**5 + 2 * 3**5 - 4) + 4**5
+
+    setup = Setup.generate_srs(8, 7)
+    pk = ProvingKey.build(setup, program)
+    proof = Prover(setup, program, pk).prove(program.fill_witness(inputs))
+    assert pk.verification_key.verify_proof(8, proof, [e])
+    assert not pk.verification_key.verify_proof(8, proof, [e + 1])
+
+    # Without fifth powers, the highest quotient chunk is zero
+    program = Program.from_str("d public\nd <== a * b + c", 8)
+    pk = ProvingKey.build(setup, program)
+    proof = Prover(setup, program, pk).prove(program.fill_witness(inputs))
+    assert proof.msg_3.W_t[-1] is None
+    assert pk.verification_key.verify_proof(8, proof, [10])
+
+    # A fourth wire that is zero everywhere commits to the point at infinity
+    program = Program.from_str("c public\nd <== a * b + c", 8)
+    pk = ProvingKey.build(setup, program)
+    proof = Prover(setup, program, pk).prove(program.fill_witness({**inputs, "c": -6}))
+    assert proof.msg_1.d_1 is None
+    assert pk.verification_key.verify_proof(8, proof, [-6])
+    assert not pk.verification_key.verify_proof(8, proof, [-5])
+
+
+def test_lookups():
+    assert eq_to_assembly("b < 16").lookup() == 16
+    for eq in ("b < 0", "b < c", "b < 4 + 4", "16 < b"):
+        with pytest.raises(Exception):
+            eq_to_assembly(eq)
+    with pytest.raises(Exception):
+        Program(["a < 16", "b < 8"], 16)
+    with pytest.raises(Exception):
+        Program(["a < 32"], 16)
+
+    # A byte as two range-checked nibbles
+    program = Program.from_str("x public\nb0 < 16\nb1 < 16\nx <== b0 + 16 * b1", 16)
+    assert program.has_lookups() and not program.has_custom_gates()
+    assert program.lookup_table() == list(range(16))
+    witness = {None: 0, "x": 115, "b0": 3, "b1": 7}
+    assert validate_witness(program, witness) == []
+    # 115 = -205 + 16 * 20, but neither is a nibble
+    bad = {None: 0, "x": 115, "b0": -205, "b1": 20}
+    assert [(x.row, x.kind) for x in validate_witness(program, bad)] == [
+        (1, "lookup"),
+        (2, "lookup"),
+    ]
+    with pytest.raises(Exception):
+        program.fill_variable_assignments({"b0": 3, "b1": 17})
+
+    setup = Setup.generate_srs(16, 7)
+    pk = ProvingKey.build(setup, program)
+    proof = Prover(setup, program, pk).prove(witness)
+    assert pk.verification_key.verify_proof(16, proof, [115])
+    assert not pk.verification_key.verify_proof(16, proof, [116])
+
+
+def test_group_order():
+    # The smallest power of two that fits the gates, or the range table
+    program = Program(["e public", "c <== a * b", "e <== c * d - 3"])
+    assert program.group_order == 4
+    assert (program.padding_rows(), program.padding_ratio()) == (1, 0.25)
+    assert Program(["a < 16", "b <== a + 1"]).group_order == 16
+    assert Program.from_lines(iter(["a <== b * c"] * 9)).group_order == 16
+
+    # Re-targeting keeps the gates, and the witness proves either way
+    larger = program.with_group_order(16)
+    assert larger.group_order == 16 and larger.padding_rows() == 13
+    assert larger.selectors is program.selectors
+    assert larger.with_group_order().group_order == 4
+    with pytest.raises(Exception):
+        program.with_group_order(2)
+    with pytest.raises(Exception):
+        Program(["a < 16"]).with_group_order(8)
+
+    setup = Setup.generate_srs(16, 7)
+    witness = program.fill_witness({"a": 3, "b": 4, "d": 5})
+    for p in (program, larger):
+        pk = ProvingKey.build(setup, p)
+        proof = Prover(setup, p, pk).prove(witness)
+        assert pk.verification_key.verify_proof(p.group_order, proof, [57])
@@ -0,0 +1,33 @@
+import pytest
+from compiler.program import Program
+from prover import Prover
+from serialization import encode_proof
+from setup import Setup
+
+
+def test_prove_many():
+    setup = Setup.generate_srs(8, 7)
+    program = Program(["e public", "c <== a * b", "e <== c * d"], 8)
+    prover = Prover(setup, program)
+    vk = prover.pk.verification_key
+    witnesses = [{"a": a, "b": 2, "d": 5} for a in range(1, 4)]
+    proofs = list(prover.prove_many(witnesses, processes=1))
+    for a, proof in zip(range(1, 4), proofs):
+        assert vk.verify_proof(8, proof, [10 * a])
+    assert not vk.verify_proof(8, proofs[0], [20])
+
+    # Proofs are deterministic, so workers must return the same proofs in
+    # input order, with windows smaller and larger than the batch
+    expected = [encode_proof(x) for x in proofs]
+    for window in (1, 10):
+        pooled = prover.prove_many(iter(witnesses), processes=2, window=window)
+        assert [encode_proof(x) for x in pooled] == expected
+
+    # Reports are only kept for proofs made in this process
+    reporting = Prover(setup, program, prover.pk, count_ops=True)
+    assert encode_proof(next(reporting.prove_many(witnesses, processes=1))) == (
+        expected[0]
+    )
+    assert reporting.op_report
+    with pytest.raises(Exception):
+        next(reporting.prove_many(witnesses, processes=2))
@@ -0,0 +1,20 @@
+from compiler.program import Program
+from prover import Prover
+from proving_key import ProvingKey
+from scheduler import PoolScheduler
+from serialization import encode_proof
+from setup import Setup
+
+
+def test_pool_scheduler():
+    setup = Setup.generate_srs(16, 7)
+    program = Program(["e public", "c <== a * b", "d < 4", "e <== c * d - 3"], 16)
+    witness = program.fill_witness({"a": 3, "b": 4, "d": 2})
+    pk = ProvingKey.build(setup, program)
+    proof = Prover(setup, program, pk).prove(witness)
+    # Small chunks, so that every MSM is split across the workers
+    with PoolScheduler(setup, processes=2, min_chunk=4) as scheduler:
+        assert ProvingKey.build(setup, program, scheduler) == pk
+        pooled = Prover(setup, program, pk, scheduler).prove(witness)
+    assert encode_proof(pooled) == encode_proof(proof)
+    assert pk.verification_key.verify_proof(16, pooled, [21])
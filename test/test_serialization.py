@@ -0,0 +1,76 @@
+import py_ecc.bn128 as b
+import pytest
+from curve import Scalar, G1Point
+from dataclasses import fields
+from prover import Proof
+from serialization import *
+
+
+def random_proof(seed: int, quotient_chunks: int = 3, features: int = 0) -> Proof:
+    # Fill every message field with distinct points and scalars, leaving the
+    # fields of custom gates and lookups unset unless asked for
+    messages = []
+    k = seed * 1000
+    for cls in MESSAGES:
+        values = {}
+        for x in fields(cls):
+            k += 1
+            typ = x.type
+            if x.name in FEATURE_FIELDS:
+                if not features & FEATURE_FIELDS[x.name]:
+                    continue
+                typ = x.type.__args__[0]
+            if typ is Scalar:
+                values[x.name] = Scalar(k * 7919)
+            elif typ is G1Point:
+                values[x.name] = b.multiply(b.G1, k)
+            else:
+                values[x.name] = [b.multiply(b.G1, k + i) for i in range(quotient_chunks)]
+                k += quotient_chunks
+        messages.append(cls(**values))
+    return Proof(*messages)
+
+
+def test_point_compression():
+    for k in [1, 2, 3, 12345, b.curve_order - 1]:
+        p = b.multiply(b.G1, k)
+        assert decompress_point(compress_point(p)) == p
+    assert decompress_point(compress_point(b.Z1)) == b.Z1
+    with pytest.raises(Exception):
+        # x = 0 gives y^2 = 3, which is not a square
+        decompress_point(bytes(32))
+
+
+def test_proof_roundtrip():
+    proof = random_proof(1)
+    data = encode_proof(proof)
+    assert len(data) == HEADER_SIZE + proof_size(3)
+    assert decode_proof(data) == proof
+    with pytest.raises(Exception):
+        decode_proof(data[:-1])
+    # Circuits with custom gates split the quotient into more chunks, and
+    # open a fourth wire. Circuits with lookups open their polynomials too
+    for features in (CUSTOM_GATES, LOOKUPS, CUSTOM_GATES | LOOKUPS):
+        proof = random_proof(2, 5, features)
+        data = encode_proof(proof)
+        assert len(data) == HEADER_SIZE + proof_size(5, features)
+        assert decode_proof(data) == proof
+    with pytest.raises(Exception):
+        encode_proofs([random_proof(3), proof])
+    # The commitment of the fourth wire may be the point at infinity, but a
+    # proof with any field of a feature needs all of its evaluations
+    proof = random_proof(4, 5, CUSTOM_GATES)
+    proof.msg_1.d_1 = None
+    assert decode_proof(encode_proof(proof)) == proof
+    proof = random_proof(5)
+    proof.msg_1.d_1 = b.G1
+    with pytest.raises(Exception):
+        encode_proof(proof)
+
+
+def test_bulk_roundtrip():
+    proofs = [random_proof(i) for i in range(3)]
+    data = encode_proofs(proofs)
+    assert proof_count(data) == 3
+    assert list(decode_proofs(data)) == proofs
+    assert decode_proof_at(memoryview(data), 2) == proofs[2]
@@ -0,0 +1,53 @@
+import pytest
+from compiler.program import Program
+from curve import Scalar
+
+
+def program() -> Program:
+    return Program.from_str(
+        """n public
+        k === 3
+        pb0 === pb0 * pb0
+        p <== pb0 + 2 * pb1
+        q <== p * k - 1
+        -r <== q * q
+        n <== p * q""",
+        8,
+    )
+
+
+def test_fill():
+    out = program().fill_variable_assignments({"pb0": 1, "pb1": 2})
+    assert (out["k"], out["p"], out["q"], out["n"]) == (3, 5, 14, 70)
+    assert out["r"] == -196 % Scalar.field_modulus
+    assert out[None] == 0
+
+
+def test_layers():
+    tape = program().witness_tape()
+    assert [tape.variables[x] for x in tape.inputs] == ["pb0", "pb1"]
+    # k, p and the check of pb0 only depend on the inputs, q on p and k,
+    # and r and n on q
+    assert sum(len(x.out) for x in tape.layers) == 6
+    assert len(tape.layers) < 6
+
+
+def test_batch():
+    p = program()
+    witnesses = [{"pb0": i % 2, "pb1": i} for i in range(5)]
+    assert p.fill_variable_assignments_batch(witnesses) == [
+        p.fill_variable_assignments(x) for x in witnesses
+    ]
+    assert p.fill_variable_assignments_batch([]) == []
+
+
+def test_failed_assertion():
+    p = program()
+    with pytest.raises(Exception):
+        p.fill_variable_assignments({"pb0": 2, "pb1": 2})
+    with pytest.raises(Exception):
+        p.fill_variable_assignments_batch([{"pb0": 1, "pb1": 2}, {"pb0": 2, "pb1": 2}])
+    with pytest.raises(Exception):
+        p.fill_variable_assignments({"pb0": 1, "pb1": 2, "n": 71})
+    with pytest.raises(Exception):
+        p.fill_variable_assignments({"pb0": 1})
@@ -0,0 +1,72 @@
+import pytest
+from compiler.program import Program
+from dataclasses import replace
+from prover import Prover
+from setup import Setup
+
+SOURCE = ["e public", "c <== a * b", "e <== c * d"]
+
+
+@pytest.fixture(scope="module")
+def proved():
+    setup = Setup.generate_srs(8, 7)
+    program = Program(SOURCE, 8)
+    prover = Prover(setup, program)
+    proof = prover.prove(program.fill_witness({"a": 3, "b": 4, "d": 5}))
+    vk = prover.pk.verification_key
+    assert vk.verify_proof(8, proof, [60])
+    return vk, proof
+
+
+def test_public_inputs_and_commitments(proved):
+    vk, proof = proved
+    assert not vk.verify_proof(8, proof, [61])
+    assert not vk.verify_proof(8, proof, [])
+    # The round 1 commitments are reused to open a(X) and b(X)
+    msg_1 = replace(proof.msg_1, a_1=proof.msg_1.b_1, b_1=proof.msg_1.a_1)
+    assert not vk.verify_proof(8, replace(proof, msg_1=msg_1), [60])
+
+
+def test_tampered_evaluations(proved):
+    # r(X) is built from the evaluations, so changing any one of them breaks
+    # the opening at ζ
+    vk, proof = proved
+    for name in ("a_eval", "b_eval", "c_eval", "s1_eval", "s2_eval", "zw_eval"):
+        msg_4 = replace(proof.msg_4, **{name: getattr(proof.msg_4, name) + 1})
+        assert not vk.verify_proof(8, replace(proof, msg_4=msg_4), [60]), name
+
+
+def test_swapped_openings(proved):
+    vk, proof = proved
+    msg_5 = replace(
+        proof.msg_5,
+        W_zeta=proof.msg_5.W_zeta_omega,
+        W_zeta_omega=proof.msg_5.W_zeta,
+    )
+    assert not vk.verify_proof(8, replace(proof, msg_5=msg_5), [60])
+
+
+def test_quotient_chunks(proved):
+    # The quotient is committed in exactly `quotient_chunks` chunks
+    vk, proof = proved
+    W_t = proof.msg_3.W_t
+    for chunks in (W_t[:-1], W_t + [W_t[0]], W_t[::-1]):
+        msg_3 = replace(proof.msg_3, W_t=chunks)
+        assert not vk.verify_proof(8, replace(proof, msg_3=msg_3), [60])
+
+
+def test_unexpected_fields(proved):
+    # The circuit has neither custom gates nor lookups, so a proof carrying
+    # any of their fields is rejected, even if they are left out of the
+    # transcript
+    vk, proof = proved
+    point, scalar = proof.msg_1.a_1, proof.msg_4.a_eval
+    for msg, name, value in (
+        ("msg_1", "d_1", point),
+        ("msg_1", "h1_1", point),
+        ("msg_2", "z2_1", point),
+        ("msg_4", "d_eval", scalar),
+        ("msg_4", "qk_eval", scalar),
+    ):
+        tampered = replace(getattr(proof, msg), **{name: value})
+        assert not vk.verify_proof(8, replace(proof, **{msg: tampered}), [60]), name
@@ -0,0 +1,95 @@
+import json
+import pytest
+from compiler.program import Program
+from prover import Proof, Prover
+from serialization import encode_proof
+from setup import Setup
+from utils import interpret_json_point
+from verifier import VerificationKey
+from verify_service import main, verify_stream
+
+SOURCE = ["e public", "c <== a * b", "e <== c * d"]
+
+
+@pytest.fixture(scope="module")
+def proved():
+    setup = Setup.generate_srs(8, 7)
+    program = Program(SOURCE, 8)
+    prover = Prover(setup, program)
+    proof = prover.prove(program.fill_witness({"a": 3, "b": 4, "d": 5}))
+    return prover.pk.verification_key, proof
+
+
+def test_json_round_trip(proved):
+    vk, proof = proved
+    data = json.loads(json.dumps(vk.to_json()))
+    assert VerificationKey.from_json(data) == vk
+    assert Proof.from_json(json.loads(json.dumps(proof.to_json()))) == proof
+    # Points off the curve or with coordinates out of range are rejected
+    x, y, _ = proof.to_json()["msg_1"]["a_1"]
+    with pytest.raises(Exception):
+        interpret_json_point([x, str(int(y) + 1), "1"])
+    with pytest.raises(Exception):
+        interpret_json_point(["0", str(2**256), "1"])
+
+
+def test_verify_stream(proved):
+    vk, proof = proved
+    bad_point = proof.to_json()
+    x, y, _ = bad_point["msg_1"]["a_1"]
+    bad_point["msg_1"]["a_1"] = [x, str(int(y) + 1), "1"]
+    requests = [
+        {"id": "json", "proof": proof.to_json(), "public": [60]},
+        {"id": "hex", "proof": encode_proof(proof).hex(), "public": [60]},
+        {"id": "public", "proof": proof.to_json(), "public": [61]},
+        {"id": "point", "proof": bad_point, "public": [60]},
+        {"id": "hex_garbage", "proof": "00ff", "public": [60]},
+    ]
+    lines = [json.dumps(x) for x in requests] + ["", "not json"]
+    verdicts = list(verify_stream(vk, lines, processes=2, chunksize=2, window=1))
+    assert [(x["id"], x["valid"]) for x in verdicts] == [
+        ("json", True),
+        ("hex", True),
+        ("public", False),
+        ("point", False),
+        ("hex_garbage", False),
+        (6, False),
+    ]
+    assert [x["error"] is not None for x in verdicts] == [False] * 3 + [True] * 3
+
+
+def test_bounded_read_ahead(proved):
+    vk, proof = proved
+    line = json.dumps({"proof": encode_proof(proof).hex(), "public": [60]})
+    read = []
+
+    def lines():
+        for i in range(8):
+            read.append(i)
+            yield line
+
+    verdicts = verify_stream(vk, lines(), processes=1, chunksize=2, window=2)
+    assert next(verdicts)["valid"]
+    # Two chunks of two lines in flight, and one more line to find the end
+    # of the next chunk
+    assert len(read) <= 5
+    assert all(x["valid"] for x in verdicts) and len(read) == 8
+
+
+def test_main(proved, tmp_path, capsys):
+    vk, proof = proved
+    (tmp_path / "vk.json").write_text(json.dumps(vk.to_json()))
+    (tmp_path / "proofs.jsonl").write_text(
+        json.dumps({"id": 1, "proof": proof.to_json(), "public": [60]}) + "\n"
+    )
+    main(
+        [
+            "--vk",
+            str(tmp_path / "vk.json"),
+            "--input",
+            str(tmp_path / "proofs.jsonl"),
+            "--processes",
+            "1",
+        ]
+    )
+    assert json.loads(capsys.readouterr().out)["valid"]
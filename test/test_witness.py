@@ -0,0 +1,34 @@
+from compiler.program import Program
+from compiler.utils import Column
+from curve import Scalar
+from witness import *
+
+
+def program() -> Program:
+    return Program(["e public", "c <== a * b", "e <== c * d"], 8)
+
+
+def test_valid_witness():
+    p = program()
+    witness = p.fill_variable_assignments({"a": 3, "b": 4, "d": 5})
+    assert validate_witness(p, witness) == []
+
+
+def test_gate_failure():
+    p = program()
+    witness = p.fill_variable_assignments({"a": 3, "b": 4, "d": 5})
+    witness["c"] = 13
+    failures = validate_witness(p, witness)
+    assert [(x.row, x.kind) for x in failures] == [(1, "gate"), (2, "gate")]
+    assert failures[0].eqn is p.constraints[1]
+
+
+def test_copy_failure():
+    p = program()
+    witness = p.fill_witness({"a": 3, "b": 4, "d": 5})
+    A, B, C = wire_values(p, witness)
+    # c is the output of row 1 and the left input of row 2
+    A[2] = Scalar(13)
+    failures = validate_wires(p, A, B, C, public_values(p, witness))
+    assert (2, "copy", Column.LEFT) in [(x.row, x.kind, x.column) for x in failures]
+    assert (1, "copy", Column.OUTPUT) in [(x.row, x.kind, x.column) for x in failures]
@@ -3,6 +3,7 @@ from curve import G1Point
 from merlin.merlin_transcript import MerlinTranscript
 from py_ecc.secp256k1.secp256k1 import bytes_to_int
 from dataclasses import dataclass
+from typing import Optional
 
 
 @dataclass
@@ -13,18 +14,28 @@ class Message1:
     b_1: G1Point
     # [c(x)]₁ (commitment to output wire polynomial)
     c_1: G1Point
+    # [d(x)]₁ (commitment to fourth wire polynomial), with custom gates only
+    d_1: Optional[G1Point] = None
+    # [h1(x)]₁, [h2(x)]₁ (commitments to the halves of the sorted vector of
+    # the lookups and the table), with lookups only
+    h1_1: Optional[G1Point] = None
+    h2_1: Optional[G1Point] = None
 
 
 @dataclass
 class Message2:
     # [z(x)]₁ (commitment to permutation polynomial)
     z_1: G1Point
+    # [z2(x)]₁ (commitment to the lookup accumulator polynomial), with
+    # lookups only
+    z2_1: Optional[G1Point] = None
 
 
 @dataclass
 class Message3:
-    # [quot(x)]₁ (commitment to the quotient polynomial t(X))
-    W_t: G1Point
+    # [t_lo(x)]₁, [t_mid(x)]₁, [t_hi(x)]₁ (commitments to the chunks of degree
+    # < n of the quotient polynomial t(X) = t_lo(X) + X^n t_mid(X) + X^2n t_hi(X))
+    W_t: list[G1Point]
 
 
 @dataclass
@@ -35,71 +46,61 @@ class Message4:
     b_eval: Scalar
     # Evaluation of c(X) at evaluation challenge ζ
     c_eval: Scalar
-    # Evaluation of QL(X) at evaluation challenge ζ
-    ql_eval: Scalar
-    # Evaluation of QR(X) at evaluation challenge ζ
-    qr_eval: Scalar
-    # Evaluation of QM(X) at evaluation challenge ζ
-    qm_eval: Scalar
-    # Evaluation of QO(X) at evaluation challenge ζ
-    qo_eval: Scalar
-    # Evaluation of QC(X) at evaluation challenge ζ
-    qc_eval: Scalar
     # Evaluation of the first permutation polynomial S_σ1(X) at evaluation challenge ζ
     s1_eval: Scalar
     # Evaluation of the second permutation polynomial S_σ2(X) at evaluation challenge ζ
     s2_eval: Scalar
-    # Evaluation of the second permutation polynomial S_σ3(X) at evaluation challenge ζ
-    s3_eval: Scalar
-    # Evaluation of the permutation polynomial z(X) at the evaluation challenge ζ
-    z_eval: Scalar
     # Evaluation of the shifted permutation polynomial z(X) at the shifted evaluation challenge ζω
     zw_eval: Scalar
-    # Evaluation of Quotient Polynomial Quot(X) at evaluation challenge ζ
-    t_eval: Scalar
+    # With custom gates only: evaluations of d(X) and of the third permutation
+    # polynomial S_σ3(X) at ζ, as S_σ4(X) takes the place of S_σ3(X) in r(X)
+    d_eval: Optional[Scalar] = None
+    s3_eval: Optional[Scalar] = None
+    # With lookups only: evaluations of q_K(X), t(X), h1(X) and h2(X) at ζ,
+    # and of t(X), h1(X) and z2(X) at ζω
+    qk_eval: Optional[Scalar] = None
+    tk_eval: Optional[Scalar] = None
+    h1_eval: Optional[Scalar] = None
+    h2_eval: Optional[Scalar] = None
+    tkw_eval: Optional[Scalar] = None
+    h1w_eval: Optional[Scalar] = None
+    z2w_eval: Optional[Scalar] = None
 
 
 @dataclass
 class Message5:
-    # (commitment to the opening proof polynomial)
-    W_a: G1Point
-    W_a_quot: G1Point
-    W_b: G1Point
-    W_b_quot: G1Point
-    W_c: G1Point
-    W_c_quot: G1Point
-    W_ql: G1Point
-    W_ql_quot: G1Point
-    W_qr: G1Point
-    W_qr_quot: G1Point
-    W_qm: G1Point
-    W_qm_quot: G1Point
-    W_qo: G1Point
-    W_qo_quot: G1Point
-    W_qc: G1Point
-    W_qc_quot: G1Point
-    W_s1: G1Point
-    W_s1_quot: G1Point
-    W_s2: G1Point
-    W_s2_quot: G1Point
-    W_s3: G1Point
-    W_s3_quot: G1Point
-    W_z: G1Point
-    W_z_quot: G1Point
-    W_zw: G1Point
-    W_zw_quot: G1Point
-    W_t: G1Point
-    W_t_quot: G1Point
+    # [W_ζ(x)]₁ (commitment to the opening proof polynomial of r(X), a(X),
+    # b(X), c(X), S_σ1(X) and S_σ2(X), and d(X) and S_σ3(X) with custom
+    # gates, and q_K(X), t(X), h1(X) and h2(X) with lookups, at ζ, aggregated
+    # with powers of v)
+    W_zeta: G1Point
+    # [W_ζω(x)]₁ (commitment to the opening proof polynomial of z(X), and
+    # z2(X), t(X) and h1(X) with lookups, at ζω, aggregated with powers of v)
+    W_zeta_omega: G1Point
 
 # https://merlin.cool/
+#
+# Which optional fields are absorbed is fixed by the circuit (the proving or
+# verification key), not by the proof: a proof carrying fields its circuit
+# does not call for is rejected by the verifier, and a field it calls for
+# that is None, the point at infinity, is absorbed as such
 class Transcript(MerlinTranscript):
+    def __init__(self, label: bytes, custom_gates: bool = False, lookups: bool = False):
+        super().__init__(label)
+        self.custom_gates = custom_gates
+        self.lookups = lookups
+
     def append(self, label: bytes, item: bytes) -> None:
         self.append_message(label, item)
 
     def append_scalar(self, label: bytes, item: Scalar):
         self.append_message(label, item.n.to_bytes(32, "big"))
 
+    # The point at infinity (None), e.g. the commitment of a zero quotient
+    # chunk, is appended as (0, 0), which is not on the curve
     def append_point(self, label: bytes, item: G1Point):
+        if item is None:
+            item = (Scalar(0), Scalar(0))
         self.append_message(label, item[0].n.to_bytes(32, "big"))
         self.append_message(label, item[1].n.to_bytes(32, "big"))
 
@@ -115,6 +116,11 @@ class Transcript(MerlinTranscript):
         self.append_point(b"a_1", message.a_1)
         self.append_point(b"b_1", message.b_1)
         self.append_point(b"c_1", message.c_1)
+        if self.custom_gates:
+            self.append_point(b"d_1", message.d_1)
+        if self.lookups:
+            self.append_point(b"h1_1", message.h1_1)
+            self.append_point(b"h2_1", message.h2_1)
 
         # The first two Fiat-Shamir challenges
         beta = self.get_and_append_challenge(b"beta")
@@ -124,13 +130,45 @@ class Transcript(MerlinTranscript):
 
     def round_2(self, message: Message2) -> tuple[Scalar, Scalar]:
         self.append_point(b"z_1", message.z_1)
+        if self.lookups:
+            self.append_point(b"z2_1", message.z2_1)
 
         alpha = self.get_and_append_challenge(b"alpha")
 
         return alpha
 
     def round_3(self, message: Message3) -> Scalar:
-        self.append_point(b"W_t", message.W_t)
+        for W_t_chunk in message.W_t:
+            self.append_point(b"W_t", W_t_chunk)
 
         zeta = self.get_and_append_challenge(b"zeta")
         return zeta
+
+    def round_4(self, message: Message4) -> Scalar:
+        self.append_scalar(b"a_eval", message.a_eval)
+        self.append_scalar(b"b_eval", message.b_eval)
+        self.append_scalar(b"c_eval", message.c_eval)
+        self.append_scalar(b"s1_eval", message.s1_eval)
+        self.append_scalar(b"s2_eval", message.s2_eval)
+        self.append_scalar(b"zw_eval", message.zw_eval)
+        if self.custom_gates:
+            self.append_scalar(b"d_eval", message.d_eval)
+            self.append_scalar(b"s3_eval", message.s3_eval)
+        if self.lookups:
+            self.append_scalar(b"qk_eval", message.qk_eval)
+            self.append_scalar(b"tk_eval", message.tk_eval)
+            self.append_scalar(b"h1_eval", message.h1_eval)
+            self.append_scalar(b"h2_eval", message.h2_eval)
+            self.append_scalar(b"tkw_eval", message.tkw_eval)
+            self.append_scalar(b"h1w_eval", message.h1w_eval)
+            self.append_scalar(b"z2w_eval", message.z2w_eval)
+
+        v = self.get_and_append_challenge(b"v")
+        return v
+
+    def round_5(self, message: Message5) -> Scalar:
+        self.append_point(b"W_zeta", message.W_zeta)
+        self.append_point(b"W_zeta_omega", message.W_zeta_omega)
+
+        u = self.get_and_append_challenge(b"u")
+        return u
@@ -1,22 +1,105 @@
 import py_ecc.bn128 as b
 from curve import Scalar
+from dataclasses import fields
+from typing import Union, get_args, get_origin
 
 f = b.FQ
 f2 = b.FQ2
 
 primitive_root = 5
 
-# Extracts a point from JSON in zkrepl's format
+# Extracts a point from JSON in zkrepl's format. Coordinates must be field
+# elements and the point on the curve, as in `serialization.decompress_point`
 def interpret_json_point(p):
     if len(p) == 3 and isinstance(p[0], str) and p[2] == "1":
-        return (f(int(p[0])), f(int(p[1])))
+        point = (f(_coordinate(p[0])), f(_coordinate(p[1])))
+        if not b.is_on_curve(point, b.b):
+            raise Exception("Point is not on the curve")
+        return point
     elif len(p) == 3 and p == ["0", "1", "0"]:
         return b.Z1
     elif len(p) == 3 and isinstance(p[0], list) and p[2] == ["1", "0"]:
-        return (
-            f2([int(p[0][0]), int(p[0][1])]),
-            f2([int(p[1][0]), int(p[1][1])]),
+        point = (
+            f2([_coordinate(p[0][0]), _coordinate(p[0][1])]),
+            f2([_coordinate(p[1][0]), _coordinate(p[1][1])]),
         )
+        if not b.is_on_curve(point, b.b2):
+            raise Exception("Point is not on the curve")
+        return point
     elif len(p) == 3 and p == [["0", "0"], ["1", "0"], ["0", "0"]]:
         return b.Z2
     raise Exception("cannot interpret that point: {}".format(p))
+
+
+def _coordinate(x: str) -> int:
+    n = int(x)
+    if not 0 <= n < b.field_modulus:
+        raise Exception("Point coordinate out of range")
+    return n
+
+
+# Encodes a point in zkrepl's JSON format, the inverse of interpret_json_point.
+# Note that py_ecc represents the point at infinity of both groups as None,
+# so it is always written in the G1 form
+def serialize_json_point(p):
+    if p is None:
+        return ["0", "1", "0"]
+    elif isinstance(p[0], f):
+        return [str(p[0].n), str(p[1].n), "1"]
+    elif isinstance(p[0], f2):
+        return [
+            [str(int(p[0].coeffs[0])), str(int(p[0].coeffs[1]))],
+            [str(int(p[1].coeffs[0])), str(int(p[1].coeffs[1]))],
+            ["1", "0"],
+        ]
+    raise Exception("cannot serialize that point: {}".format(p))
+
+
+# JSON encoding of the values held in proof messages and verification keys:
+# scalars as decimal strings, points in zkrepl's format, and lists of them
+# (the quotient chunks) as arrays
+def value_to_json(value):
+    if isinstance(value, Scalar):
+        return str(value.n)
+    elif isinstance(value, int):
+        return value
+    elif isinstance(value, list):
+        return [value_to_json(x) for x in value]
+    return serialize_json_point(value)
+
+
+def value_from_json(typ, data):
+    if typ is Scalar:
+        return Scalar(int(data))
+    elif typ is int:
+        return int(data)
+    elif get_origin(typ) is list:
+        return [value_from_json(get_args(typ)[0], x) for x in data]
+    return interpret_json_point(data)
+
+
+# Fields that default to None, such as those of custom gates, are left out
+# while None, and take their default when read back. Required fields may
+# also be None, for the point at infinity
+def dataclass_to_json(obj) -> dict:
+    return {
+        x.name: value_to_json(getattr(obj, x.name))
+        for x in fields(obj)
+        if getattr(obj, x.name) is not None or x.default is not None
+    }
+
+
+def dataclass_from_json(cls, data: dict):
+    return cls(
+        **{
+            x.name: value_from_json(_optional_type(x.type), data[x.name])
+            for x in fields(cls)
+            if x.name in data
+        }
+    )
+
+
+# The type of an Optional type's values
+def _optional_type(typ):
+    args = [x for x in get_args(typ) if x is not type(None)]
+    return args[0] if get_origin(typ) is Union and len(args) == 1 else typ
@@ -4,6 +4,25 @@ from dataclasses import dataclass
 from curve import *
 from transcript import Transcript
 from poly import Polynomial, Basis
+from instrumentation import span, log
+from typing import Optional
+
+
+# Commitments and evaluations that proofs of programs with custom gates
+# carry. A commitment may be None, the point at infinity
+CUSTOM_GATE_COMMITMENTS = ["d_1"]
+CUSTOM_GATE_EVALS = ["d_eval", "s3_eval"]
+# Commitments and evaluations that proofs of programs with lookups carry
+LOOKUP_COMMITMENTS = ["h1_1", "h2_1", "z2_1"]
+LOOKUP_EVALS = [
+    "qk_eval",
+    "tk_eval",
+    "h1_eval",
+    "h2_eval",
+    "tkw_eval",
+    "h1w_eval",
+    "z2w_eval",
+]
 
 
 @dataclass
@@ -32,15 +51,66 @@ class VerificationKey:
     X_2: G2Point
     # nth root of unity, where n is the program's group order.
     w: Scalar
+    # Number of chunks the quotient polynomial is split into
+    quotient_chunks: int
+    # Commitments of custom gates, None for programs without them:
+    # [q_D(x)]₁, [q_L5(x)]₁, [q_R5(x)]₁, [q_O5(x)]₁ (custom gate selectors)
+    Qd: Optional[G1Point] = None
+    Ql5: Optional[G1Point] = None
+    Qr5: Optional[G1Point] = None
+    Qo5: Optional[G1Point] = None
+    # [S_σ4(x)]₁ (commitment to the fourth permutation polynomial S_σ4(X))
+    S4: Optional[G1Point] = None
+    # Commitments of lookups, None for programs without them:
+    # [q_K(x)]₁ (commitment to the lookup selector polynomial)
+    Qk: Optional[G1Point] = None
+    # [t(x)]₁ (commitment to the table polynomial)
+    Tk: Optional[G1Point] = None
+
+    def has_custom_gates(self) -> bool:
+        return self.Qd is not None
+
+    def has_lookups(self) -> bool:
+        return self.Qk is not None
+
+    def to_json(self) -> dict:
+        return dataclass_to_json(self)
+
+    @classmethod
+    def from_json(cls, data: dict):
+        return dataclass_from_json(cls, data)
 
     # More optimized version that tries hard to minimize pairings and
     # elliptic curve multiplications, but at the cost of being harder
     # to understand and mixing together a lot of the computations to
     # efficiently batch them
+    #
+    # Returns False (rather than raising) if any check fails
     def verify_proof(self, group_order: int, pf, public=[]) -> bool:
-        # Compute challenges
-        beta, gamma, alpha, zeta = self.compute_challenges(pf)
+        with span("verify", "verify", group_order=group_order):
+            return self._verify_proof(group_order, pf, public)
+
+    def _verify_proof(self, group_order: int, pf, public: list[int]) -> bool:
         proof = pf.flatten()
+        if len(proof["W_t"]) != self.quotient_chunks:
+            return False
+        # Proofs carry the fields of custom gates (the fourth wire) and of
+        # lookups exactly when the circuit has them. The commitments may be
+        # None, the point at infinity, but the evaluations are always there
+        custom = self.has_custom_gates()
+        lookups = self.has_lookups()
+        for enabled, commitments, evals in (
+            (custom, CUSTOM_GATE_COMMITMENTS, CUSTOM_GATE_EVALS),
+            (lookups, LOOKUP_COMMITMENTS, LOOKUP_EVALS),
+        ):
+            if any((proof[x] is not None) != enabled for x in evals):
+                return False
+            if not enabled and any(proof[x] is not None for x in commitments):
+                return False
+
+        # Compute challenges
+        with span("transcript", "transcript"):
+            beta, gamma, alpha, zeta, v, u = self.compute_challenges(pf)
 
         # Compute zero polynomial evaluation Z_H(ζ) = ζ^n - 1
         ZH_ev = zeta**group_order - 1
@@ -56,96 +126,158 @@ class VerificationKey:
         )
         PI_ev = PI.barycentric_eval(zeta)
 
-        # Verify KZG10 commitment
-        self.verify_commitment(proof, proof["W_a"], "W_a_quot", "a_eval", zeta)
-        self.verify_commitment(proof, proof["W_b"], "W_b_quot", "b_eval", zeta)
-        self.verify_commitment(proof, proof["W_c"], "W_c_quot", "c_eval", zeta)
-        self.verify_commitment(proof, proof["W_z"], "W_z_quot", "z_eval", zeta)
-        self.verify_commitment(proof, proof["W_zw"], "W_zw_quot", "zw_eval", zeta)
-        self.verify_commitment(proof, proof["W_t"], "W_t_quot", "t_eval", zeta)
-        self.verify_commitment(proof, self.Ql, "W_ql_quot", "ql_eval", zeta)
-        self.verify_commitment(proof, self.Qr, "W_qr_quot", "qr_eval", zeta)
-        self.verify_commitment(proof, self.Qm, "W_qm_quot", "qm_eval", zeta)
-        self.verify_commitment(proof, self.Qo, "W_qo_quot", "qo_eval", zeta)
-        self.verify_commitment(proof, self.Qc, "W_qc_quot", "qc_eval", zeta)
-        self.verify_commitment(proof, self.S1, "W_s1_quot", "s1_eval", zeta)
-        self.verify_commitment(proof, self.S2, "W_s2_quot", "s2_eval", zeta)
-        self.verify_commitment(proof, self.S3, "W_s3_quot", "s3_eval", zeta)
-
-        # Verify constraints and permutation
         a_eval = proof["a_eval"]
         b_eval = proof["b_eval"]
         c_eval = proof["c_eval"]
-        ql_eval = proof["ql_eval"]
-        qr_eval = proof["qr_eval"]
-        qm_eval = proof["qm_eval"]
-        qo_eval = proof["qo_eval"]
-        qc_eval = proof["qc_eval"]
         s1_eval = proof["s1_eval"]
         s2_eval = proof["s2_eval"]
-        s3_eval = proof["s3_eval"]
-        z_eval = proof["z_eval"]
         zw_eval = proof["zw_eval"]
-        t_eval = proof["t_eval"]
 
+        # Compute the commitment to the linearization polynomial r(X) as a
+        # combination of the verification key and the proof commitments.
+        # The quotient chunks are recombined with powers of ζ^n, and the
+        # constant term of r(X) is committed as a multiple of [1]₁
         f_eval = (
             (a_eval + beta * zeta + gamma)
             * (b_eval + beta * zeta * 2 + gamma)
             * (c_eval + beta * zeta * 3 + gamma)
         )
-        g_eval = (
-            (a_eval + beta * s1_eval + gamma)
-            * (b_eval + beta * s2_eval + gamma)
-            * (c_eval + beta * s3_eval + gamma)
+        g_partial_eval = (a_eval + beta * s1_eval + gamma) * (
+            b_eval + beta * s2_eval + gamma
         )
-
-        gate_constraints_eval = (
-            ql_eval * a_eval
-            + qr_eval * b_eval
-            + qm_eval * a_eval * b_eval
-            + qo_eval * c_eval
-            + qc_eval
-            + PI_ev
+        # The permutation polynomial of the last wire enters r(X) linearly.
+        # With custom gates, that is S_σ4(X) for the fourth wire
+        last_eval, S_last = c_eval, self.S3
+        custom_terms = []
+        if custom:
+            d_eval, s3_eval = proof["d_eval"], proof["s3_eval"]
+            f_eval *= d_eval + beta * zeta * 4 + gamma
+            g_partial_eval *= c_eval + beta * s3_eval + gamma
+            last_eval, S_last = d_eval, self.S4
+            custom_terms = [
+                (self.Qd, d_eval),
+                (self.Ql5, a_eval**5),
+                (self.Qr5, b_eval**5),
+                (self.Qo5, c_eval**5),
+            ]
+        R_1 = ec_lincomb(
+            [
+                (self.Qm, a_eval * b_eval),
+                (self.Ql, a_eval),
+                (self.Qr, b_eval),
+                (self.Qo, c_eval),
+                (self.Qc, 1),
+                *custom_terms,
+                (proof["z_1"], alpha * f_eval + alpha**2 * L0_ev),
+                (S_last, -alpha * g_partial_eval * zw_eval * beta),
+                *[
+                    (W_t_chunk, -ZH_ev * zeta ** (group_order * i))
+                    for i, W_t_chunk in enumerate(proof["W_t"])
+                ],
+                (
+                    b.G1,
+                    PI_ev
+                    - alpha * g_partial_eval * zw_eval * (last_eval + gamma)
+                    - alpha**2 * L0_ev,
+                ),
+            ]
         )
+        # Lookups add the lookup grand product, with z2(X) linear and every
+        # other polynomial evaluated, times α³, and (z2(X) - 1) L_0(ζ) α⁴
+        if lookups:
+            qk_eval, tk_eval, h1_eval, h2_eval, tkw_eval, h1w_eval, z2w_eval = (
+                proof[x] for x in LOOKUP_EVALS
+            )
+            gamma_beta = gamma * (beta + 1)
+            lookup_numerator = (
+                (beta + 1)
+                * (gamma + qk_eval * a_eval)
+                * (gamma_beta + tk_eval + beta * tkw_eval)
+            )
+            lookup_denominator = (gamma_beta + h1_eval + beta * h2_eval) * (
+                gamma_beta + h2_eval + beta * h1w_eval
+            )
+            R_1 = ec_lincomb(
+                [
+                    (R_1, 1),
+                    (proof["z2_1"], alpha**3 * lookup_numerator + alpha**4 * L0_ev),
+                    (
+                        b.G1,
+                        -alpha**3 * lookup_denominator * z2w_eval - alpha**4 * L0_ev,
+                    ),
+                ]
+            )
 
-        permutation_grand_product_eval = z_eval * f_eval - zw_eval * g_eval
-
-        permutation_first_row_eval = L0_ev * (z_eval - 1)
-
-        left = (
-            gate_constraints_eval
-            + alpha * permutation_grand_product_eval
-            +  alpha ** 2 * permutation_first_row_eval
+        # Verify KZG10 commitment
+        # Batch the two openings with the challenge u:
+        # - W_ζ opens r(X) + v a(X) + v² b(X) + v³ c(X) + v⁴ S_σ1(X) + v⁵ S_σ2(X)
+        #   at ζ to v a̅ + v² b̅ + v³ c̅ + v⁴ s̅_σ1 + v⁵ s̅_σ2 (r(ζ) = 0 proves
+        #   that all constraints hold at ζ), plus v⁶ d(X) + v⁷ S_σ3(X) with
+        #   custom gates
+        #   and q_K(X), t(X), h1(X), h2(X) with lookups
+        # - W_ζω opens z(X) at ζω to z̅ω, plus v z2(X) + v² t(X) + v³ h1(X) with
+        #   lookups
+        # so that e([x]₂, W_ζ + u W_ζω) = e([1]₂, ζ W_ζ + u ζω W_ζω + F - E)
+        W_zeta = proof["W_zeta"]
+        W_zeta_omega = proof["W_zeta_omega"]
+        opened = [
+            (proof["a_1"], a_eval),
+            (proof["b_1"], b_eval),
+            (proof["c_1"], c_eval),
+            (self.S1, s1_eval),
+            (self.S2, s2_eval),
+        ]
+        shifted = [(proof["z_1"], zw_eval)]
+        if custom:
+            opened += [(proof["d_1"], d_eval), (self.S3, s3_eval)]
+        if lookups:
+            opened += [
+                (self.Qk, qk_eval),
+                (self.Tk, tk_eval),
+                (proof["h1_1"], h1_eval),
+                (proof["h2_1"], h2_eval),
+            ]
+            shifted += [
+                (proof["z2_1"], z2w_eval),
+                (self.Tk, tkw_eval),
+                (proof["h1_1"], h1w_eval),
+            ]
+        F_1 = ec_lincomb(
+            [(R_1, 1)]
+            + [(x, v**i) for i, (x, _) in enumerate(opened, 1)]
+            + [(x, u * v**i) for i, (x, _) in enumerate(shifted)]
         )
+        E_ev = Scalar(0)
+        for i, (_, x_eval) in enumerate(opened, 1):
+            E_ev += x_eval * v**i
+        for i, (_, x_eval) in enumerate(shifted):
+            E_ev += x_eval * u * v**i
+        left = ec_lincomb([(W_zeta, 1), (W_zeta_omega, u)])
+        right = ec_lincomb(
+            [
+                (W_zeta, zeta),
+                (W_zeta_omega, u * zeta * self.w),
+                (F_1, 1),
+                (b.G1, -E_ev),
+            ]
+        )
+        with span("pairing", "pairing"):
+            valid = b.pairing(self.X_2, left) == b.pairing(b.G2, right)
+        if not valid:
+            return False
 
-        right = t_eval * ZH_ev
-
-        assert left == right
-
-        print("Done equation check for all constraints")
+        log("Done KZG10 commitment check for all opened polynomials")
         return True
 
     # Compute challenges (should be same as those computed by prover)
     def compute_challenges(
         self, proof
-    ) -> tuple[Scalar, Scalar, Scalar, Scalar]:
-        transcript = Transcript(b"plonk")
+    ) -> tuple[Scalar, Scalar, Scalar, Scalar, Scalar, Scalar]:
+        transcript = Transcript(b"plonk", self.has_custom_gates(), self.has_lookups())
         beta, gamma = transcript.round_1(proof.msg_1)
         alpha = transcript.round_2(proof.msg_2)
         zeta = transcript.round_3(proof.msg_3)
+        v = transcript.round_4(proof.msg_4)
+        u = transcript.round_5(proof.msg_5)
 
-        return beta, gamma, alpha, zeta
-
-    def verify_commitment(self, proof, W, W_quot_key, eval_key, zeta):
-        W_quot = proof[W_quot_key]
-        eval = proof[eval_key]
-        ec_comb = ec_lincomb(
-            [
-                (W, 1),
-                (W_quot, zeta),
-                (b.G1, -eval),
-            ]
-        )
-
-        assert b.pairing(self.X_2, W_quot) == b.pairing(b.G2, ec_comb)
-        print(f"Done KZG10 commitment check for {eval_key} polynomial")
+        return beta, gamma, alpha, zeta, v, u
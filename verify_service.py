@@ -0,0 +1,133 @@
+# Batch verification service: reads proofs from a JSON-lines stream and
+# verifies them concurrently across a process pool against a single
+# verification key, writing one JSON verdict line per proof.
+#
+# Each input line is an object of the form
+#   {"id": ..., "proof": <Proof.to_json()>, "public": [60]}
+# where "proof" may also be the hex string of `serialization.encode_proof`,
+# and each output line has the form
+#   {"id": ..., "valid": true, "latency_ms": 1234.5, "error": null}
+#
+# Input is read as verdicts are written: at most `window` chunks of
+# `chunksize` proofs are in flight, so a fast producer on stdin does not
+# make the service buffer the whole stream.
+#
+# Usage:
+#   python verify_service.py --vk vk.json [--input proofs.jsonl] [--processes 8]
+import argparse
+import json
+import os
+import sys
+import time
+from collections import deque
+from instrumentation import clear_observers
+from itertools import islice
+from multiprocessing import Pool
+from typing import Iterable, Iterator, Optional
+from prover import Proof
+from serialization import decode_proof
+from verifier import VerificationKey
+
+# Verification key loaded once per worker process by `_init_worker`
+_vk: Optional[VerificationKey] = None
+
+
+def _init_worker(vk_json: dict):
+    global _vk
+    clear_observers()
+    _vk = VerificationKey.from_json(vk_json)
+
+
+def _verify_line(item: tuple[int, str]) -> dict:
+    index, line = item
+    start = time.perf_counter()
+    proof_id = index
+    try:
+        request = json.loads(line)
+        proof_id = request.get("id", index)
+        if isinstance(request["proof"], str):
+            proof = decode_proof(bytes.fromhex(request["proof"]))
+        else:
+            proof = Proof.from_json(request["proof"])
+        valid = _vk.verify_proof(_vk.group_order, proof, request.get("public", []))
+        error = None
+    except Exception as e:
+        valid = False
+        error = "{}: {}".format(type(e).__name__, e)
+    return {
+        "id": proof_id,
+        "valid": bool(valid),
+        "latency_ms": (time.perf_counter() - start) * 1000,
+        "error": error,
+    }
+
+
+def _verify_lines(items: list[tuple[int, str]]) -> list[dict]:
+    return [_verify_line(x) for x in items]
+
+
+# Verifies every proof in `lines` (one JSON request per line, blank lines
+# skipped) and yields the verdicts in input order. Requests are sent to the
+# workers `chunksize` at a time, and at most `window` chunks (by default
+# two per process) are read ahead of the verdicts yielded
+def verify_stream(
+    vk: VerificationKey,
+    lines: Iterable[str],
+    processes: Optional[int] = None,
+    chunksize: int = 1,
+    window: Optional[int] = None,
+) -> Iterator[dict]:
+    processes = processes or os.cpu_count() or 1
+    window = window or 2 * processes
+    requests = ((i, line) for i, line in enumerate(lines) if line.strip())
+    pending = deque()
+    with Pool(processes, _init_worker, (vk.to_json(),)) as pool:
+        for chunk in iter(lambda: list(islice(requests, chunksize)), []):
+            pending.append(pool.apply_async(_verify_lines, (chunk,)))
+            if len(pending) == window:
+                yield from pending.popleft().get()
+        while pending:
+            yield from pending.popleft().get()
+
+
+def main(argv: Optional[list[str]] = None):
+    parser = argparse.ArgumentParser(
+        description="Verify a stream of proofs against a verification key"
+    )
+    parser.add_argument("--vk", required=True, help="verification key JSON file")
+    parser.add_argument(
+        "--input", default="-", help="JSON-lines proof file, - for stdin"
+    )
+    parser.add_argument(
+        "--output", default="-", help="JSON-lines verdict file, - for stdout"
+    )
+    parser.add_argument(
+        "--processes", type=int, default=None, help="worker processes"
+    )
+    parser.add_argument(
+        "--chunksize", type=int, default=1, help="proofs sent to a worker at once"
+    )
+    parser.add_argument(
+        "--window", type=int, default=None, help="chunks in flight at once"
+    )
+    args = parser.parse_args(argv)
+
+    with open(args.vk) as f:
+        vk = VerificationKey.from_json(json.load(f))
+    source = sys.stdin if args.input == "-" else open(args.input)
+    sink = sys.stdout if args.output == "-" else open(args.output, "w")
+    try:
+        for verdict in verify_stream(
+            vk, source, args.processes, args.chunksize, args.window
+        ):
+            sink.write(json.dumps(verdict) + "\n")
+            sink.flush()
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if sink is not sys.stdout:
+            sink.close()
+
+
+if __name__ == "__main__":
+    main()
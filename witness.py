@@ -0,0 +1,132 @@
+# Witness validation
+#
+# Checks that a witness satisfies every gate and copy constraint of a
+# program in a single pass over its rows, before any proving work is done.
+# The checks are run on numpy arrays of the field elements' integers rather
+# than on Polynomial objects, so each constraint is one vectorized
+# expression instead of a loop of Scalar operations.
+import numpy as np
+from compiler.program import Program, Witness
+from compiler.assembly import AssemblyEqn
+from compiler.utils import Column
+from curve import Scalar
+from dataclasses import dataclass
+from proving_key import ProvingKey
+from typing import Optional, Union
+
+
+@dataclass
+class ConstraintFailure:
+    """A row of the circuit that the witness does not satisfy"""
+
+    row: int
+    # "gate" for a gate equation, "copy" for a copy constraint between two
+    # cells holding the same variable, "lookup" for a value missing from the
+    # lookup table
+    kind: str
+    # Wire column of the cell, for copy constraints
+    column: Optional[Column]
+    # Source equation of the row, None for padding rows
+    eqn: Optional[AssemblyEqn]
+
+    def __str__(self) -> str:
+        cell = "" if self.column is None else " ({})".format(self.column.name)
+        return "row {}{}: {} constraint failed for {}".format(
+            self.row, cell, self.kind, self.eqn
+        )
+
+
+# Values of the left, right and output wires of every row, and of the
+# fourth wire for programs with custom gates, padded with zeros up to the
+# group order
+def wire_values(program: Program, witness: Witness) -> tuple[list[Scalar], ...]:
+    padding = [Scalar(0)] * (program.group_order - program.num_constraints)
+    columns = len(program.columns())
+    return tuple(
+        [Scalar(x) for x in witness[ids]] + padding
+        for ids in program.wire_ids.as_list()[:columns]
+    )
+
+
+# Public input values, negated, in the first rows of the circuit
+def public_values(program: Program, witness: Witness) -> list[Scalar]:
+    public = [Scalar(-witness[id]) for id in program.public_ids()]
+    return public + [Scalar(0)] * (program.group_order - len(public))
+
+
+def _ints(values: list[Scalar]) -> np.ndarray:
+    return np.array([x.n for x in values], dtype=object)
+
+
+# Checks wire values against the gate and copy constraints of the program.
+# The selector and permutation polynomials are taken from `pk` if given,
+# and recomputed from the program otherwise. `D` holds the fourth wire of
+# programs with custom gates
+def validate_wires(
+    program: Program,
+    A: list[Scalar],
+    B: list[Scalar],
+    C: list[Scalar],
+    PI: list[Scalar],
+    pk: Optional[ProvingKey] = None,
+    D: Optional[list[Scalar]] = None,
+) -> list[ConstraintFailure]:
+    group_order = program.group_order
+    modulus = Scalar.field_modulus
+    if pk is None:
+        pk = program.common_preprocessed_input()
+
+    def eqn(row: int) -> Optional[AssemblyEqn]:
+        return program.constraints[row] if row < program.num_constraints else None
+
+    a, b, c = _ints(A), _ints(B), _ints(C)
+    QL, QR, QM, QO, QC = (_ints(x.values) for x in (pk.QL, pk.QR, pk.QM, pk.QO, pk.QC))
+    gates = (QL * a + QR * b + QM * a * b + QO * c + _ints(PI) + QC) % modulus
+    wires = [a, b, c]
+    if pk.QD is not None:
+        d = _ints(D)
+        QD, QL5, QR5, QO5 = (_ints(x.values) for x in (pk.QD, pk.QL5, pk.QR5, pk.QO5))
+        a5, b5, c5 = (x**5 % modulus for x in wires)
+        gates = (gates + QD * d + QL5 * a5 + QR5 * b5 + QO5 * c5) % modulus
+        wires.append(d)
+    failures = [
+        ConstraintFailure(int(row), "gate", None, eqn(int(row)))
+        for row in np.flatnonzero(gates)
+    ]
+    # Lookup rows need their left wire in the table
+    if pk.QK is not None:
+        table = {x.n for x in pk.TK.values}
+        for row in np.flatnonzero(_ints(pk.QK.values)):
+            if a[row] not in table:
+                failures.append(ConstraintFailure(int(row), "lookup", None, eqn(row)))
+
+    # Cell (column, row) is labelled ω^row * column, and S_σ maps each cell
+    # to the label of the next cell holding the same variable. A witness
+    # fulfils the copy constraints iff every cell equals the cell it maps to
+    columns = program.columns()
+    S = [pk.S1, pk.S2, pk.S3, pk.S4][: len(columns)]
+    labels = {}
+    for column in columns:
+        for row, root in enumerate(Scalar.roots_of_unity(group_order)):
+            labels[(root * column.value).n] = (column.value - 1) * group_order + row
+    sigma = np.array([labels[x.n] for s in S for x in s.values], dtype=np.int64)
+    cells = np.concatenate(wires)
+    for i in np.flatnonzero(cells != cells[sigma]):
+        column, row = columns[i // group_order], int(i % group_order)
+        failures.append(ConstraintFailure(row, "copy", column, eqn(row)))
+
+    return sorted(failures, key=lambda x: x.row)
+
+
+# Checks a full witness, as an array or as named assignments (see
+# `Program.fill_variable_assignments`), against the program, returning the
+# failing rows. An empty list means the witness can be proved
+def validate_witness(
+    program: Program,
+    witness: Union[dict[Optional[str], int], Witness],
+    pk: Optional[ProvingKey] = None,
+) -> list[ConstraintFailure]:
+    witness = program.witness_values(witness)
+    A, B, C, *D = wire_values(program, witness)
+    PI = public_values(program, witness)
+    return validate_wires(program, A, B, C, PI, pk, D[0] if D else None)